@@ -0,0 +1,427 @@
+import ast
+import itertools
+import operator
+import sys
+from tpsup.logbasic import log_FileFuncLine
+from tpsup.modtools import compile_codelist
+
+try:
+    # pip install numpy
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def row_to_dict(row: list, fieldnames: list) -> dict:
+    """ a csv.reader row as a dict, the same way as csv.DictReader """
+    d = dict(zip(fieldnames, row))
+    if len(row) > len(fieldnames):
+        d[None] = row[len(fieldnames):]
+    elif len(row) < len(fieldnames):
+        for key in fieldnames[len(row):]:
+            d[key] = None
+    return d
+
+
+class Batch:
+    """
+    a batch of csv rows (lists), with its columns converted to numpy arrays on demand.
+    """
+
+    def __init__(self, rows: list, index_by_field: dict):
+        self.rows = rows
+        self.index_by_field = index_by_field
+        self.fieldnames = list(index_by_field)
+        self.array_by_key = {}
+        self.min_len = min(map(len, rows)) if rows else 0
+
+    def __len__(self):
+        return len(self.rows)
+
+    def get_array(self, field: str, cast: str = None):
+        """
+        cast=None for the strings as is, 'float' or 'int' for float(r[field]) or int(r[field]).
+        raise ValueError, TypeError or OverflowError where python's float() or int() would.
+        """
+        key = (field, cast)
+        if key not in self.array_by_key:
+            if (field, None) in self.array_by_key:
+                values = self.array_by_key[(field, None)]
+            else:
+                i = self.index_by_field[field]
+                if i < self.min_len:
+                    values = np.array(list(map(operator.itemgetter(i), self.rows)), dtype=object)
+                else:
+                    # like csv.DictReader, a short row has None for the missing fields
+                    values = np.array([row[i] if i < len(row) else None for row in self.rows], dtype=object)
+                self.array_by_key[(field, None)] = values
+            # an object array converts each value with python's own float() and int()
+            if cast == 'float':
+                self.array_by_key[key] = values.astype(np.float64)
+            elif cast == 'int':
+                self.array_by_key[key] = values.astype(np.int64)
+        return self.array_by_key[key]
+
+    def row_dict(self, i: int) -> dict:
+        return row_to_dict(self.rows[i], self.fieldnames)
+
+    def dicts(self, indices) -> list:
+        return [self.row_dict(i) for i in indices]
+
+
+class CachedBatch(Batch):
+    """
+    rows [start, end) of a tpsup.csvcachetools.ColumnCache. the int and float columns
+    are numpy arrays over the memory-mapped file, no parsing. a str column is converted
+    once per distinct value, in shared, then picked by its codes.
+    """
+
+    def __init__(self, cache, start: int, end: int, shared: dict):
+        self.cache = cache
+        self.start = start
+        self.end = end
+        self.shared = shared
+        self.fieldnames = cache.fieldnames
+        self.array_by_key = {}
+
+    def __len__(self):
+        return self.end - self.start
+
+    def get_typed(self, field: str):
+        return np.asarray(self.cache.get_view(field)[self.start:self.end])
+
+    def get_dictionary_array(self, field: str, cast: str = None):
+        """ the str column's dictionary as an array, or None if some value does not cast """
+        key = (field, cast)
+        if key not in self.shared:
+            values = np.array(self.cache.get_dictionary(field), dtype=object)
+            if cast is not None:
+                try:
+                    values = values.astype(np.float64 if cast == 'float' else np.int64)
+                except (ValueError, TypeError, OverflowError):
+                    values = None
+            self.shared[key] = values
+        return self.shared[key]
+
+    def get_array(self, field: str, cast: str = None):
+        key = (field, cast)
+        if key in self.array_by_key:
+            return self.array_by_key[key]
+
+        kind = self.cache.get_kind(field)
+        values = None
+        if kind == 'str':
+            dictionary = self.get_dictionary_array(field, cast)
+            if dictionary is not None:
+                values = dictionary[self.get_typed(field)]
+        elif cast == 'float':
+            values = self.get_typed(field).astype(np.float64)
+        elif cast == 'int' and kind == 'int':
+            values = self.get_typed(field)
+        if values is None:
+            # the strings, so that python's own float() or int() raises, eg, int('1.5')
+            values = np.array(self.cache.get_strings(field, self.start, self.end), dtype=object)
+            if cast == 'float':
+                values = values.astype(np.float64)
+            elif cast == 'int':
+                values = values.astype(np.int64)
+        self.array_by_key[key] = values
+        return values
+
+    def row_dict(self, i: int) -> dict:
+        return self.dicts([i])[0]
+
+    def dicts(self, indices) -> list:
+        indices = np.asarray(indices, dtype=np.int64)
+        columns = []
+        for field in self.fieldnames:
+            picked = self.get_typed(field)[indices].tolist()
+            kind = self.cache.get_kind(field)
+            if kind == 'int':
+                columns.append(map(str, picked))
+            elif kind == 'float':
+                columns.append(map(repr, picked))
+            else:
+                columns.append(map(self.cache.get_dictionary(field).__getitem__, picked))
+        return [dict(zip(self.fieldnames, values)) for values in zip(*columns)]
+
+
+class Untranslatable(Exception):
+    pass
+
+
+compare_ops = {
+    ast.Eq: operator.eq,
+    ast.NotEq: operator.ne,
+    ast.Lt: operator.lt,
+    ast.LtE: operator.le,
+    ast.Gt: operator.gt,
+    ast.GtE: operator.ge,
+}
+
+# no division: numpy returns inf for x/0, python raises ZeroDivisionError
+arith_ops = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+}
+
+
+def translate_exp(exp: str, fieldnames: list):
+    """
+    translate a row expression into a function(batch) returning a boolean mask.
+    raise Untranslatable if the expression is more than:
+        r['f'] or r["f"], float(r['f']), int(r['f']), where f is a csv column
+        int, float and str constants, + - * of numbers
+        comparisons (== != < <= > >=, chained too), str in/not in a tuple/list/set of strs
+        and, or, not
+    a str is only compared with a str, and a number with a number, the same way python
+    would not raise.
+    """
+    try:
+        tree = ast.parse(exp.strip(), mode='eval')
+    except SyntaxError:
+        raise Untranslatable(exp)
+    fields = set(fieldnames)
+
+    def get_field(node) -> str:
+        if isinstance(node, ast.Subscript) and isinstance(node.value, ast.Name) and node.value.id == 'r' \
+                and isinstance(node.slice, ast.Constant) and node.slice.value in fields:
+            return node.slice.value
+        return None
+
+    def term(node):
+        """ return (kind, func(batch)), kind is 'str' or 'num' """
+        if isinstance(node, ast.Constant):
+            value = node.value
+            if isinstance(value, bool) or value is None:
+                raise Untranslatable(exp)
+            if isinstance(value, str):
+                return 'str', lambda batch: value
+            if isinstance(value, (int, float)):
+                return 'num', lambda batch: value
+            raise Untranslatable(exp)
+        if (field := get_field(node)) is not None:
+            return 'str', lambda batch: batch.get_array(field)
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in ('float', 'int') \
+                and len(node.args) == 1 and not node.keywords and (field := get_field(node.args[0])) is not None:
+            cast = node.func.id
+            return 'num', lambda batch: batch.get_array(field, cast)
+        if isinstance(node, ast.BinOp) and type(node.op) in arith_ops:
+            kind1, f1 = term(node.left)
+            kind2, f2 = term(node.right)
+            if kind1 != 'num' or kind2 != 'num':
+                raise Untranslatable(exp)
+            op = arith_ops[type(node.op)]
+            return 'num', lambda batch: _checked(op, f1(batch), f2(batch))
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+            kind, f = term(node.operand)
+            if kind != 'num':
+                raise Untranslatable(exp)
+            return 'num', lambda batch: _checked(operator.neg, f(batch))
+        raise Untranslatable(exp)
+
+    def constants(node) -> list:
+        if not isinstance(node, (ast.Tuple, ast.List, ast.Set)):
+            raise Untranslatable(exp)
+        values = []
+        for elt in node.elts:
+            if not isinstance(elt, ast.Constant) or not isinstance(elt.value, str):
+                raise Untranslatable(exp)
+            values.append(elt.value)
+        return values
+
+    def mask(node):
+        if isinstance(node, ast.BoolOp):
+            funcs = [mask(v) for v in node.values]
+            op = operator.and_ if isinstance(node.op, ast.And) else operator.or_
+            return lambda batch: _reduce(op, [f(batch) for f in funcs])
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+            f = mask(node.operand)
+            return lambda batch: ~f(batch)
+        if isinstance(node, ast.Compare):
+            funcs = []
+            left = node.left
+            for op, right in zip(node.ops, node.comparators):
+                if isinstance(op, (ast.In, ast.NotIn)):
+                    kind, f = term(left)
+                    if kind != 'str':
+                        raise Untranslatable(exp)
+                    values = constants(right)
+                    invert = isinstance(op, ast.NotIn)
+                    funcs.append(lambda batch, f=f, values=values, invert=invert:
+                                 np.isin(_as_array(f(batch), batch), values, invert=invert))
+                elif type(op) in compare_ops:
+                    kind1, f1 = term(left)
+                    kind2, f2 = term(right)
+                    if kind1 != kind2:
+                        raise Untranslatable(exp)
+                    op_func = compare_ops[type(op)]
+                    funcs.append(lambda batch, f1=f1, f2=f2, op_func=op_func:
+                                 _as_array(op_func(f1(batch), f2(batch)), batch).astype(bool))
+                else:
+                    raise Untranslatable(exp)
+                left = right
+            return lambda batch: _reduce(operator.and_, [f(batch) for f in funcs])
+        raise Untranslatable(exp)
+
+    return mask(tree.body)
+
+
+def can_translate(exp: str, fieldnames: list) -> bool:
+    try:
+        translate_exp(exp, fieldnames)
+    except Untranslatable:
+        return False
+    return True
+
+
+def _reduce(op, masks: list):
+    result = masks[0]
+    for m in masks[1:]:
+        result = op(result, m)
+    return result
+
+
+def _checked(op, *args):
+    """
+    op(*args), but raise OverflowError where int64 would wrap around and python's int
+    would not. the caller then evaluates the batch row by row.
+    """
+    result = op(*args)
+    if isinstance(result, np.ndarray) and result.dtype.kind in 'iu':
+        # redo it in float64, which does not wrap. 2**62 leaves room for its rounding.
+        check = op(*[np.asarray(a, dtype=np.float64) for a in args])
+        if np.any(np.abs(check) >= 2.0 ** 62):
+            raise OverflowError(f'int64 overflow in {op.__name__}')
+    return result
+
+
+def _as_array(value, batch: Batch):
+    # a comparison of two constants is a scalar
+    if isinstance(value, np.ndarray):
+        return value
+    return np.full(len(batch), value)
+
+
+def filter_batches(batches,
+                   fieldnames: list,
+                   filter_func,
+                   MatchExps: list = None,
+                   ExcludeExps: list = None,
+                   **opt):
+    """
+    filter batches of rows, Batch or CachedBatch, with numpy masks for the MatchExps and
+    ExcludeExps that translate_exp() can handle. the rows passing the masks are turned
+    into dicts, the same way as csv.DictReader, and sent to filter_func(dict_iter,
+    MatchExps=..., ExcludeExps=...) with the remaining expressions, eg, filter_dicts().
+
+    when a translated expression fails on a batch, eg, float('') raises ValueError, it
+    is evaluated row by row for that batch, so errors and short-circuits stay the same.
+    """
+    verbose = opt.get('verbose', 0)
+    MatchExps = MatchExps or []
+    ExcludeExps = ExcludeExps or []
+
+    # [(exp, is_exclude, mask_func, row_func)]
+    translated = []
+    rest_match = []
+    rest_exclude = []
+    for exps, is_exclude, rest in [(MatchExps, False, rest_match), (ExcludeExps, True, rest_exclude)]:
+        for exp in exps:
+            try:
+                translated.append((exp, is_exclude, translate_exp(exp, fieldnames)))
+            except Untranslatable:
+                rest.append(exp)
+    row_funcs = compile_codelist([exp for exp, is_exclude, mask_func in translated], is_exp=True,
+                                 code_header='import re\n', signature='r')
+
+    if verbose:
+        log_FileFuncLine(f'vectorized={[exp for exp, is_exclude, f in translated]}, '
+                         f'row by row={rest_match + rest_exclude}', file=sys.stderr)
+
+    def get_passed_dicts():
+        for batch in batches:
+            passed = np.ones(len(batch), dtype=bool)
+            for (exp, is_exclude, mask_func), row_func in zip(translated, row_funcs):
+                try:
+                    m = mask_func(batch)
+                except (ValueError, TypeError, OverflowError):
+                    if verbose > 1:
+                        log_FileFuncLine(f'{exp} falls back to row by row for a batch', file=sys.stderr)
+                    m = np.zeros(len(batch), dtype=bool)
+                    for i in np.flatnonzero(passed):
+                        m[i] = bool(row_func(batch.row_dict(i)))
+                passed &= ~m if is_exclude else m
+            yield from batch.dicts(np.flatnonzero(passed))
+
+    yield from filter_func(get_passed_dicts(), MatchExps=rest_match, ExcludeExps=rest_exclude)
+
+
+def filter_csv_columnar(csv_reader,
+                        fieldnames: list,
+                        filter_func,
+                        MatchExps: list = None,
+                        ExcludeExps: list = None,
+                        batch_size: int = 65536,
+                        **opt):
+    """
+    filter the rows of a csv.reader in batches. see filter_batches().
+    """
+    index_by_field = {field: i for i, field in enumerate(fieldnames)}
+
+    def get_batches():
+        while True:
+            chunk = list(itertools.islice(csv_reader, batch_size))
+            if not chunk:
+                break
+            # like csv.DictReader, skip blank lines
+            rows = [row for row in chunk if row]
+            if rows:
+                yield Batch(rows, index_by_field)
+
+    yield from filter_batches(get_batches(), fieldnames, filter_func, MatchExps, ExcludeExps, **opt)
+
+
+def filter_cached_columnar(cache,
+                           filter_func,
+                           MatchExps: list = None,
+                           ExcludeExps: list = None,
+                           batch_size: int = 65536,
+                           **opt):
+    """
+    filter the rows of a tpsup.csvcachetools.ColumnCache in batches. see filter_batches().
+    """
+    shared = {}
+
+    def get_batches():
+        for start in range(0, cache.num_rows, batch_size):
+            yield CachedBatch(cache, start, min(start + batch_size, cache.num_rows), shared)
+
+    yield from filter_batches(get_batches(), cache.fieldnames, filter_func, MatchExps, ExcludeExps, **opt)
+
+
+def main():
+    fieldnames = ['side', 'qty', 'px']
+    rows = [['B', '1500', '10.5'], ['S', '2000', '9'], ['B', '10', '1'], ['B', '', '2']]
+    batch = Batch(rows, {f: i for i, f in enumerate(fieldnames)})
+    big_rows = [['B', '3037000500', '1'], ['S', '2', '1']]
+
+    def test_codes():
+        translate_exp("float(r['qty']) > 1000 and r['side'] == 'B'", fieldnames)(Batch(rows[:3], batch.index_by_field))
+        translate_exp("r['side'] in ('S', 'X') or int(r['px']) > 5", fieldnames)(Batch(rows[1:3], batch.index_by_field))
+        can_translate("r['side'] > 1", fieldnames)  # False
+        can_translate("r['temp'] == 'B'", fieldnames)  # False
+        can_translate("r['side'].startswith('B')", fieldnames)  # False
+        [r['qty'] for r in filter_csv_columnar(iter(rows), fieldnames, lambda dicts, **opt: dicts,
+                                               MatchExps=["r['qty'] != '' and float(r['qty']) > 1000"])]
+        # 3037000500 * 3037000500 wraps around in int64. the batch falls back to row by row.
+        [r['qty'] for r in filter_csv_columnar(iter(big_rows), fieldnames, lambda dicts, **opt: dicts,
+                                               MatchExps=["int(r['qty']) * int(r['qty']) > 5"])]
+
+    from tpsup.testtools import test_lines
+    test_lines(test_codes, source_globals=globals(), source_locals=locals())
+
+
+if __name__ == '__main__':
+    main()
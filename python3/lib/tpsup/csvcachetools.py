@@ -0,0 +1,424 @@
+import array
+import itertools
+import json
+import mmap
+import operator
+import os
+import struct
+import sys
+from tpsup.logbasic import log_FileFuncLine
+
+magic = b'TPCOL1\n\0'
+
+# the array typecodes of the column kinds. all are 8 bytes except the str codes.
+typecode_by_kind = {'int': 'q', 'float': 'd', 'str': 'i'}
+
+int64_min = -2 ** 63
+int64_max = 2 ** 63 - 1
+
+
+def get_cache_dir(CacheDir: str = None) -> str:
+    if not CacheDir:
+        CacheDir = os.path.expanduser("~") + '/.tpsup/csvcache'
+    # the cached csv files may have secrets, eg, conn.csv
+    os.makedirs(CacheDir, mode=0o700, exist_ok=True)
+    return CacheDir
+
+
+def get_cache_file(filename: str, CacheDir: str = None) -> str:
+    """
+    the sidecar of a csv file, named after its absolute path, like the gzindex sidecar.
+    """
+    abs_path = os.path.abspath(filename).replace('\\', '/')
+    return f'{get_cache_dir(CacheDir)}/{abs_path.replace("/", "%").replace(":", "%")}.tpcol'
+
+
+def convert_values(values: list) -> tuple:
+    """
+    return ('int', ints) if every value is exactly what str(int(value)) gives back and fits
+    in an int64, ('float', floats) if every value is exactly what repr(float(value)) gives
+    back, otherwise ('str', None).
+    """
+    if not values:
+        return 'str', None
+    try:
+        ints = list(map(int, values))
+        if list(map(str, ints)) == values and int64_min <= min(ints) and max(ints) <= int64_max:
+            return 'int', ints
+    except ValueError:
+        pass
+    try:
+        floats = list(map(float, values))
+        if list(map(repr, floats)) == values:
+            return 'float', floats
+    except ValueError:
+        pass
+    return 'str', None
+
+
+class ColumnCacheBuilder:
+    """
+    collect the rows of a csv file, column by column, then save them as a sidecar:
+        magic, header length, json header, then the column arrays, 8-byte aligned.
+    a column whose values all convert to int (or float) and back to the same string is
+    saved as an int64 (or float64) array. any other column is saved as int32 codes into
+    a dictionary of its distinct strings.
+
+    the rows are held in memory until save(). once the sidecar would exceed CacheMB, the
+    builder gives up and frees them, so that a big file costs no more memory than CacheMB.
+    """
+
+    def __init__(self, fieldnames: list, batch_size: int = 4096, CacheMB: float = 1024, **opt):
+        self.verbose = opt.get('verbose', 0)
+        self.fieldnames = list(fieldnames)
+        self.batch_size = batch_size
+        self.CacheMB = CacheMB
+        self.batch = []
+        self.kinds = [None for f in self.fieldnames]
+        # the int or float columns
+        self.arrays = [None for f in self.fieldnames]
+        # the str columns: a value's first row number, in the order of first appearance,
+        # and each row's value as the first row number of the value
+        self.first_row_by_value = [None for f in self.fieldnames]
+        self.first_rows = [None for f in self.fieldnames]
+        # the bytes of each str column's distinct strings
+        self.string_bytes = [0 for f in self.fieldnames]
+        self.num_rows = 0
+        self.disabled = False
+        self.disabled_reason = None
+
+    def add_row(self, row: list):
+        """ add a row from csv.reader """
+        self.batch.append(row)
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def add_strings(self, i: int, values, start_row: int):
+        if self.first_row_by_value[i] is None:
+            self.first_row_by_value[i] = {}
+            self.first_rows[i] = array.array('q')
+        first_row_by_value = self.first_row_by_value[i]
+        size = len(first_row_by_value)
+        # setdefault() gives a new value this row's number, all in C
+        self.first_rows[i].extend(map(first_row_by_value.setdefault, values, itertools.count(start_row)))
+        # the new values are the last ones in the dict
+        new = len(first_row_by_value) - size
+        if new:
+            self.string_bytes[i] += sum(map(len, itertools.islice(reversed(first_row_by_value), new)))
+
+    def get_size(self) -> int:
+        """ about the size of the sidecar of the rows so far """
+        size = 0
+        for i, kind in enumerate(self.kinds):
+            if kind == 'str':
+                # int32 codes, and int64 offsets plus the bytes of the distinct strings
+                size += 4 * self.num_rows + 8 * len(self.first_row_by_value[i]) + self.string_bytes[i]
+            else:
+                size += 8 * self.num_rows
+        return size
+
+    def disable(self, reason: str):
+        """ stop collecting rows, and free the ones collected """
+        self.disabled = True
+        self.disabled_reason = reason
+        self.batch = []
+        self.arrays = None
+        self.first_row_by_value = None
+        self.first_rows = None
+
+    def flush(self):
+        batch = self.batch
+        self.batch = []
+        if self.disabled or not batch:
+            return
+        if set(map(len, batch)) != {len(self.fieldnames)}:
+            # a row with too few or too many fields. DictReader fills the missing ones with
+            # None, or puts the extra ones under key None; the cache only stores strings.
+            self.disable('has rows of the wrong length')
+            return
+        for i in range(len(self.fieldnames)):
+            values = list(map(operator.itemgetter(i), batch))
+            if self.kinds[i] == 'str':
+                self.add_strings(i, values, self.num_rows)
+                continue
+            kind, converted = convert_values(values)
+            if self.kinds[i] is None:
+                self.kinds[i] = kind
+                if kind != 'str':
+                    self.arrays[i] = array.array(typecode_by_kind[kind])
+            elif kind != self.kinds[i]:
+                # a mixed column, eg, ints then an empty string. the earlier rows convert
+                # back to their strings exactly.
+                to_str = str if self.kinds[i] == 'int' else repr
+                self.add_strings(i, map(to_str, self.arrays[i]), 0)
+                self.kinds[i] = kind = 'str'
+                self.arrays[i] = None
+            if kind == 'str':
+                self.add_strings(i, values, self.num_rows)
+            else:
+                self.arrays[i].extend(converted)
+        self.num_rows += len(batch)
+
+        size = self.get_size()
+        if size > self.CacheMB * 1024 * 1024:
+            self.disable(f'cache would be over {self.CacheMB} MB')
+
+    def save(self, cache_file: str, source: dict, **opt) -> bool:
+        """
+        write the sidecar. source is {'path', 'size', 'mtime_ns', 'skip'} of the csv file.
+        return False if the rows could not be cached or the sidecar would exceed CacheMB.
+        """
+        self.flush()
+        if self.disabled:
+            if self.verbose:
+                log_FileFuncLine(f'{source["path"]} {self.disabled_reason}, not cached', file=sys.stderr)
+            return False
+
+        columns = []
+        sections = []
+        offset = 0
+        for i, field in enumerate(self.fieldnames):
+            # a file without rows has str columns
+            kind = self.kinds[i] or 'str'
+            column = {'name': field, 'kind': kind}
+            if kind == 'str':
+                if self.first_row_by_value[i] is None:
+                    self.add_strings(i, [], 0)
+                values = list(self.first_row_by_value[i])
+                code_by_first_row = dict(zip(self.first_row_by_value[i].values(), range(len(values))))
+                encoded = [v.encode('utf-8', 'surrogatepass') for v in values]
+                offsets = array.array('q', [0])
+                offsets.extend(itertools.accumulate(map(len, encoded)))
+                codes = array.array('i', map(code_by_first_row.__getitem__, self.first_rows[i]))
+                parts = [('offset', codes.tobytes()),
+                         ('dict_offset', offsets.tobytes()),
+                         ('blob_offset', b''.join(encoded))]
+                column['dict_size'] = len(values)
+            else:
+                parts = [('offset', self.arrays[i].tobytes())]
+            for key, data in parts:
+                column[key] = offset
+                sections.append(data)
+                offset += len(data)
+                padding = -offset % 8
+                if padding:
+                    sections.append(b'\0' * padding)
+                    offset += padding
+            column['blob_length'] = len(parts[-1][1]) if kind == 'str' else 0
+            columns.append(column)
+
+        header = dict(source)
+        header.update({'fieldnames': self.fieldnames, 'num_rows': self.num_rows, 'columns': columns})
+        header_bytes = json.dumps(header).encode('utf-8')
+        header_bytes += b' ' * (-(len(magic) + 8 + len(header_bytes)) % 8)
+
+        total = len(magic) + 8 + len(header_bytes) + offset
+        if total > self.CacheMB * 1024 * 1024:
+            if self.verbose:
+                log_FileFuncLine(f'{source["path"]} cache would be {total} bytes, over {self.CacheMB} MB, not cached',
+                                 file=sys.stderr)
+            return False
+
+        # write to a tmp file first, so that a reader never sees a half sidecar
+        tmp_file = f'{cache_file}.tmp{os.getpid()}'
+        # only the owner can read it, whatever the csv file's permission
+        with os.fdopen(os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as fh:
+            fh.write(magic)
+            fh.write(struct.pack('<q', len(header_bytes)))
+            fh.write(header_bytes)
+            for data in sections:
+                fh.write(data)
+        os.replace(tmp_file, cache_file)
+
+        if self.verbose:
+            log_FileFuncLine(f'saved {self.num_rows} rows of {source["path"]} to {cache_file}, {total} bytes',
+                             file=sys.stderr)
+        return True
+
+
+class ColumnCache:
+    """
+    a memory-mapped sidecar saved by ColumnCacheBuilder. the int and float columns are
+    memoryviews over the file; the str columns are memoryviews of codes plus a
+    dictionary decoded on first use.
+    """
+
+    def __init__(self, cache_file: str):
+        self.cache_file = cache_file
+        with open(cache_file, 'rb') as fh:
+            self.mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mm[:len(magic)] != magic:
+            raise RuntimeError(f'{cache_file} is not a csv cache file')
+        header_length, = struct.unpack('<q', self.mm[len(magic):len(magic) + 8])
+        start = len(magic) + 8
+        self.header = json.loads(self.mm[start:start + header_length])
+        self.data_start = start + header_length
+        self.fieldnames = self.header['fieldnames']
+        self.num_rows = self.header['num_rows']
+        self.column_by_field = {c['name']: c for c in self.header['columns']}
+        self.dictionary_by_field = {}
+
+    def get_kind(self, field: str) -> str:
+        return self.column_by_field[field]['kind']
+
+    def get_view(self, field: str, key: str = 'offset', count: int = None):
+        """ a memoryview of a column's array, without copying """
+        column = self.column_by_field[field]
+        typecode = 'q' if key == 'dict_offset' else typecode_by_kind[column['kind']]
+        if count is None:
+            count = self.num_rows
+        start = self.data_start + column[key]
+        return memoryview(self.mm)[start:start + count * array.array(typecode).itemsize].cast(typecode)
+
+    def get_dictionary(self, field: str) -> list:
+        """ the distinct strings of a str column, indexed by code """
+        if field not in self.dictionary_by_field:
+            column = self.column_by_field[field]
+            offsets = self.get_view(field, 'dict_offset', column['dict_size'] + 1)
+            start = self.data_start + column['blob_offset']
+            blob = self.mm[start:start + column['blob_length']]
+            self.dictionary_by_field[field] = [blob[offsets[i]:offsets[i + 1]].decode('utf-8', 'surrogatepass')
+                                               for i in range(column['dict_size'])]
+        return self.dictionary_by_field[field]
+
+    def get_strings(self, field: str, start: int = 0, end: int = None) -> list:
+        """ the values of rows [start, end) of a column, as the csv strings """
+        view = self.get_view(field)[start:end]
+        kind = self.get_kind(field)
+        if kind == 'int':
+            return list(map(str, view))
+        if kind == 'float':
+            return list(map(repr, view))
+        return list(map(self.get_dictionary(field).__getitem__, view))
+
+    def iter_dicts(self, batch_size: int = 65536):
+        """ yield the rows as dicts, like csv.DictReader """
+        fieldnames = self.fieldnames
+        for start in range(0, self.num_rows, batch_size):
+            end = min(start + batch_size, self.num_rows)
+            columns = [self.get_strings(f, start, end) for f in fieldnames]
+            for values in zip(*columns):
+                yield dict(zip(fieldnames, values))
+
+    def close(self):
+        try:
+            self.mm.close()
+        except BufferError:
+            # a caller still holds a view. the mapping goes away with the last view.
+            pass
+
+
+def get_source(filename: str, skip: int = 0) -> dict:
+    st = os.stat(filename)
+    return {'path': os.path.abspath(filename), 'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'skip': skip}
+
+
+def open_column_cache(filename: str, CacheDir: str = None, skip: int = 0, **opt):
+    """
+    return the ColumnCache of a csv file if its sidecar matches the file's path, size,
+    mtime and skip; otherwise None. a hit marks the sidecar as recently used.
+    """
+    verbose = opt.get('verbose', 0)
+    cache_file = get_cache_file(filename, CacheDir)
+    if not os.path.exists(cache_file):
+        return None
+    try:
+        cache = ColumnCache(cache_file)
+    except Exception as e:
+        if verbose:
+            log_FileFuncLine(f'cannot read {cache_file}: {e}', file=sys.stderr)
+        return None
+
+    source = get_source(filename, skip)
+    if any(cache.header.get(k) != v for k, v in source.items()):
+        if verbose:
+            log_FileFuncLine(f'{cache_file} is stale', file=sys.stderr)
+        cache.close()
+        return None
+
+    # the mtime of a sidecar is its last use, for evict_column_cache()
+    os.utime(cache_file)
+    if verbose:
+        log_FileFuncLine(f'reuse {cache_file}', file=sys.stderr)
+    return cache
+
+
+def save_column_cache(builder: ColumnCacheBuilder, filename: str, CacheDir: str = None, CacheMB: float = 1024,
+                      skip: int = 0, **opt):
+    cache_file = get_cache_file(filename, CacheDir)
+    try:
+        if builder.save(cache_file, get_source(filename, skip)):
+            evict_column_cache(CacheDir, CacheMB, **opt)
+    except OSError as e:
+        # a full disk or a read-only cache dir must not fail the query
+        print(f'failed to save csv cache {cache_file}: {e}', file=sys.stderr)
+
+
+def evict_column_cache(CacheDir: str = None, CacheMB: float = 1024, **opt):
+    """
+    remove the least recently used sidecars until the cache dir is within CacheMB.
+    """
+    verbose = opt.get('verbose', 0)
+    cache_dir = get_cache_dir(CacheDir)
+    entries = []
+    total = 0
+    for entry in os.scandir(cache_dir):
+        if not entry.name.endswith('.tpcol') or not entry.is_file():
+            continue
+        st = entry.stat()
+        entries.append((st.st_mtime, entry.path, st.st_size))
+        total += st.st_size
+
+    budget = CacheMB * 1024 * 1024
+    for mtime, path, size in sorted(entries):
+        if total <= budget:
+            break
+        if verbose:
+            log_FileFuncLine(f'evict {path}', file=sys.stderr)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            # another process evicted it
+            pass
+        total -= size
+
+
+def main():
+    import shutil
+    import tpsup.tmptools
+    test_dir = f'{tpsup.tmptools.get_dailydir()}/csvcache_test'
+    shutil.rmtree(test_dir, ignore_errors=True)
+    os.makedirs(test_dir)
+    csv_file = f'{test_dir}/test.csv'
+    with open(csv_file, 'w') as fh:
+        fh.write('sym,qty,px,note\nIBM,100,10.5,\nAAPL,-2,9.25,new\nIBM,007,1.0,x\n')
+
+    import csv
+    with open(csv_file) as fh:
+        reader = csv.reader(fh)
+        builder = ColumnCacheBuilder(next(reader), batch_size=2)
+        for row in reader:
+            builder.add_row(row)
+    save_column_cache(builder, csv_file, CacheDir=test_dir)
+
+    small = ColumnCacheBuilder(['sym', 'qty'], batch_size=2, CacheMB=0.00002)
+    for row in [['IBM', '1'], ['AAPL', '2'], ['MSFT', '3']]:
+        small.add_row(row)
+    cache = open_column_cache(csv_file, CacheDir=test_dir)
+
+    def test_codes():
+        [cache.get_kind(f) for f in cache.fieldnames]  # ['str', 'str', 'float', 'str']
+        cache.get_dictionary('sym')
+        list(cache.get_view('px'))
+        list(cache.iter_dicts(batch_size=2))
+        evict_column_cache(test_dir, CacheMB=0)
+        open_column_cache(csv_file, CacheDir=test_dir)  # None, evicted
+        small.disabled_reason  # over CacheMB after the first batch
+        small.first_rows  # None, freed
+
+    from tpsup.testtools import test_lines
+    test_lines(test_codes, source_globals=globals(), source_locals=locals())
+
+
+if __name__ == '__main__':
+    main()
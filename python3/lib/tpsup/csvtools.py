@@ -1,18 +1,41 @@
+from collections import deque
 import csv
+import datetime
+from functools import partial
+import heapq
 import inspect
 import io
+import itertools
+import mmap
+import multiprocessing
+import operator
 import os
+import pickle
 import pkgutil
 import re
+import shutil
 import sys
+import tempfile
 from pprint import pformat
 from tpsup.filetools import TpInput, TpOutput
+import tpsup.columntools
+import tpsup.csvcachetools
 from tpsup.logbasic import log_FileFuncLine
 from tpsup.utilbasic import convert_kvlist_to_dict, silence_BrokenPipeError
-from tpsup.modtools import load_module, stringdict_to_funcdict, strings_to_compilable_func
+from tpsup.modtools import load_module, stringdict_to_funcdict, strings_to_compilable_func, hoist_re_literals
 
 
 def filter_dicts(dict_iter, columns, **opt):
+    if opt.get('GroupBy') or opt.get('SortKeys'):
+        # filter first, then group and sort what is left
+        rows = filter_dicts(dict_iter, columns, **{**opt, 'GroupBy': None, 'SortKeys': None})
+        yield from group_and_sort_dicts(rows, **opt)
+        return
+
+    if opt.get('SchemaFunc'):
+        # typed values, converted once here, before the expressions see them
+        dict_iter = convert_dicts(dict_iter, opt['SchemaFunc'])
+
     verbose = opt.get('verbose', 0)
 
     if verbose:
@@ -69,11 +92,7 @@ def filter_dicts(dict_iter, columns, **opt):
         with open(helper_file, 'r') as f:
             source_list.append(f.read())
 
-    for attr, logic in [('MatchExps', 'and'), ('ExcludeExps', 'or')]:
-        _list = opt.get(attr, [])
-        source_list.append(strings_to_compilable_func(
-            _list, attr, logic=logic, verbose=verbose))
-
+    dict_by_attr = {}
     for attr in ['TempExps', 'ExportExps']:
         _dict = {}
 
@@ -87,9 +106,28 @@ def filter_dicts(dict_iter, columns, **opt):
                     # split at the first occurrence
                     (key, value) = pair.split("=", 1)
                     _dict[key] = value
+        dict_by_attr[attr] = _dict
+
+    match_list = opt.get('MatchExps', None) or []
+    exclude_list = opt.get('ExcludeExps', None) or []
+    all_exps = [*dict_by_attr['TempExps'].values(), *dict_by_attr['ExportExps'].values(),
+                *match_list, *exclude_list]
 
-        source_list.append(stringdict_to_funcdict(
-            _dict, attr, is_exp=1, verbose=verbose))
+    # 'ifh' needs the per-expression functions of modtools.string_to_temp_func()
+    fused = not any(re.search(r'\bifh\b', exp) for exp in all_exps)
+
+    if fused:
+        source_list.append(get_fused_filter_source(dict_by_attr['TempExps'], dict_by_attr['ExportExps'],
+                                                   match_list, exclude_list, verbose=verbose))
+    else:
+        for attr, logic in [('MatchExps', 'and'), ('ExcludeExps', 'or')]:
+            _list = opt.get(attr, [])
+            source_list.append(strings_to_compilable_func(
+                _list, attr, logic=logic, verbose=verbose))
+
+        for attr in ['TempExps', 'ExportExps']:
+            source_list.append(stringdict_to_funcdict(
+                dict_by_attr[attr], attr, is_exp=1, verbose=verbose))
 
     source = '\n\n'.join(source_list)
 
@@ -103,6 +141,10 @@ def filter_dicts(dict_iter, columns, **opt):
 
     exp_module = load_module(source)
 
+    if fused:
+        yield from exp_module.filter_rows(dict_iter)
+        return
+
     match_exps = exp_module.MatchExps
     exclude_exps = exp_module.ExcludeExps
     temp_dict = exp_module.TempExps
@@ -126,6 +168,760 @@ def filter_dicts(dict_iter, columns, **opt):
             raise e
 
 
+def get_fused_filter_source(temp_dict: dict,
+                            export_dict: dict,
+                            match_list: list,
+                            exclude_list: list,
+                            **opt) -> str:
+    """
+    generate the source of one generator, filter_rows(rows), that runs all expressions
+    of a query for each row in a single frame: the temp and export assignments, then the
+    match (and) and exclude (or) tests, stopping at the first one that fails. regex
+    literals, eg, re.search('^B', ...), are compiled once, outside the loop.
+    """
+    verbose = opt.get('verbose', 0)
+
+    keys = [*temp_dict.keys(), *export_dict.keys()]
+    exps, compiled_list = hoist_re_literals(
+        [*temp_dict.values(), *export_dict.values(), *match_list, *exclude_list])
+    assign_exps = exps[:len(keys)]
+    match_exps = exps[len(keys):len(keys) + len(match_list)]
+    exclude_exps = exps[len(keys) + len(match_list):]
+
+    statements = ['from pprint import pformat', *compiled_list, '',
+                  'def filter_rows(rows):', '    for r in rows:']
+    for k, exp in zip(keys, assign_exps):
+        statements.append(f'        r[{k!r}] = {exp}')
+    if verbose > 1:
+        statements.append("        sys.stderr.write(f'r = {pformat(r)}\\n')")
+    if match_exps or exclude_exps:
+        statements.append('        try:')
+        statements.extend([f'            if not ({exp}): continue' for exp in match_exps])
+        statements.extend([f'            if ({exp}): continue' for exp in exclude_exps])
+        statements.extend(['        except Exception:',
+                           "            sys.stderr.write(f'r = {pformat(r)}\\n')",
+                           '            raise'])
+    statements.append('        yield r')
+
+    return '\n'.join(statements)
+
+
+def to_number(value):
+    """
+    return value as an int or float if it looks like one, otherwise None.
+    """
+    if isinstance(value, (int, float)):
+        return value
+    if value is None or value == '' or not isinstance(value, str):
+        return None
+    if value.isdigit():
+        return int(value)
+    try:
+        return int(value)
+    except (ValueError, TypeError):
+        pass
+    try:
+        return float(value)
+    except (ValueError, TypeError):
+        return None
+
+
+def get_sort_key_func(SortKeys: list, Typed: bool = False):
+    """
+    SortKeys is a list of column names. 'col:num' sorts the column as numbers, where
+    the empty and non-numeric values come first. other columns sort as they are, with
+    None as ''.
+
+    Typed=True is for the rows converted by a QueryCsv Schema, where a column has typed
+    values and also strings, ie, the empty and unconverted values. the strings come
+    first, then the typed values.
+    """
+    parsed = []
+    for k in SortKeys:
+        if k.endswith(':num'):
+            parsed.append((k[:-4], True))
+        else:
+            parsed.append((k, False))
+
+    def get_key(r: dict) -> tuple:
+        key = []
+        for col, is_num in parsed:
+            value = r.get(col, None)
+            if is_num:
+                number = to_number(value)
+                key.append((0, 0) if number is None else (1, number))
+            elif Typed:
+                key.append(typed_key(value))
+            else:
+                key.append('' if value is None else value)
+        return tuple(key)
+
+    if Typed:
+        return get_key
+
+    if len(parsed) == 1 and not parsed[0][1]:
+        # the common case, one plain column. the key is called for every row.
+        col = parsed[0][0]
+
+        def get_key(r: dict):
+            value = r.get(col, None)
+            return '' if value is None else value
+
+    return get_key
+
+
+def typed_key(value) -> tuple:
+    if value is None:
+        return 0, ''
+    if isinstance(value, str):
+        return 0, value
+    return 1, value
+
+
+def get_row_bytes(r: dict) -> int:
+    """ a rough size of a row in memory """
+    return sys.getsizeof(r) + sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in r.items())
+
+
+def write_run(rows: list, run_dir: str, run_number: int) -> str:
+    run_file = os.path.join(run_dir, f'run{run_number}.pickle')
+    with open(run_file, 'wb') as fh:
+        # chunks, so that pickle shares the repeated keys within a chunk
+        for i in range(0, len(rows), 1000):
+            pickle.dump(rows[i:i + 1000], fh, protocol=pickle.HIGHEST_PROTOCOL)
+    return run_file
+
+
+def read_run(run_file: str):
+    with open(run_file, 'rb') as fh:
+        while True:
+            try:
+                chunk = pickle.load(fh)
+            except EOFError:
+                break
+            yield from chunk
+
+
+def sort_dicts(dict_iter,
+               SortKeys: list,
+               SortReverse: bool = False,
+               MemoryMB: float = 256,
+               TmpDir: str = None,
+               **opt):
+    """
+    sort the rows by SortKeys (see get_sort_key_func()), keeping the input order of equal
+    rows. rows are sorted in memory until about MemoryMB of them, then each sorted run is
+    written to a temp file under TmpDir, and the runs are merged at the end.
+    """
+    verbose = opt.get('verbose', 0)
+    get_key = get_sort_key_func(SortKeys, Typed=bool(opt.get('SchemaFunc', None)))
+    budget = MemoryMB * 1024 * 1024
+
+    rows = []
+    used = 0
+    run_dir = None
+    run_files = []
+    try:
+        for r in dict_iter:
+            rows.append(r)
+            if used == 0:
+                row_bytes = get_row_bytes(r)
+            used += row_bytes
+            if used >= budget:
+                if run_dir is None:
+                    run_dir = tempfile.mkdtemp(prefix='sort_dicts.', dir=TmpDir)
+                rows.sort(key=get_key, reverse=SortReverse)
+                run_files.append(write_run(rows, run_dir, len(run_files)))
+                if verbose:
+                    log_FileFuncLine(f'spilled {len(rows)} rows to {run_files[-1]}', file=sys.stderr)
+                rows = []
+                used = 0
+
+        rows.sort(key=get_key, reverse=SortReverse)
+        if not run_files:
+            yield from rows
+            return
+
+        # heapq.merge() takes from the earliest run on ties, so the sort stays stable
+        runs = [read_run(f) for f in run_files] + [rows]
+        yield from heapq.merge(*runs, key=get_key, reverse=SortReverse)
+    finally:
+        if run_dir is not None:
+            shutil.rmtree(run_dir, ignore_errors=True)
+
+
+agg_funcs = ['count', 'sum', 'min', 'max', 'mean', 'first', 'last']
+
+
+def parse_aggs(Aggs: list) -> list:
+    """
+    each agg is 'func:col', 'name=func:col', or 'count'. func is one of agg_funcs.
+    return [(name, func, col)]. the default name is func_col, eg, sum_qty.
+    """
+    parsed = []
+    for agg in Aggs or []:
+        name = None
+        if '=' in agg:
+            name, agg = agg.split('=', 1)
+        if ':' in agg:
+            func, col = agg.split(':', 1)
+        else:
+            func, col = agg, None
+        if func not in agg_funcs:
+            raise RuntimeError(f'unknown agg func={func} in {agg}. expected one of {agg_funcs}')
+        if col is None and func != 'count':
+            raise RuntimeError(f'agg {agg} needs a column, eg, {func}:qty')
+        if name is None:
+            name = func if col is None else f'{func}_{col}'
+        parsed.append((name, func, col))
+    return parsed
+
+
+def get_group_columns(GroupBy: list, Aggs: list) -> list:
+    return list(GroupBy) + [name for name, func, col in parse_aggs(Aggs)]
+
+
+def update_state(state: list, parsed_aggs: list, r: dict):
+    """
+    state has one accumulator per agg:
+        count: n; sum: total; mean: [total, n]; min/max: [sort_key, value]; first/last: value
+    """
+    for i, (name, func, col) in enumerate(parsed_aggs):
+        if func == 'count':
+            state[i] += 1
+            continue
+        value = r.get(col, None)
+        if func == 'first':
+            continue  # set when the state was created
+        if func == 'last':
+            state[i] = value
+            continue
+        if func in ('sum', 'mean'):
+            number = to_number(value)
+            if number is None:
+                continue
+            if func == 'sum':
+                state[i] += number
+            else:
+                state[i][0] += number
+                state[i][1] += 1
+            continue
+        # min and max: numbers before other values; compare the numbers as numbers. the
+        # other values are strings, or also dates with a Schema
+        if value is None or value == '':
+            continue
+        number = to_number(value)
+        key = (0, number) if number is not None else (1, typed_key(value))
+        if state[i] is None or (key < state[i][0] if func == 'min' else key > state[i][0]):
+            state[i] = [key, value]
+
+
+def new_state(parsed_aggs: list, r: dict) -> list:
+    state = []
+    for name, func, col in parsed_aggs:
+        if func in ('count', 'sum'):
+            state.append(0)
+        elif func == 'mean':
+            state.append([0, 0])
+        elif func == 'first':
+            state.append(r.get(col, None))
+        else:
+            state.append(None)
+    return state
+
+
+def merge_state(state: list, later: list, parsed_aggs: list):
+    """ merge the state of later rows into the state of earlier rows """
+    for i, (name, func, col) in enumerate(parsed_aggs):
+        if func in ('count', 'sum'):
+            state[i] += later[i]
+        elif func == 'mean':
+            state[i][0] += later[i][0]
+            state[i][1] += later[i][1]
+        elif func == 'last':
+            state[i] = later[i]
+        elif func in ('min', 'max'):
+            if later[i] is not None and (state[i] is None or (
+                    later[i][0] < state[i][0] if func == 'min' else later[i][0] > state[i][0])):
+                state[i] = later[i]
+
+
+def state_to_row(GroupBy: list, key: tuple, state: list, parsed_aggs: list) -> dict:
+    row = dict(zip(GroupBy, key))
+    for i, (name, func, col) in enumerate(parsed_aggs):
+        if func == 'mean':
+            total, n = state[i]
+            row[name] = total / n if n else ''
+        elif func in ('min', 'max'):
+            row[name] = state[i][1] if state[i] is not None else ''
+        else:
+            row[name] = state[i]
+    return row
+
+
+def group_dicts(dict_iter,
+                GroupBy: list,
+                Aggs: list = None,
+                MemoryMB: float = 256,
+                TmpDir: str = None,
+                Partitions: int = 16,
+                **opt):
+    """
+    group the rows by the GroupBy columns and compute the Aggs (see parse_aggs()) of each
+    group. yield one row per group, sorted by the GroupBy columns.
+
+    the groups are kept in a dict until about MemoryMB of them. then their partial states
+    are written to Partitions temp files, by the hash of the group key, and the dict starts
+    over. at the end, each partition file is merged on its own.
+    """
+    verbose = opt.get('verbose', 0)
+    parsed_aggs = parse_aggs(Aggs)
+    budget = MemoryMB * 1024 * 1024
+
+    state_by_key = {}
+    used = 0
+    group_bytes = 0
+    part_dir = None
+    part_fhs = None
+
+    def spill():
+        nonlocal part_dir, part_fhs
+        if part_dir is None:
+            part_dir = tempfile.mkdtemp(prefix='group_dicts.', dir=TmpDir)
+            part_fhs = [open(os.path.join(part_dir, f'part{i}.pickle'), 'wb') for i in range(Partitions)]
+        items_by_part = [[] for i in range(Partitions)]
+        for key, state in state_by_key.items():
+            items_by_part[hash(key) % Partitions].append((key, state))
+        for fh, items in zip(part_fhs, items_by_part):
+            if items:
+                pickle.dump(items, fh, protocol=pickle.HIGHEST_PROTOCOL)
+        if verbose:
+            log_FileFuncLine(f'spilled {len(state_by_key)} groups to {part_dir}', file=sys.stderr)
+        state_by_key.clear()
+
+    def get_rows():
+        if part_dir is None:
+            for key, state in state_by_key.items():
+                yield state_to_row(GroupBy, key, state, parsed_aggs)
+            return
+
+        spill()
+        for fh in part_fhs:
+            fh.close()
+        for i in range(Partitions):
+            merged = {}
+            # the partial states were written in input order, so first/last stay right
+            for key, state in read_run(os.path.join(part_dir, f'part{i}.pickle')):
+                if key in merged:
+                    merge_state(merged[key], state, parsed_aggs)
+                else:
+                    merged[key] = state
+            for key, state in merged.items():
+                yield state_to_row(GroupBy, key, state, parsed_aggs)
+
+    try:
+        for r in dict_iter:
+            key = tuple([r.get(col, None) for col in GroupBy])
+            state = state_by_key.get(key, None)
+            if state is None:
+                state = new_state(parsed_aggs, r)
+                state_by_key[key] = state
+                if not group_bytes:
+                    group_bytes = sys.getsizeof(key) + sum(sys.getsizeof(v) for v in key) \
+                        + sys.getsizeof(state) + 64 * len(state) + 100
+                used += group_bytes
+            update_state(state, parsed_aggs, r)
+            if used >= budget:
+                spill()
+                used = 0
+
+        # the groups of a partition can come out in any order
+        yield from sort_dicts(get_rows(), GroupBy, **{**opt, 'SortReverse': False,
+                                                      'MemoryMB': MemoryMB, 'TmpDir': TmpDir})
+    finally:
+        if part_fhs:
+            for fh in part_fhs:
+                fh.close()
+        if part_dir is not None:
+            shutil.rmtree(part_dir, ignore_errors=True)
+
+
+def group_and_sort_dicts(dict_iter, GroupBy: list = None, SortKeys: list = None, **opt):
+    """
+    apply GroupBy/Aggs, then SortKeys, to the rows. see group_dicts() and sort_dicts().
+    """
+    rows = dict_iter
+    if GroupBy:
+        rows = group_dicts(rows, GroupBy, **opt)
+    if SortKeys:
+        rows = sort_dicts(rows, SortKeys, **opt)
+    yield from rows
+
+
+class YyyymmddDate(datetime.date):
+    """ a date that prints as yyyymmdd, the way it was in the csv file """
+
+    def __str__(self):
+        return self.strftime('%Y%m%d')
+
+
+def to_date(value: str) -> YyyymmddDate:
+    if len(value) != 8 or not value.isdigit():
+        raise ValueError(f'not a yyyymmdd date: {value!r}')
+    return YyyymmddDate(int(value[:4]), int(value[4:6]), int(value[6:]))
+
+
+def is_yyyymmdd(value: str) -> bool:
+    try:
+        # years outside this range are more likely 8-digit ids
+        return 1900 <= to_date(value).year < 2200
+    except ValueError:
+        return False
+
+
+def is_int(value: str) -> bool:
+    # the value must come back the same, so that 007 and zip codes stay strings
+    try:
+        return str(int(value)) == value
+    except ValueError:
+        return False
+
+
+# no leading zero before another digit: 02139 is a code, 0.5 is a number
+float_pattern = re.compile(r'[+-]?((0|[1-9]\d*)(\.\d*)?|\.\d+)([eE][+-]?\d+)?')
+
+
+def is_float(value: str) -> bool:
+    return float_pattern.fullmatch(value) is not None
+
+
+schema_converters = {'int': int, 'float': float, 'date': to_date, 'str': None}
+
+
+def infer_type(values: list) -> tuple:
+    """
+    return (type_name, note) for the sample values of a column: 'date' when all are
+    yyyymmdd, else 'int', else 'float', else 'str'. empty values are ignored.
+    """
+    values = [v for v in values if v]
+    if not values:
+        return 'str', 'no value in the sample'
+    if all(map(is_yyyymmdd, values)):
+        return 'date', f'{len(values)} yyyymmdd values'
+    not_int = next((v for v in values if not is_int(v)), None)
+    if not_int is None:
+        return 'int', f'{len(values)} int values'
+    not_float = next((v for v in values if not is_float(v)), None)
+    if not_float is None:
+        return 'float', f'{len(values)} values, {not_int!r} is not an int'
+    return 'str', f'{not_float!r} is not a number or date'
+
+
+def get_schema(sample: list, fieldnames: list, Schema='infer') -> list:
+    """
+    return [(field, type_name, note), ...] for the columns. Schema='infer' infers all
+    columns from the sample rows. Schema={'qty': int, 'day': 'date', ...} gives the types
+    of some columns, by type or name; the other columns are inferred. a callable that is
+    not one of int/float/str is used as the converter of its column.
+    """
+    given = {}
+    if isinstance(Schema, dict):
+        for field, t in Schema.items():
+            if field not in fieldnames:
+                raise RuntimeError(f'Schema column {field!r} is not in the header {fieldnames}')
+            if t in (int, float, str):
+                t = t.__name__
+            if isinstance(t, str) and t not in schema_converters:
+                raise RuntimeError(f'unknown type {t!r} for column {field!r}. '
+                                   f'expected one of {list(schema_converters)} or a function')
+            given[field] = t
+    elif Schema != 'infer':
+        raise RuntimeError(f"Schema must be 'infer' or a dict, actual {Schema!r}")
+
+    schema = []
+    for field in fieldnames:
+        if field in given:
+            schema.append((field, given[field], 'given'))
+        else:
+            type_name, note = infer_type([r.get(field, None) for r in sample])
+            schema.append((field, type_name, note))
+    return schema
+
+
+def get_schema_func(schema: list) -> dict:
+    """ return {field: converter} of the columns that are not strings """
+    converters = {}
+    for field, t, _ in schema:
+        convert = schema_converters.get(t, None) if isinstance(t, str) else t
+        if convert is not None:
+            converters[field] = convert
+    return converters
+
+
+def format_schema(schema: list) -> str:
+    width = max([len(field) for field, *_ in schema], default=0)
+    lines = []
+    for field, t, note in schema:
+        name = t if isinstance(t, str) else getattr(t, '__name__', str(t))
+        lines.append(f'{field:<{width}}  {name:<5}  {note}')
+    return '\n'.join(lines)
+
+
+# the key of the original text of the converted columns in a row, see restore_text()
+schema_text_key = '__schema_text__'
+
+
+def convert_dicts(dict_iter, converters: dict, batch_size: int = 4096, **opt):
+    """
+    convert the columns in the rows, in place, a batch of rows at a time. empty values
+    stay ''. a value that does not convert stays a string; the first one of each column is
+    reported on stderr. the original values are kept in row[schema_text_key].
+    """
+    reported = set()
+
+    def convert_each(field, convert, values):
+        for v in values:
+            if not v:
+                yield v
+                continue
+            try:
+                yield convert(v)
+            except (ValueError, TypeError, ArithmeticError):
+                if field not in reported:
+                    reported.add(field)
+                    log_FileFuncLine(f'column {field!r}: cannot convert {v!r}, kept as a string',
+                                     file=sys.stderr)
+                yield v
+
+    rows = iter(dict_iter)
+    while True:
+        batch = list(itertools.islice(rows, batch_size))
+        if not batch:
+            break
+        texts = []
+        for field, convert in converters.items():
+            values = list(map(dict.get, batch, itertools.repeat(field)))
+            texts.append(values)
+            try:
+                # the whole column in one call. an empty or bad value fails it.
+                converted = list(map(convert, values))
+            except (ValueError, TypeError, ArithmeticError):
+                converted = list(convert_each(field, convert, values))
+            # dict.__setitem__ as a map, without a python loop
+            deque(map(operator.setitem, batch, itertools.repeat(field), converted), maxlen=0)
+        deque(map(operator.setitem, batch, itertools.repeat(schema_text_key), zip(*texts)), maxlen=0)
+        yield from batch
+
+
+def restore_text(row: dict, fields: tuple) -> dict:
+    """ put back the original values of the columns converted by convert_dicts() """
+    texts = row.pop(schema_text_key, None)
+    if texts is not None:
+        row.update(zip(fields, texts))
+    return row
+
+
+def get_header_end(filename: str, skip: int = 0, quotechar: bytes = b'"') -> int:
+    """
+    return the byte offset right after the skipped lines and the header record.
+    """
+    with open(filename, 'rb') as fh:
+        for i in range(skip):
+            fh.readline()
+        parity = 0
+        while True:
+            line = fh.readline()
+            if not line:
+                break
+            parity ^= line.count(quotechar) & 1
+            if not parity:
+                # not inside a quoted field, the header record ends here
+                break
+        return fh.tell()
+
+
+def get_next_quote(mm, pos: int, inside: bool, quotechar: bytes, openers: tuple) -> tuple:
+    """
+    find the next quote from pos, given whether pos is inside a quoted field.
+    return (quote position, position after it, inside after it), or (-1, -1, inside) if none.
+    this follows the csv module: a quote only opens a field at the field start, a doubled
+    quote inside a quoted field is a quote char, any other quote there closes the field,
+    and a quote inside an unquoted field is a plain char.
+    """
+    k = mm.find(quotechar, pos)
+    if k < 0:
+        return -1, -1, inside
+    if inside:
+        if mm[k + 1:k + 2] == quotechar:
+            return k, k + 2, True
+        return k, k + 1, False
+    return k, k + 1, k == 0 or mm[k - 1] in openers
+
+
+def get_record_ranges(filename: str,
+                      start: int,
+                      chunk_size: int,
+                      delimiter: bytes = b',',
+                      quotechar: bytes = b'"',
+                      window: int = 1024 * 1024):
+    """
+    cut the file from start to EOF into (start, end) byte ranges of about chunk_size
+    bytes, each ending at a record boundary. end=None means EOF.
+
+    a newline is a record boundary unless it is inside a quoted field. only the bytes
+    near each cut are looked at: from the last quotes before the cut, we follow the quotes
+    twice, once as if we were inside a quoted field and once as if not, until both agree.
+    from there, the first newline outside quotes is the boundary. if they do not agree
+    within 'window' bytes past the cut, eg, a quoted field that never closes, we return
+    None and let the caller read the file serially.
+    """
+    size = os.path.getsize(filename)
+    if size <= start:
+        return [(start, None)]
+
+    openers = (delimiter[0], ord('\n'), ord('\r'))
+
+    ranges = []
+    with open(filename, 'rb') as fh, mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        def get_boundary(pos: int, inside: bool):
+            # the first newline outside quotes from pos, or None at EOF
+            while True:
+                k, after, inside2 = get_next_quote(mm, pos, inside, quotechar, openers)
+                if not inside:
+                    nl = mm.find(b'\n', pos, size if k < 0 else k)
+                    if nl >= 0:
+                        return nl + 1
+                if k < 0:
+                    return None
+                pos, inside = after, inside2
+
+        range_start = start
+        target = start + chunk_size
+        while target < size:
+            q = mm.rfind(quotechar, range_start, target)
+            if q < 0:
+                # no quote since the last boundary, so we are not in a quoted field
+                end = get_boundary(target, False)
+            else:
+                # the state before q is unknown. q may also be the second of a doubled quote,
+                # so start from the first quote of its run, where we are either inside a
+                # quoted field or not. follow both until they agree.
+                while q > range_start and mm[q - 1] == quotechar[0]:
+                    q -= 1
+                a = (q, False)
+                b = (q, True)
+                while a != b:
+                    if min(a[0], b[0]) >= min(size, target + window):
+                        return None
+                    # step the one behind. with no more quotes, it stays as it is till EOF.
+                    if a[0] <= b[0]:
+                        k, after, inside = get_next_quote(mm, a[0], a[1], quotechar, openers)
+                        a = (size if k < 0 else after, inside)
+                    else:
+                        k, after, inside = get_next_quote(mm, b[0], b[1], quotechar, openers)
+                        b = (size if k < 0 else after, inside)
+                pos, inside = a
+                # q was the last quote before target, so the state holds until target
+                end = get_boundary(max(pos, target), inside)
+
+            if end is None:
+                break
+            ranges.append((range_start, end))
+            range_start = end
+            target = end + chunk_size
+
+    if range_start < size or not ranges:
+        ranges.append((range_start, None))
+    else:
+        # the last boundary is EOF. let the last range read to EOF, in case the file grew.
+        ranges[-1] = (ranges[-1][0], None)
+    return ranges
+
+
+def query_csv_range(record_range: tuple, filename: str, fieldnames: list, columns: list, delimiter: str = ',',
+                    **opt) -> tuple:
+    """
+    the work of one QueryCsv(Parallel=N) worker: filter the records in a byte range.
+    columns=None keeps all columns. return (keys, [values, ...]). every row has the same keys, so sending tuples back
+    saves pickling the keys of each row.
+    """
+    keys = None
+    rows = []
+    with TpInput(filename=filename, ranges=[record_range], **opt) as tpi:
+        reader = csv.DictReader(tpi, fieldnames=fieldnames, delimiter=delimiter)
+        for row in filter_dicts(reader, fieldnames, **opt):
+            if keys is None:
+                # the original text of the Schema columns goes back with the row
+                keys = [key for key in row if columns is None or key in columns or key == schema_text_key]
+            rows.append(tuple([row[key] for key in keys]))
+    return keys, rows
+
+
+def get_tuple_func(columns: list):
+    """
+    return a function turning a dict row into a tuple of the columns, '' for a missing one.
+    """
+    if not columns:
+        return lambda row: ()
+    getter = operator.itemgetter(*columns)
+    is_single = len(columns) == 1
+
+    def get_values(row: dict) -> tuple:
+        try:
+            values = getter(row)
+        except KeyError:
+            return tuple(row[c] if c in row else '' for c in columns)
+        return (values,) if is_single else values
+
+    return get_values
+
+
+def get_output_columns(fieldnames: list, **opt) -> list:
+    """
+    the output columns of the csv fieldnames, after SelectFields, ExportExps and GroupBy.
+    """
+    if opt.get('SelectFields'):
+        columns = opt['SelectFields'].split(',')
+    else:
+        columns = fieldnames
+        # https://docs.python.org/3/library/csv.html#csv.DictWriter
+        #     "this attribute is initialized upon first access or when the first record is read from the file."
+        # This is likely by use the __get_attr__() trick when an attribute was missing from the object.
+        # Therefore, when csv.DictWriter calls
+        #     writer = csv.DictWriter(..., fieldnames=columns, ...)
+        # reader.fieldnames will fetch the header line from the input file, and hence the header line will
+        # be gone from the input afterwards. In this case, __iter__() will not yield the header row.
+        # This part puzzled me quite a while because I couldn't figure out why the header line was gone4
+        # and not yield by the __iter__()
+
+        if columns is None:
+            columns = []
+            # this is to avoid this error when the input happened to be empty
+            #   File "/usr/lib/python3.6/csv.py", line 143, in writeheader
+            #     header = dict(zip(self.fieldnames, self.fieldnames))
+            # TypeError: zip argument #1 must support iteration
+    ExportExps = opt.get('ExportExps', None)
+    if ExportExps is not None:
+        # ExportExps could be a dict or a list of key=value strings
+
+        if isinstance(ExportExps, list):
+            # format is kvlist: key=expression.
+            # we need to convert it to dict
+            ExportExps = convert_kvlist_to_dict(ExportExps)
+
+        if isinstance(ExportExps, dict):
+            columns.extend(dict(ExportExps).keys())
+        else:
+            raise RuntimeError(
+                f'ExportExps must be a dict or a list of key=value strings. actual type={type(ExportExps)}, value={pformat(ExportExps)}')
+
+    if opt.get('GroupBy') and not opt.get('SelectFields'):
+        # one row per group
+        columns = get_group_columns(opt['GroupBy'], opt.get('Aggs', None))
+
+    return columns
+
+
 class QueryCsv:
     def __init__(self, filename, delimiter=',', **opt):
         self.verbose = opt.get('verbose', 0)
@@ -136,45 +932,55 @@ class QueryCsv:
         self.delimiter = delimiter
         self.opt = opt
 
+        # Parallel=N filters an uncompressed file in N processes, each working on byte
+        # ranges that end at record boundaries. the rows come back in the file's order.
+        self.Parallel = opt.get('Parallel', None)
+        self.ranges = None  # set by can_split()
+
+        # Engine='numpy' runs the simple MatchExps/ExcludeExps as numpy masks over batches
+        # of rows. see tpsup.columntools. Engine='row' is the default.
+        self.Engine = opt.get('Engine', 'row')
+
+        # Cache=True keeps a binary columnar copy of the csv file in CacheDir, up to CacheMB
+        # in total, see tpsup.csvcachetools. a later query of the unchanged file reads the
+        # copy instead of parsing the text.
+        self.Cache = opt.get('Cache', False)
+
+        # Schema='infer' converts the columns that look like int, float or yyyymmdd dates
+        # in the first SchemaRows rows, so that the expressions compare typed values.
+        # Schema={'qty': int, ...} gives the types of some columns. see get_schema().
+        self.Schema = opt.get('Schema', None)
+        self.SchemaRows = opt.get('SchemaRows', 1000)
+        self.schema = None  # [(field, type, note), ...], when Schema is set
+        self.sample = []  # rows read from stdin to infer the schema
+
     def __enter__(self):
         self.tpi = TpInput(filename=self.filename, need_header=1, **self.opt)
-        self.reader = csv.DictReader(self.tpi.open())
-        if self.opt.get('SelectFields'):
-            self.columns = self.opt['SelectFields'].split(',')
+        self.reader = csv.DictReader(self.tpi.open(), delimiter=self.delimiter)
+        # the csv header. ExportExps adds to self.reader.fieldnames
+        self.header = list(self.reader.fieldnames or [])
+        if self.Schema and self.reader.fieldnames is not None:
+            self.set_schema()
+        self.columns = get_output_columns(self.reader.fieldnames, **self.opt)
+        return self
+
+    def set_schema(self):
+        if self.filename != '-' and os.path.isfile(self.filename):
+            # a separate read of the head of the file, so that every way of reading the
+            # file, eg, Parallel and Cache, sees all rows
+            opt = {k: v for k, v in self.opt.items()
+                   if k not in ['offset', 'tail', 'reverse', 'follow', 'ranges']}
+            with TpInput(filename=self.filename, need_header=1, **opt) as tpi:
+                reader = csv.DictReader(tpi, delimiter=self.delimiter)
+                sample = list(itertools.islice(reader, self.SchemaRows))
         else:
-            self.columns = self.reader.fieldnames
-            # https://docs.python.org/3/library/csv.html#csv.DictWriter
-            #     "this attribute is initialized upon first access or when the first record is read from the file."
-            # This is likely by use the __get_attr__() trick when an attribute was missing from the object.
-            # Therefore, when csv.DictWriter calls
-            #     writer = csv.DictWriter(..., fieldnames=self.columns, ...)
-            # reader.fieldnames will fetch the header line from the input file, and hence the header line will
-            # be gone from the input afterwards. In this case, __iter__() will not yield the header row.
-            # This part puzzled me quite a while because I couldn't figure out why the header line was gone4
-            # and not yield by the __iter__()
-
-            if self.columns is None:
-                self.columns = []
-                # this is to avoid this error when the input happened to be empty
-                #   File "/usr/lib/python3.6/csv.py", line 143, in writeheader
-                #     header = dict(zip(self.fieldnames, self.fieldnames))
-                # TypeError: zip argument #1 must support iteration
-        ExportExps = self.opt.get('ExportExps', None)
-        if ExportExps is not None:
-            # ExportExps could be a dict or a list of key=value strings
-
-            if isinstance(ExportExps, list):
-                # format is kvlist: key=expression.
-                # we need to convert it to dict
-                ExportExps = convert_kvlist_to_dict(ExportExps)
-
-            if isinstance(ExportExps, dict):
-                self.columns.extend(dict(ExportExps).keys())
-            else:
-                raise RuntimeError(
-                    f'ExportExps must be a dict or a list of key=value strings. actual type={type(ExportExps)}, value={pformat(ExportExps)}')
+            # stdin cannot be read twice. get_rows() puts these rows back in front.
+            self.sample = sample = list(itertools.islice(self.reader, self.SchemaRows))
 
-        return self
+        self.schema = get_schema(sample, self.header, self.Schema)
+        self.opt['SchemaFunc'] = get_schema_func(self.schema)
+        if self.verbose:
+            log_FileFuncLine(f'schema from {len(sample)} rows:\n{format_schema(self.schema)}', file=sys.stderr)
 
     def __iter__(self):
         if not self.reader:
@@ -191,10 +997,175 @@ class QueryCsv:
             #          print(row)
             yield from self.iterator()
 
+    def can_split(self) -> bool:
+        if not self.Parallel or self.Parallel <= 1:
+            return False
+        if self.filename == '-' or self.filename.endswith('.gz') or not os.path.isfile(self.filename):
+            return False
+        # these options read the file in their own way
+        for k in ['offset', 'tail', 'reverse', 'follow', 'ranges']:
+            if self.opt.get(k):
+                return False
+        if self.reader.fieldnames is None:
+            # empty file
+            return False
+
+        start = get_header_end(self.filename, skip=self.opt.get('skip', 0))
+        size = os.path.getsize(self.filename)
+        chunk_size = max(1024 * 1024, min(32 * 1024 * 1024, size // (self.Parallel * 4) + 1))
+        self.ranges = get_record_ranges(self.filename, start, chunk_size, delimiter=self.delimiter.encode())
+        if self.ranges is None:
+            if self.verbose:
+                log_FileFuncLine(f'cannot find the record boundaries of {self.filename}. read it serially.',
+                                 file=sys.stderr)
+            return False
+        if self.verbose:
+            log_FileFuncLine(f'{len(self.ranges)} ranges of about {chunk_size} bytes in {self.Parallel} processes',
+                             file=sys.stderr)
+        return True
+
+    def iterator_parallel(self):
+        """ called after can_split() has cut the file into self.ranges """
+        fieldnames = self.reader.fieldnames
+        ranges = self.ranges
+
+        # the workers only filter. grouping and sorting need all rows, so they are done here.
+        opt = {k: v for k, v in self.opt.items()
+               if k not in ['need_header', 'skip', 'Parallel', 'GroupBy', 'SortKeys']}
+        if self.opt.get('GroupBy') or self.opt.get('SortKeys'):
+            columns = None  # keep all columns until grouped
+        else:
+            columns = self.columns
+        func = partial(query_csv_range, filename=self.filename, fieldnames=fieldnames, delimiter=self.delimiter,
+                       columns=columns, **opt)
+
+        with multiprocessing.Pool(processes=self.Parallel) as pool:
+            # a few ranges ahead of the caller, so that a slow consumer does not make the
+            # finished ranges pile up in memory
+            def get_rows(result):
+                keys, rows = result.get()
+                for values in rows:
+                    yield dict(zip(keys, values))
+
+            def get_all_rows():
+                pending = deque()
+                for record_range in ranges:
+                    pending.append(pool.apply_async(func, (record_range,)))
+                    if len(pending) >= self.Parallel * 2:
+                        yield from get_rows(pending.popleft())
+                while pending:
+                    yield from get_rows(pending.popleft())
+
+            if columns is not None:
+                yield from get_all_rows()
+            else:
+                yield from group_and_sort_dicts(get_all_rows(), **self.opt)
+
+    def can_cache(self) -> bool:
+        tpi = self.tpi
+        if self.reader.fieldnames is None or tpi.filename == '-' or not os.path.isfile(tpi.filename):
+            return False
+        # these options read the file in their own way, or drop lines before csv parsing
+        if not tpi.plan.is_empty() or tpi.binary or tpi.reverse or tpi.follow:
+            return False
+        for k in ['offset', 'tail', 'ranges']:
+            if self.opt.get(k):
+                return False
+        return True
+
+    def iterator_cached(self):
+        fieldnames = self.reader.fieldnames
+        cache = tpsup.csvcachetools.open_column_cache(self.filename, **self.opt)
+        if cache is not None and cache.fieldnames != self.header:
+            cache.close()
+            cache = None
+
+        if cache is None:
+            # parse the text, and save the cache if all rows are read. DictReader has read
+            # the header; its csv.reader gives the rest as lists.
+            builder = tpsup.csvcachetools.ColumnCacheBuilder(self.header, CacheMB=self.opt.get('CacheMB', 1024),
+                                                             verbose=self.verbose)
+
+            def get_recorded_rows():
+                for row in self.reader.reader:
+                    if not row:
+                        # like csv.DictReader, skip blank lines
+                        continue
+                    builder.add_row(row)
+                    yield tpsup.columntools.row_to_dict(row, fieldnames)
+                tpsup.csvcachetools.save_column_cache(builder, self.filename, **self.opt)
+
+            rows = filter_dicts(get_recorded_rows(), fieldnames, **self.opt)
+        elif self.Engine == 'numpy' and tpsup.columntools.np is not None and not self.Schema:
+            def filter_func(dict_iter, **opt):
+                return filter_dicts(dict_iter, fieldnames, **{**self.opt, **opt})
+
+            rows = tpsup.columntools.filter_cached_columnar(cache, filter_func, **self.opt)
+        else:
+            rows = filter_dicts(cache.iter_dicts(), fieldnames, **self.opt)
+
+        yield from rows
+
+    def get_rows(self):
+        """ the filtered rows, with all their keys, and the original values of the Schema columns """
+        rows = self.get_typed_rows()
+        SchemaFunc = self.opt.get('SchemaFunc', None)
+        if SchemaFunc:
+            # the typed values are only for the expressions, sorting and grouping
+            rows = map(partial(restore_text, fields=tuple(SchemaFunc)), rows)
+        yield from rows
+
+    def get_typed_rows(self):
+        """ the filtered rows, with all their keys. with Schema, the values are typed """
+        if self.Cache and self.can_cache():
+            yield from self.iterator_cached()
+            return
+
+        if self.can_split():
+            yield from self.iterator_parallel()
+            return
+
+        if self.Engine == 'numpy' and tpsup.columntools.np is None:
+            log_FileFuncLine('numpy is not installed. use the row engine.', file=sys.stderr)
+        elif self.Engine == 'numpy' and self.Schema:
+            # the numpy masks compare the text of the values
+            if self.verbose:
+                log_FileFuncLine('Schema uses the row engine.', file=sys.stderr)
+        elif self.Engine == 'numpy' and self.reader.fieldnames is not None:
+            fieldnames = self.reader.fieldnames
+
+            def filter_func(dict_iter, **opt):
+                return filter_dicts(dict_iter, fieldnames, **{**self.opt, **opt})
+
+            # DictReader has read the header; its csv.reader gives the rest as lists
+            csv_reader = self.reader.reader
+            tpi = self.tpi
+            if tpi.plan.is_empty() and not (tpi.binary or tpi.reverse or tpi.following or tpi.filename == '-'):
+                # no line to filter. parse the file handle directly, without TpInput's
+                # readline() generator in between.
+                csv_reader = csv.reader(tpi.fh, delimiter=self.delimiter)
+            yield from tpsup.columntools.filter_csv_columnar(csv_reader, fieldnames, filter_func, **self.opt)
+            return
+
+        rows = itertools.chain(self.sample, self.reader) if self.sample else self.reader
+        yield from filter_dicts(rows, self.reader.fieldnames, **self.opt)
+
     def iterator(self):
-        for row in filter_dicts(self.reader, self.reader.fieldnames, **self.opt):
+        columns = set(self.columns)
+        for row in self.get_rows():
             # print('__iter__', row)
-            yield {key: value for key, value in row.items() if key in self.columns}
+            yield {key: value for key, value in row.items() if key in columns}
+
+    def iter_tuples(self):
+        """
+        the rows as tuples in the order of self.columns, '' for a missing column. this is
+        what output() writes, without making a dict per row.
+        """
+        if not self.reader:
+            with self:
+                yield from map(get_tuple_func(self.columns), self.get_rows())
+        else:
+            yield from map(get_tuple_func(self.columns), self.get_rows())
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.close()
@@ -242,7 +1213,7 @@ class QueryCsv:
             # print("output() called by a context manager")
             rows = self
             # output_rows()
-            write_dictlist_to_csv(self, self.columns, filename, **opt)
+            write_dictlist_to_csv(self.iter_tuples(), self.columns, filename, **opt)
         else:
             # print("output() not called by a context manager")
             # if self.tpi not initiated, __enter__() must not have been called, then we must not be called by a
@@ -255,10 +1226,257 @@ class QueryCsv:
             #     QueryCsv(...).output(...)
             with self as rows:
                 # output_rows()
-                write_dictlist_to_csv(self, self.columns, filename, **opt)
+                write_dictlist_to_csv(self.iter_tuples(), self.columns, filename, **opt)
+
+
+join_hows = ['inner', 'left', 'anti']
+
+# the options on how a join input is read. they apply to both files.
+join_read_opts = ['delimiter', 'skip', 'binary', 'errors', 'Cache', 'CacheDir', 'CacheMB',
+                  'readahead', 'readahead_block', 'readahead_depth']
+
+# the line patterns only filter the left (input) file, like they do without a join.
+# Parallel reads the left file in processes.
+join_left_opts = ['MatchPatterns', 'ExcludePatterns', 'CaseInsensitive', 'Parallel']
+
+
+def parse_join_on(on) -> list:
+    """
+    on is a list, or a comma-separated string, of 'col' or 'left_col=right_col'.
+    return [(left_col, right_col)].
+    """
+    if isinstance(on, str):
+        on = on.split(',')
+    pairs = []
+    for item in on:
+        if '=' in item:
+            left_col, right_col = item.split('=', 1)
+        else:
+            left_col = right_col = item
+        pairs.append((left_col, right_col))
+    return pairs
+
+
+class JoinCsv:
+    """
+    join two csv files on key columns, then filter the joined rows like QueryCsv does.
+        how='inner': a row per pair of left and right rows with the same key.
+        how='left':  like inner, plus the left rows without a right match, with the right
+                     columns as ''.
+        how='anti':  the left rows without a right match, with the left columns only.
+    the right columns are appended after the left ones, except the right key columns. a
+    right column with the same name as a left one is renamed to right_<name>.
+
+    by default, it is a hash join: the smaller file (by file size) is loaded into a dict,
+    and the larger one is streamed. the output follows the streamed file's order; when
+    the left file is loaded, the unmatched left rows of how='left' come last.
+
+    Sorted=True is a merge join of two files already sorted on the key, as strings, eg,
+    by ptcsv -sort. it keeps only the right rows of the current key in memory and
+    follows the left file's order. a file out of order raises RuntimeError.
+
+    the join_read_opts, eg, delimiter, skip and binary, apply to both files. the
+    join_left_opts, eg, MatchPatterns, only apply to the left file. the other options,
+    eg, MatchExps and SelectFields, apply to the joined rows.
+    """
+
+    def __init__(self, left, right, on, how='inner', Sorted=False, **opt):
+        if how not in join_hows:
+            raise RuntimeError(f'how={how} is not supported. must be one of {join_hows}')
+        self.verbose = opt.get('verbose', 0)
+        self.left = left
+        self.right = right
+        self.on_pairs = parse_join_on(on)
+        self.how = how
+        self.Sorted = Sorted
+        self.opt = opt
+        self.left_qc = None
+        self.right_qc = None
+        self.columns = None  # output columns
+        self.fieldnames = None  # joined columns, before filtering
+
+    def __enter__(self):
+        read_opt = {k: self.opt[k] for k in join_read_opts if k in self.opt}
+        left_opt = {k: self.opt[k] for k in join_left_opts if k in self.opt}
+        self.left_qc = QueryCsv(self.left, verbose=self.verbose, **read_opt, **left_opt).__enter__()
+        self.right_qc = QueryCsv(self.right, verbose=self.verbose, **read_opt).__enter__()
+        left_fields = list(self.left_qc.columns)
+        right_fields = list(self.right_qc.columns)
+
+        for left_col, right_col in self.on_pairs:
+            if left_col not in left_fields:
+                raise RuntimeError(f'join column {left_col} is not in {self.left} header {left_fields}')
+            if right_col not in right_fields:
+                raise RuntimeError(f'join column {right_col} is not in {self.right} header {right_fields}')
+
+        # [(right_col, output_col)]
+        self.right_outputs = []
+        if self.how != 'anti':
+            right_keys = [right_col for left_col, right_col in self.on_pairs]
+            for col in right_fields:
+                if col in right_keys:
+                    continue
+                self.right_outputs.append((col, f'right_{col}' if col in left_fields else col))
+        self.fieldnames = left_fields + [out for col, out in self.right_outputs]
+
+        self.columns = get_output_columns(list(self.fieldnames), **self.opt)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        for qc in [self.left_qc, self.right_qc]:
+            if qc:
+                qc.close()
+        self.left_qc = None
+        self.right_qc = None
+
+    def __iter__(self):
+        if not self.left_qc:
+            with self:
+                yield from self.iterator()
+        else:
+            yield from self.iterator()
+
+    def get_key_funcs(self) -> tuple:
+        def get_key_func(cols: list):
+            def get_key(r: dict) -> tuple:
+                return tuple('' if r.get(c) is None else r[c] for c in cols)
+            return get_key
+
+        return (get_key_func([left_col for left_col, right_col in self.on_pairs]),
+                get_key_func([right_col for left_col, right_col in self.on_pairs]))
+
+    def merge_row(self, left_row: dict, right_row: dict) -> dict:
+        row = dict(left_row)
+        for col, out in self.right_outputs:
+            row[out] = '' if right_row is None else right_row.get(col)
+        return row
+
+    def hash_join(self):
+        get_left_key, get_right_key = self.get_key_funcs()
+        how = self.how
+
+        def get_size(filename: str) -> float:
+            if filename == '-':
+                # stdin can only be streamed
+                return float('inf')
+            return os.path.getsize(filename)
+
+        if get_size(self.left) < get_size(self.right):
+            # load the left rows, stream the right ones
+            if self.verbose:
+                log_FileFuncLine(f'loading {self.left}, streaming {self.right}', file=sys.stderr)
+            left_by_key = {}
+            for r in self.left_qc:
+                left_by_key.setdefault(get_left_key(r), []).append(r)
+            matched_keys = set()
+            for r in self.right_qc:
+                key = get_right_key(r)
+                left_rows = left_by_key.get(key, None)
+                if left_rows is None:
+                    continue
+                matched_keys.add(key)
+                if how != 'anti':
+                    for left_row in left_rows:
+                        yield self.merge_row(left_row, r)
+            if how != 'inner':
+                for key, left_rows in left_by_key.items():
+                    if key in matched_keys:
+                        continue
+                    for left_row in left_rows:
+                        yield left_row if how == 'anti' else self.merge_row(left_row, None)
+        else:
+            # load the right rows, stream the left ones
+            if self.verbose:
+                log_FileFuncLine(f'loading {self.right}, streaming {self.left}', file=sys.stderr)
+            right_by_key = {}
+            if how == 'anti':
+                # only the keys are needed
+                for r in self.right_qc:
+                    right_by_key[get_right_key(r)] = True
+            else:
+                # only the output columns are kept
+                right_cols = [col for col, out in self.right_outputs]
+                for r in self.right_qc:
+                    right_by_key.setdefault(get_right_key(r), []).append({c: r.get(c) for c in right_cols})
+            for r in self.left_qc:
+                right_rows = right_by_key.get(get_left_key(r), None)
+                if how == 'anti':
+                    if right_rows is None:
+                        yield r
+                elif right_rows is None:
+                    if how == 'left':
+                        yield self.merge_row(r, None)
+                else:
+                    for right_row in right_rows:
+                        yield self.merge_row(r, right_row)
+
+    def merge_join(self):
+        get_left_key, get_right_key = self.get_key_funcs()
+        how = self.how
+
+        def get_right_groups():
+            last_key = None
+            for key, rows in itertools.groupby(self.right_qc, key=get_right_key):
+                if last_key is not None and key <= last_key:
+                    raise RuntimeError(f'{self.right} is not sorted on the join key: {key} after {last_key}')
+                last_key = key
+                yield key, list(rows)
+
+        right_groups = get_right_groups()
+        right_key, right_rows = next(right_groups, (None, None))
+        last_key = None
+        for r in self.left_qc:
+            key = get_left_key(r)
+            if last_key is not None and key < last_key:
+                raise RuntimeError(f'{self.left} is not sorted on the join key: {key} after {last_key}')
+            last_key = key
+
+            while right_key is not None and right_key < key:
+                right_key, right_rows = next(right_groups, (None, None))
+
+            if right_key == key:
+                if how != 'anti':
+                    for right_row in right_rows:
+                        yield self.merge_row(r, right_row)
+            elif how == 'anti':
+                yield r
+            elif how == 'left':
+                yield self.merge_row(r, None)
+
+    def get_rows(self):
+        joined = self.merge_join() if self.Sorted else self.hash_join()
+        yield from filter_dicts(joined, self.fieldnames, **self.opt)
+
+    def iterator(self):
+        columns = set(self.columns)
+        for row in self.get_rows():
+            yield {key: value for key, value in row.items() if key in columns}
+
+    def output(self, filename, **opt):
+        if self.left_qc:
+            write_dictlist_to_csv(map(get_tuple_func(self.columns), self.get_rows()), self.columns, filename, **opt)
+        else:
+            with self:
+                write_dictlist_to_csv(map(get_tuple_func(self.columns), self.get_rows()), self.columns, filename,
+                                      **opt)
+
+
+def join_csv(left, right, on, how='inner', **opt):
+    """
+    yield the joined rows of two csv files. see JoinCsv.
+    """
+    with JoinCsv(left, right, on, how=how, **opt) as jc:
+        yield from jc
 
 
 def write_dictlist_to_csv(dict_iter, columns, filename, **opt):
+    """
+    write the rows as csv. the rows are all dicts, or all tuples/lists in the order of
+    columns. a dict's missing column is written as ''. the tuples are written as they are.
+    """
     ofh = None
 
     # we have to declare ofh here, otherwise ofh is only defined in a function within a function, therefore
@@ -283,23 +1501,32 @@ def write_dictlist_to_csv(dict_iter, columns, filename, **opt):
         # >>> isinstance(sys.stdout, io.TextIOBase)
         # True
 
-        writer = csv.DictWriter(ofh, fieldnames=columns,
-                                delimiter=delimiter, lineterminator=os.linesep)
+        # the rows are written to a buffer, then to ofh a batch at a time: csv.writer calls
+        # write() once per row, and each call through TextIOWrapper or gzip has its cost.
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, delimiter=delimiter, lineterminator=os.linesep)
+        write = ofh.write
         if ofh is sys.stdout:
-            writer.writeheader = silence_BrokenPipeError(writer.writeheader)
-            writer.writerow = silence_BrokenPipeError(writer.writerow)
+            write = silence_BrokenPipeError(write)
         if not opt.get('PrintNoHeader'):
-            writer.writeheader()
+            writer.writerow(columns)
+            write(buffer.getvalue())
         # rows is in this python's closure
-        for row in dict_iter:
-            # print('debug2', row)
-            new_row = {}
-            for key in columns:
-                if key in row:
-                    new_row[key] = str(row[key])
-                else:
-                    new_row[key] = ""
-            writer.writerow(new_row)
+        get_values = get_tuple_func(columns)
+        batch_size = opt.get('WriteBatchSize', 8192)
+        rows = iter(dict_iter)
+        while batch := list(itertools.islice(rows, batch_size)):
+            # print('debug2', batch[0])
+            if isinstance(batch[0], dict):
+                batch = list(map(get_values, batch))
+            if any(map(operator.contains, batch, itertools.repeat(None))):
+                # csv.writer writes None as ''. we have always written str(None).
+                batch = [tuple('None' if v is None else v for v in values) if None in values else values
+                         for values in batch]
+            buffer.seek(0)
+            buffer.truncate()
+            writer.writerows(batch)
+            write(buffer.getvalue())
 
     if isinstance(filename, io.IOBase):
         if isinstance(filename, io.TextIOBase):
@@ -396,6 +1623,66 @@ def main():
         write_dictlist_to_csv(qc, qc.columns, ofh)
     os.system(f"gunzip -c {output_file_gz}")
 
+    print(f'\ntest10\n')
+    with QueryCsv(filename=file,
+                  MatchExps=["r['name'].startswith('S')"],
+                  Parallel=2,
+                  verbose=verbose) as qc:
+        qc.output(filename='-')
+
+    print(f'\ntest11\n')
+    with QueryCsv(filename=file,
+                  MatchExps=["int(r['number']) > 2 and r['name'] != 'Stephen'"],
+                  Engine='numpy',
+                  verbose=verbose) as qc:
+        qc.output(filename='-')
+
+    print(f'\ntest12\n')
+    with QueryCsv(filename=file,
+                  SortKeys=['number:num'],
+                  SortReverse=True,
+                  verbose=verbose) as qc:
+        qc.output(filename='-')
+
+    with QueryCsv(filename=file,
+                  GroupBy=['name'],
+                  Aggs=['count', 'sum:number'],
+                  verbose=verbose) as qc:
+        qc.output(filename='-')
+
+    print(f'\ntest13\n')
+    with JoinCsv(file, file, on='alpha', how='inner', Sorted=True,
+                 MatchExps=["int(r['number']) < 3"],
+                 SelectFields='alpha,name,right_number',
+                 verbose=verbose) as jc:
+        jc.output(filename='-')
+
+    print(f'\ntest14\n')
+    import tpsup.tmptools
+    cache_dir = f'{tpsup.tmptools.get_dailydir()}/csvcache'
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    # the first query saves the cache, the second one reads it
+    for i in range(2):
+        with QueryCsv(filename=file,
+                      MatchExps=["int(r['number']) > 6"],
+                      Cache=True,
+                      CacheDir=cache_dir,
+                      verbose=verbose) as qc:
+            qc.output(filename='-')
+
+    print(f'\ntest15\n')
+    # tuple rows are written as they are
+    write_dictlist_to_csv([('x', 1, 2.5), ('y', None, 'a,b')], ['c1', 'c2', 'c3'], sys.stdout)
+
+    print(f'\ntest16\n')
+    # typed values: number is inferred as int, so the expression needs no int()
+    with QueryCsv(filename=file,
+                  Schema='infer',
+                  MatchExps=["r['number'] > 6"],
+                  verbose=verbose) as qc:
+        print(format_schema(qc.schema))
+        qc.output(filename='-')
+
 
 if __name__ == '__main__':
     main()
@@ -1,3 +1,4 @@
+import datetime
 import gzip
 import re
 import os
@@ -17,10 +17,12 @@
 # OK
 
 import unittest
+import csv
 import io
 import os
 import sys
 import pprint
+import tempfile
 import time
 
 import tpsup.csvtools
@@ -41,6 +43,19 @@ class TestCsvTools(unittest.TestCase):
 
         self.assertEqual(s.getvalue(), expected_string)
 
+    def test_patterns_binary(self, verbose=0):
+        _dir = os.path.dirname(sys.modules["tpsup.csvtools"].__file__)
+        file = os.path.join(_dir, "csvtools_test.csv")
+        s = io.StringIO()
+        with tpsup.csvtools.QueryCsv(file, MatchPatterns=[',S'], ExcludePatterns=['Smith'], binary=True,
+                                     verbose=verbose) as qc:
+            for row in qc:
+                print(f'{row}', file=s, end='')
+
+        expected_string = "{'alpha': 'd', 'number': '3', 'name': 'Stephen'}"
+
+        self.assertEqual(s.getvalue(), expected_string)
+
     def test_expressions(self, verbose=0):
         # https://docs.python.org/3/library/pkgutil.html
         # pprint.pprint(sys.modules)
@@ -65,6 +80,97 @@ class TestCsvTools(unittest.TestCase):
 
         self.assertEqual(s.getvalue(), expected_string)
 
+    def write_quoted_csv(self, dir: str, stray: bool) -> str:
+        # quoted fields with newlines, delimiters and doubled quotes. stray=True adds a
+        # quote inside an unquoted field, which the csv module reads as a plain char.
+        file = os.path.join(dir, f'quoted_{int(stray)}.csv')
+        with open(file, 'w', newline='') as fh:
+            fh.write('id,desc,qty\n')
+            for i in range(60000):
+                if stray and i == 100:
+                    fh.write(f'{i},12" ruler,1\n')
+                elif i % 97 == 0:
+                    fh.write(f'{i},"multi\nline, ""quoted""\nfield",{i % 7}\n')
+                else:
+                    fh.write(f'{i},plain {i},{i % 7}\n')
+        return file
+
+    def test_parallel_quoted(self, verbose=0):
+        with tempfile.TemporaryDirectory() as dir:
+            for stray in [False, True]:
+                file = self.write_quoted_csv(dir, stray)
+                serial = list(tpsup.csvtools.QueryCsv(file, verbose=verbose))
+                self.assertEqual(len(serial), 60000)
+                parallel = list(tpsup.csvtools.QueryCsv(file, Parallel=2, verbose=verbose))
+                self.assertEqual(parallel, serial)
+
+                start = tpsup.csvtools.get_header_end(file)
+                ranges = tpsup.csvtools.get_record_ranges(file, start, 1000)
+                # every range ends at a record boundary
+                self.assertGreater(len(ranges), 1)
+                with open(file, 'rb') as fh:
+                    data = fh.read()
+                self.assertEqual(b''.join(data[s:e] for s, e in ranges), data[start:])
+                rows = []
+                for s, e in ranges:
+                    rows.extend(csv.reader(io.StringIO(data[s:e].decode(), newline='')))
+                self.assertEqual(rows, list(csv.reader(io.StringIO(data[start:].decode(), newline=''))))
+
+            # a quoted field that never closes: we cannot tell where the records are
+            file = os.path.join(dir, 'unclosed.csv')
+            with open(file, 'w') as fh:
+                fh.write('id,desc\n0,"open\n' + '1,plain\n' * 1000)
+            self.assertIsNone(tpsup.csvtools.get_record_ranges(file, tpsup.csvtools.get_header_end(file), 1000))
+            self.assertEqual(list(tpsup.csvtools.QueryCsv(file, Parallel=2, verbose=verbose)),
+                             list(tpsup.csvtools.QueryCsv(file, verbose=verbose)))
+
+    def test_schema_sort_group(self, verbose=0):
+        # the empty and unconverted cells stay strings in the typed columns
+        with tempfile.TemporaryDirectory() as dir:
+            file = os.path.join(dir, 'typed.csv')
+            with open(file, 'w') as fh:
+                fh.write('name,qty,day\na,5,20240105\nb,,\nc,3,20240103\nd,x,20240103\ne,7,20240101\n')
+
+            rows = list(tpsup.csvtools.QueryCsv(file, Schema={'qty': int}, SortKeys=['qty'], verbose=verbose))
+            self.assertEqual([r['name'] for r in rows], ['b', 'd', 'c', 'a', 'e'])
+
+            # the typed values are only for evaluation. the rows keep the original text.
+            rows = list(tpsup.csvtools.QueryCsv(file, Schema={'qty': float},
+                                                MatchExps=["isinstance(r['qty'], float) and r['qty'] > 4"],
+                                                verbose=verbose))
+            self.assertEqual([r['qty'] for r in rows], ['5', '7'])
+
+            rows = list(tpsup.csvtools.QueryCsv(file, Schema='infer', GroupBy=['day'], Aggs=['n=count'],
+                                                verbose=verbose))
+            self.assertEqual([(str(r['day']), r['n']) for r in rows],
+                             [('', 1), ('20240101', 1), ('20240103', 2), ('20240105', 1)])
+
+    def test_join_read_opts(self, verbose=0):
+        # the read options apply to both files, the line patterns only to the left one
+        with tempfile.TemporaryDirectory() as dir:
+            left = os.path.join(dir, 'left.psv')
+            right = os.path.join(dir, 'right.psv')
+            with open(left, 'w') as fh:
+                fh.write('id|sym\n1|IBM\n2|AAPL\n3|MSFT\n')
+            with open(right, 'w') as fh:
+                fh.write('id|px\n1|10\n3|30\n')
+
+            rows = list(tpsup.csvtools.join_csv(left, right, 'id', delimiter='|', verbose=verbose))
+            self.assertEqual(rows, [{'id': '1', 'sym': 'IBM', 'px': '10'},
+                                    {'id': '3', 'sym': 'MSFT', 'px': '30'}])
+
+            # both files have a line before the header
+            skipped = os.path.join(dir, 'skipped.psv')
+            with open(skipped, 'w') as fh:
+                fh.write('junk line\nid|px\n1|10\n3|30\n')
+            rows = list(tpsup.csvtools.join_csv(skipped, skipped, 'id', delimiter='|', skip=1, verbose=verbose))
+            self.assertEqual(rows, [{'id': '1', 'px': '10', 'right_px': '10'},
+                                    {'id': '3', 'px': '30', 'right_px': '30'}])
+
+            rows = list(tpsup.csvtools.join_csv(left, right, 'id', how='left', delimiter='|',
+                                                MatchPatterns=['AAPL|MSFT'], verbose=verbose))
+            self.assertEqual([(r['sym'], r['px']) for r in rows], [('AAPL', ''), ('MSFT', '30')])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,17 +1,45 @@
+import array
+import ast
+from collections import deque
+import csv
+import concurrent.futures
+import ctypes
+import ctypes.util
 from glob import glob
 import gzip
+import io
+import json
 import os
+import queue
 import re
+import select
 import stat
 import sys
+import threading
 from pprint import pformat, pprint
 import time
 import types
+import zlib
 from typing import Union
-from tpsup.modtools import compile_codelist, strings_to_compilable_patterns, load_module
+from tpsup.modtools import compile_codelist
+from tpsup.patterntools import get_match_plan
 from tpsup.logbasic import log_FileFuncLine
 from tpsup.utilbasic import silence_BrokenPipeError
 
+try:
+    # zran-style seek points for gzip files
+    # pip install indexed_gzip
+    import indexed_gzip
+except ImportError:
+    indexed_gzip = None
+
+# max lines kept when reading an unseekable input (stdin, .gz without gzindex) in reverse
+default_reverse_buffer = 100000
+
+# a directory changed this close to its listing may change again within the same mtime
+# tick, eg, 2s on FAT, without a new mtime. such a listing is never reused.
+listing_granularity_ns = 2 * 10 ** 9
+
 
 class TpInput:
     def __init__(self, filename, **opt):
@@ -21,28 +49,127 @@ class TpInput:
         self.need_close_fh = False
         self.fh = None
 
-        source_list = ['import re']
-
-        for attr in ['MatchPatterns', 'ExcludePatterns']:
-            # need to convert pattern string into bytes-like object as we read the csv as binary data
-            strings = opt.get(attr, [])
-            source_list.append(strings_to_compilable_patterns(strings, attr))
-
-        source = '\n\n'.join(source_list)
+        # binary mode reads raw lines and matches them with bytes patterns.
+        # only the lines that pass the patterns are decoded, using the 'errors' policy,
+        # so a bad byte only affects its own line, not the rest of the file.
+        self.binary = opt.get('binary', False)
+        self.errors = opt.get('errors', 'replace' if self.binary else 'strict')
+        # newline='' keeps '\r\n' as it is, which the csv module needs. newline=None
+        # translates it to '\n', like open(). only for the text file handles.
+        self.newline = opt.get('newline', '')
+
+        # the plan checks cheap literal substrings before running the regex engine.
+        # it is shared, so building the same TpInput for many files, eg, tpfind's getline(),
+        # only compiles the patterns once.
+        self.plan = get_match_plan(opt.get('MatchPatterns', None),
+                                   opt.get('ExcludePatterns', None),
+                                   CaseInsensitive=opt.get('CaseInsensitive', False),
+                                   binary=self.binary)
 
         if self.verbose >= 2:
-            sys.stderr.write(f'source code = \n{source}\n')
-
-        pattern_filter = load_module(source)
-
-        self.match_patterns = pattern_filter.MatchPatterns
-        self.exclude_patterns = pattern_filter.ExcludePatterns
+            sys.stderr.write(f'match_items = {self.plan.match_items}\n')
+            sys.stderr.write(f'exclude_literals = {self.plan.exclude_literals}\n')
+            sys.stderr.write(f'exclude_items = {self.plan.exclude_items}\n')
 
         self.skip = opt.get('skip', 0)
 
+        # start reading at an uncompressed byte offset, or only read the last 'tail' bytes.
+        # reading starts at the next full line. both work on .gz files; with gzindex=True,
+        # a sidecar index lets us jump there instead of decompressing from byte 0.
+        self.offset = opt.get('offset', 0)
+        self.tail = opt.get('tail', None)
+        self.gzindex = opt.get('gzindex', False)
+        self.gzindex_spacing = opt.get('gzindex_spacing', 1)  # MB between seek points
+        self.gzindex_to_save = False
+
+        # read-ahead: a background thread decompresses .gz blocks into a bounded queue,
+        # while this thread splits and matches lines. zlib releases the GIL, so the two overlap.
+        self.readahead = opt.get('readahead', False)
+        self.readahead_block = opt.get('readahead_block', 4)  # MB of uncompressed data per block
+        self.readahead_depth = opt.get('readahead_depth', 4)  # max number of blocks in the queue
+
+        # reverse: yield lines newest-first. a seekable file (plain, or .gz with gzindex) is
+        # read in blocks backward from EOF. other inputs are scanned forward, keeping the
+        # last 'reverse_buffer' matched lines in a deque, default_reverse_buffer if not set.
+        self.reverse = opt.get('reverse', False)
+        self.reverse_block = opt.get('reverse_block', 1024 * 1024)  # bytes per backward read
+        self.reverse_buffer = opt.get('reverse_buffer', None)
+        self.reverse_seekable = False
+
+        # follow: like 'tail -f', keep yielding lines as the file grows. a rotated file (new
+        # inode) is reopened from its start, a truncated file is read again from its start.
+        # we wait with inotify where available, otherwise poll with a backoff from
+        # follow_interval to follow_max_interval seconds. follow_idle=N stops after N
+        # seconds without a new line. only plain files can be followed.
+        self.follow = opt.get('follow', False)
+        self.follow_interval = opt.get('follow_interval', 0.1)
+        self.follow_max_interval = opt.get('follow_max_interval', 2.0)
+        self.follow_idle = opt.get('follow_idle', None)
+        self.following = False
+
+        # ranges: only read these (start, end) byte ranges of a plain file, end=None for EOF.
+        # each range must start at a line start, eg, the blocks from TrigramIndex.
+        self.ranges = opt.get('ranges', None)
+
     def open(self):
         if self.filename == '-':
-            self.fh = sys.stdin
+            self.fh = sys.stdin.buffer if self.binary or self.reverse else sys.stdin
+        elif self.follow and not self.filename.endswith('.gz'):
+            # binary, so that a half-written last line can be kept until it is complete
+            self.need_close_fh = True
+            self.following = True
+            if self.offset or self.tail is not None:
+                self.fh = self.open_seekable()
+            else:
+                self.fh = open(self.filename, 'rb')
+        elif self.reverse:
+            self.need_close_fh = True
+            self.fh = None
+            if self.filename.endswith('.gz'):
+                if self.gzindex:
+                    self.fh = open_gzindex(self, self.filename, spacing=self.gzindex_spacing,
+                                           verbose=self.verbose)
+                    if self.fh:
+                        self.fh.build_full_index()
+                        self.reverse_seekable = True
+                if self.fh is None:
+                    self.fh = gzip.open(self.filename, 'rb')
+            else:
+                self.fh = open(self.filename, 'rb')
+                self.reverse_seekable = True
+            # skip only applies to reading forward
+            return self
+        elif self.ranges is not None and not self.filename.endswith('.gz'):
+            self.need_close_fh = True
+            raw = io.BufferedReader(RangeReader(self.filename, self.ranges))
+            if self.binary:
+                self.fh = raw
+            else:
+                self.fh = io.TextIOWrapper(raw, encoding='utf-8', errors=self.errors, newline=self.newline)
+        elif self.offset or self.tail is not None or (self.gzindex and self.filename.endswith('.gz')):
+            self.need_close_fh = True
+            raw = self.open_seekable()
+            if self.binary:
+                self.fh = raw
+            else:
+                self.fh = io.TextIOWrapper(raw, encoding='utf-8', errors=self.errors, newline=self.newline)
+        elif self.readahead and self.filename.endswith('.gz'):
+            self.need_close_fh = True
+            block_size = int(self.readahead_block * 1024 * 1024)
+            raw = io.BufferedReader(ReadAheadGzip(self.filename,
+                                                  block_size=block_size,
+                                                  depth=self.readahead_depth),
+                                    buffer_size=block_size)
+            if self.binary:
+                self.fh = raw
+            else:
+                self.fh = io.TextIOWrapper(raw, encoding='utf-8', errors=self.errors, newline=self.newline)
+        elif self.binary:
+            self.need_close_fh = True
+            if self.filename.endswith('.gz'):
+                self.fh = gzip.open(self.filename, 'rb')
+            else:
+                self.fh = open(self.filename, 'rb')
         else:
             self.need_close_fh = True
             # the unicode-sandwich design pattern
@@ -60,10 +187,10 @@ class TpInput:
                 #         raise ValueError("Argument 'newline' not supported in binary mode")
 
                 self.fh = gzip.open(self.filename, 'rt',
-                                    encoding='utf-8', newline='')
+                                    encoding='utf-8', errors=self.errors, newline=self.newline)
             else:
                 self.fh = open(self.filename, 'r',
-                               encoding='utf-8', newline='')
+                               encoding='utf-8', errors=self.errors, newline=self.newline)
 
         for count in range(0, self.skip):
             try:
@@ -73,7 +200,20 @@ class TpInput:
         return self
 
     def readline(self):
+        if self.following:
+            yield from self.readline_follow()
+            return
+
+        if self.reverse:
+            yield from self.readline_reverse()
+            return
+
+        if self.binary:
+            yield from self.readline_binary()
+            return
+
         line_number = 0
+        matches = None if self.plan.is_empty() else self.plan.matches
 
         # UnicodeDecodeError: 'utf-8' codec can't decode byte 0xc1 in position 24:
         #     invalid start byte
@@ -86,23 +226,7 @@ class TpInput:
                     yield line
                     continue
 
-                matched = 1
-                for compiled in self.match_patterns:
-                    # if not compiled.match(line):
-                    if not compiled.search(line):
-                        matched = 0
-                        break
-
-                if not matched:
-                    continue
-
-                excluded = 0
-
-                for compiled in self.exclude_patterns:
-                    if compiled.search(line):
-                        excluded = 1
-                        break
-                if excluded:
+                if matches and not matches(line):
                     continue
 
                 # print(f'iamhere {line}')
@@ -112,8 +236,274 @@ class TpInput:
             return
         return
 
+    def readline_binary(self):
+        line_number = 0
+        errors = self.errors
+        matches = None if self.plan.is_empty() else self.plan.matches
+
+        for line in self.fh:
+            line_number += 1
+
+            if line_number == 1 and self.need_header:
+                # csv module needs the header line
+                yield line.decode('utf-8', errors=errors)
+                continue
+
+            if matches and not matches(line):
+                continue
+
+            # only decode the lines that we keep
+            try:
+                yield line.decode('utf-8', errors=errors)
+            except UnicodeDecodeError as e:
+                # only possible when errors='strict'. skip this line only.
+                print(f'{e} in {self.filename} line {line_number}. skipped.', file=sys.stderr)
+
+    def readline_reverse(self):
+        if not self.reverse_seekable:
+            # cannot seek backward, eg, stdin or plain .gz. scan forward and keep the tail.
+            if self.verbose:
+                log_FileFuncLine(f'cannot read {self.filename} backward, scan it forward', file=sys.stderr)
+            yield from self.read_forward_tail()
+            return
+
+        errors = self.errors
+        matches = None
+        if not self.binary and not self.plan.is_empty():
+            # in binary mode, the plan was already applied on raw bytes
+            matches = self.plan.matches
+        for line in self.read_backward():
+            try:
+                line = line.decode('utf-8', errors=errors)
+            except UnicodeDecodeError as e:
+                print(f'{e} in {self.filename}. skipped a line.', file=sys.stderr)
+                continue
+            if matches and not matches(line):
+                continue
+            yield line
+
+    def read_backward(self):
+        """
+        yield raw lines from EOF backward, reading reverse_block bytes at a time.
+        in binary mode, the plan is applied here, on raw bytes.
+        """
+        fh = self.fh
+        matches = None
+        if self.binary and not self.plan.is_empty():
+            matches = self.plan.matches
+
+        pos = fh.seek(0, io.SEEK_END)
+        buf = b''
+        while pos > 0:
+            read_size = min(self.reverse_block, pos)
+            pos -= read_size
+            fh.seek(pos)
+            # buf is the not-yet-yielded beginning of the following block
+            buf = fh.read(read_size) + buf
+
+            end = len(buf)
+            while True:
+                # the newline before the last line. the last line's own newline is not a separator.
+                i = buf.rfind(b'\n', 0, end - 1)
+                if i < 0:
+                    break
+                line = buf[i + 1:end]
+                end = i + 1
+                if matches and not matches(line):
+                    continue
+                yield line
+            buf = buf[:end]
+
+        if buf and not (matches and not matches(buf)):
+            yield buf
+
+    def read_forward_tail(self):
+        """
+        scan lines forward, keep the last reverse_buffer matched lines, yield them newest-first.
+        in binary mode, raw lines are matched and only the kept ones are decoded.
+        otherwise, each line is decoded once and the decoded line is matched and kept.
+        """
+        errors = self.errors
+        matches = None if self.plan.is_empty() else self.plan.matches
+        binary = self.binary
+
+        maxlen = self.reverse_buffer
+        if maxlen is None:
+            maxlen = default_reverse_buffer
+        kept = deque(maxlen=maxlen)
+        dropped = 0
+        for line in self.fh:
+            if not binary:
+                try:
+                    line = line.decode('utf-8', errors=errors)
+                except UnicodeDecodeError as e:
+                    print(f'{e} in {self.filename}. skipped a line.', file=sys.stderr)
+                    continue
+            if matches and not matches(line):
+                continue
+            if len(kept) == maxlen:
+                dropped += 1
+            kept.append(line)
+
+        if dropped and self.reverse_buffer is None:
+            log_FileFuncLine(f'only kept the last {maxlen} lines of {self.filename}, dropped {dropped}. '
+                             f'set reverse_buffer, or use gzindex to read it backward', file=sys.stderr)
+
+        while kept:
+            line = kept.pop()
+            if binary:
+                try:
+                    line = line.decode('utf-8', errors=errors)
+                except UnicodeDecodeError as e:
+                    print(f'{e} in {self.filename}. skipped a line.', file=sys.stderr)
+                    continue
+            yield line
+
+    def readline_follow(self):
+        errors = self.errors
+        matches = None if self.plan.is_empty() else self.plan.matches
+        binary = self.binary
+
+        def keep(line: bytes):
+            # in binary mode, match raw bytes before decoding. otherwise decode first.
+            if binary and matches and not matches(line):
+                return None
+            try:
+                line = line.decode('utf-8', errors=errors)
+            except UnicodeDecodeError as e:
+                print(f'{e} in {self.filename}. skipped a line.', file=sys.stderr)
+                return None
+            if not binary and matches and not matches(line):
+                return None
+            return line
+
+        waiter = FileWaiter(self.filename,
+                            min_interval=self.follow_interval,
+                            max_interval=self.follow_max_interval,
+                            verbose=self.verbose)
+        partial = b''
+        last_line_time = time.time()
+        try:
+            while True:
+                line = self.fh.readline()
+                if line:
+                    if not line.endswith(b'\n'):
+                        # the writer has not finished this line yet
+                        partial += line
+                        continue
+                    if partial:
+                        line = partial + line
+                        partial = b''
+                    last_line_time = time.time()
+                    waiter.reset()
+                    line = keep(line)
+                    if line is not None:
+                        yield line
+                    continue
+
+                # at EOF
+                old_fh = self.fh
+                if self.reopen_if_rotated():
+                    if old_fh is not self.fh:
+                        # the writer may have added to the old file after we reached its end
+                        lines = old_fh.readlines()
+                        old_fh.close()
+                        if partial:
+                            lines.insert(0, partial + (lines.pop(0) if lines else b''))
+                            partial = b''
+                        for line in lines:
+                            line = keep(line)
+                            if line is not None:
+                                yield line
+                        waiter.watch()
+                    else:
+                        # truncated. the partial line will never be completed.
+                        partial = b''
+                    continue
+
+                if self.follow_idle is not None and time.time() - last_line_time >= self.follow_idle:
+                    if partial:
+                        line = keep(partial)
+                        if line is not None:
+                            yield line
+                    return
+
+                waiter.wait()
+        finally:
+            waiter.close()
+
+    def reopen_if_rotated(self) -> bool:
+        """
+        check the file at EOF. return True if it was rotated (self.fh is then the new file)
+        or truncated (self.fh is then at its start).
+        """
+        try:
+            st = os.stat(self.filename)
+        except FileNotFoundError:
+            # rotated away and the new file is not created yet
+            return False
+
+        fst = os.fstat(self.fh.fileno())
+        if (st.st_ino, st.st_dev) != (fst.st_ino, fst.st_dev):
+            if self.verbose:
+                log_FileFuncLine(f'{self.filename} was rotated, reopen it', file=sys.stderr)
+            self.fh = open(self.filename, 'rb')
+            return True
+
+        if st.st_size < self.fh.tell():
+            if self.verbose:
+                log_FileFuncLine(f'{self.filename} was truncated, read it from start', file=sys.stderr)
+            self.fh.seek(0)
+            return True
+
+        return False
+
+    def open_seekable(self):
+        """
+        open the file in binary mode, positioned at the first full line at or after
+        the requested offset or tail.
+        """
+        if self.filename.endswith('.gz'):
+            fh = None
+            if self.gzindex:
+                fh = open_gzindex(self, self.filename, spacing=self.gzindex_spacing, verbose=self.verbose)
+            if fh is None:
+                # plain gzip can only seek forward by decompressing from byte 0
+                fh = gzip.open(self.filename, 'rb')
+        else:
+            fh = open(self.filename, 'rb')
+
+        start = self.offset
+        if self.tail is not None:
+            if hasattr(fh, 'build_full_index'):
+                # indexed_gzip can only seek from the end with a complete index
+                fh.build_full_index()
+            try:
+                size = fh.seek(0, io.SEEK_END)
+            except (OSError, ValueError):
+                # gzip module cannot seek from the end. count the uncompressed size.
+                if self.verbose:
+                    log_FileFuncLine(f'decompressing {self.filename} to find its size', file=sys.stderr)
+                fh.seek(0)
+                size = 0
+                while chunk := fh.read(1024 * 1024):
+                    size += len(chunk)
+            start = max(size - self.tail, start)
+
+        if start > 0:
+            fh.seek(start - 1)
+            if fh.read(1) != b'\n':
+                # we landed in the middle of a line. skip the rest of it.
+                fh.readline()
+        else:
+            fh.seek(0)
+        return fh
+
     def close(self):
         if self.need_close_fh:
+            if self.gzindex_to_save:
+                save_gzindex(self.fh, self.filename, spacing=self.gzindex_spacing, verbose=self.verbose)
+                self.gzindex_to_save = False
             self.fh.close()
         self.fh = None
         self.need_close_fh = False
@@ -131,6 +521,323 @@ class TpInput:
         self.close()
 
 
+class ReadAheadGzip(io.RawIOBase):
+    """
+    a raw reader of a .gz file, decompressed by a background thread.
+    the thread puts blocks of at most block_size uncompressed bytes into a queue of
+    at most 'depth' blocks, so memory stays bounded when the consumer is slower.
+    wrap it with io.BufferedReader (and io.TextIOWrapper) to read lines.
+    """
+
+    def __init__(self, filename: str, block_size: int = 4 * 1024 * 1024, depth: int = 4):
+        super().__init__()
+        self.filename = filename
+        self.block_size = block_size
+        self.queue = queue.Queue(maxsize=depth)
+        self.stop_event = threading.Event()
+        self.block = memoryview(b'')
+        self.pos = 0
+        self.eof = False
+        self.thread = threading.Thread(target=self.decompress, daemon=True)
+        self.thread.start()
+
+    def put(self, item) -> bool:
+        # don't block forever if the consumer has gone away
+        while not self.stop_event.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def decompress(self):
+        try:
+            with open(self.filename, 'rb') as f:
+                # wbits=31: gzip header and trailer
+                d = zlib.decompressobj(wbits=31)
+                while not self.stop_event.is_set():
+                    data = f.read(self.block_size)
+                    if not data:
+                        break
+                    while data:
+                        out = d.decompress(data, self.block_size)
+                        if out and not self.put(out):
+                            return
+                        if d.eof:
+                            # a .gz file can have multiple members
+                            data = d.unused_data
+                            d = zlib.decompressobj(wbits=31)
+                        else:
+                            data = d.unconsumed_tail
+            self.put(None)
+        except Exception as e:
+            self.put(e)
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        while self.pos >= len(self.block):
+            if self.eof:
+                return 0
+            item = self.queue.get()
+            if item is None:
+                self.eof = True
+                return 0
+            if isinstance(item, Exception):
+                self.eof = True
+                raise item
+            self.block = memoryview(item)
+            self.pos = 0
+
+        n = min(len(b), len(self.block) - self.pos)
+        b[:n] = self.block[self.pos:self.pos + n]
+        self.pos += n
+        return n
+
+    def close(self):
+        if not self.closed:
+            self.stop_event.set()
+            # unblock the thread if it is waiting on a full queue
+            while self.thread.is_alive():
+                try:
+                    self.queue.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            self.thread.join()
+        super().close()
+
+
+class RangeReader(io.RawIOBase):
+    """
+    a raw reader that returns the given (start, end) byte ranges of a file, one after
+    another, as if they were one file. end=None means EOF.
+    """
+
+    def __init__(self, filename: str, ranges: list):
+        super().__init__()
+        self.f = open(filename, 'rb')
+        self.ranges = deque(ranges)
+        self.remaining = 0  # bytes left in the current range. None means to EOF.
+        self.next_range()
+
+    def next_range(self) -> bool:
+        if not self.ranges:
+            self.remaining = 0
+            return False
+        start, end = self.ranges.popleft()
+        self.f.seek(start)
+        self.remaining = None if end is None else end - start
+        return True
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        while True:
+            if self.remaining is None:
+                n = self.f.readinto(b)
+            else:
+                size = min(len(b), self.remaining)
+                n = self.f.readinto(memoryview(b)[:size]) if size else 0
+                self.remaining -= n
+            if n:
+                return n
+            if not self.next_range():
+                return 0
+
+    def close(self):
+        self.f.close()
+        super().close()
+
+
+class FileWaiter:
+    """
+    wait for a followed file to change.
+
+    on linux, inotify (through ctypes, no extra package) wakes us up when the file is
+    written, or when its directory gets a new file, eg, after a rotation. we still wake
+    up every max_interval seconds, in case an event is missed.
+
+    elsewhere, we poll with a backoff: the wait starts at min_interval seconds and doubles,
+    up to max_interval, until reset() is called when new data arrives.
+    """
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+
+    libc = None
+
+    def __init__(self, filename: str, min_interval: float = 0.1, max_interval: float = 2.0, **opt):
+        self.verbose = opt.get('verbose', 0)
+        self.filename = filename
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        self.fd = None
+
+        libc = FileWaiter.get_libc()
+        if libc:
+            fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+            if fd >= 0:
+                self.fd = fd
+                dirname = os.path.dirname(os.path.abspath(filename))
+                self.add_watch(dirname, self.IN_CREATE | self.IN_MOVED_TO)
+                self.watch()
+        if self.verbose:
+            log_FileFuncLine(f'follow {filename} with {"inotify" if self.fd is not None else "polling"}',
+                             file=sys.stderr)
+
+    @classmethod
+    def get_libc(cls):
+        if cls.libc is None:
+            cls.libc = False
+            if sys.platform.startswith('linux'):
+                try:
+                    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+                    libc.inotify_init1
+                    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+                    cls.libc = libc
+                except (OSError, AttributeError):
+                    pass
+        return cls.libc
+
+    def add_watch(self, path: str, mask: int):
+        wd = FileWaiter.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0 and self.verbose:
+            log_FileFuncLine(f'inotify_add_watch({path}) failed, errno={ctypes.get_errno()}',
+                             file=sys.stderr)
+
+    def watch(self):
+        """
+        watch the current file at filename. call it again after the file is rotated.
+        """
+        if self.fd is not None:
+            self.add_watch(self.filename,
+                           self.IN_MODIFY | self.IN_ATTRIB | self.IN_MOVE_SELF | self.IN_DELETE_SELF)
+
+    def wait(self):
+        if self.fd is not None:
+            readable, _, _ = select.select([self.fd], [], [], self.max_interval)
+            if readable:
+                # drain the events. we only need to know that something happened.
+                try:
+                    while os.read(self.fd, 4096):
+                        pass
+                except BlockingIOError:
+                    pass
+            return
+
+        time.sleep(self.interval)
+        self.interval = min(self.interval * 2, self.max_interval)
+
+    def reset(self):
+        self.interval = self.min_interval
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def get_gzindex_files(filename: str):
+    """
+    return the sidecar (index_file, meta_file) of a .gz file.
+    the sidecar sits next to the .gz file; if that directory is not writable, eg, a
+    shared log directory, it goes to ~/.tpsup/gzindex.
+    """
+    abs_path = os.path.abspath(filename).replace('\\', '/')
+    if os.access(os.path.dirname(abs_path), os.W_OK):
+        index_file = f'{abs_path}.gzidx'
+    else:
+        cache_dir = os.path.expanduser("~") + '/.tpsup/gzindex'
+        os.makedirs(cache_dir, exist_ok=True)
+        index_file = f'{cache_dir}/{abs_path.replace("/", "%").replace(":", "%")}.gzidx'
+    return index_file, f'{index_file}.json'
+
+
+warned_no_indexed_gzip = False
+
+
+def open_gzindex(tpi: TpInput, filename: str, spacing: int = 1, **opt):
+    """
+    open a .gz file with indexed_gzip. reuse the sidecar index if the .gz file's
+    mtime and size are unchanged; otherwise, mark the TpInput to save the index
+    that this read builds. return None if indexed_gzip is not installed.
+    """
+    verbose = opt.get('verbose', 0)
+
+    if indexed_gzip is None:
+        global warned_no_indexed_gzip
+        if not warned_no_indexed_gzip:
+            warned_no_indexed_gzip = True
+            log_FileFuncLine('indexed_gzip is not installed. gzindex is ignored', file=sys.stderr)
+        return None
+
+    index_file, meta_file = get_gzindex_files(filename)
+    st = os.stat(filename)
+
+    meta = None
+    if os.path.exists(meta_file) and os.path.exists(index_file):
+        try:
+            with open(meta_file, 'r') as f:
+                meta = json.load(f)
+        except Exception as e:
+            if verbose:
+                log_FileFuncLine(f'cannot read {meta_file}: {e}', file=sys.stderr)
+
+    spacing_bytes = int(spacing * 1024 * 1024)
+
+    if meta and meta.get('size') == st.st_size and meta.get('mtime') == st.st_mtime \
+            and meta.get('spacing') == spacing:
+        if verbose:
+            log_FileFuncLine(f'reuse gzindex {index_file}', file=sys.stderr)
+        try:
+            return indexed_gzip.IndexedGzipFile(filename, spacing=spacing_bytes, index_file=index_file)
+        except Exception as e:
+            # corrupted index. rebuild it below.
+            if verbose:
+                log_FileFuncLine(f'cannot import {index_file}: {e}', file=sys.stderr)
+
+    if verbose:
+        log_FileFuncLine(f'build gzindex {index_file}', file=sys.stderr)
+    tpi.gzindex_to_save = True
+    return indexed_gzip.IndexedGzipFile(filename, spacing=spacing_bytes)
+
+
+def save_gzindex(fh, filename: str, spacing: int = 1, **opt):
+    """
+    finish the index that a read has built so far and save it as the sidecar,
+    along with the .gz file's mtime and size.
+    """
+    verbose = opt.get('verbose', 0)
+
+    # TextIOWrapper(IndexedGzipFile)
+    igz = fh.buffer if isinstance(fh, io.TextIOWrapper) else fh
+
+    index_file, meta_file = get_gzindex_files(filename)
+    st = os.stat(filename)
+    try:
+        # if we read the whole file, the index is already complete and this is cheap.
+        igz.build_full_index()
+        igz.export_index(f'{index_file}.tmp')
+        os.replace(f'{index_file}.tmp', index_file)
+        with open(f'{meta_file}.tmp', 'w') as f:
+            json.dump({'size': st.st_size, 'mtime': st.st_mtime, 'spacing': spacing}, f)
+        os.replace(f'{meta_file}.tmp', meta_file)
+        if verbose:
+            log_FileFuncLine(f'saved gzindex {index_file}', file=sys.stderr)
+    except Exception as e:
+        # the index is only a speedup. never fail the read because of it.
+        print(f'failed to save gzindex {index_file}: {e}', file=sys.stderr)
+
+
 class TpOutput:
     def __init__(self, filename, **opt):
         self.verbose = opt.get('verbose', 0)
@@ -236,6 +943,19 @@ def sort_files(files: Union[list, str],
                reverse=False,
                globbed: bool = False,  # sort_files() uses this to avoid infinite loop
                **opt):
+    if isinstance(files, FindResults):
+        # sort on the columns. the files are not stat'ed again.
+        results = files[:]
+        if sort_func:
+            order = sorted(range(len(results)), key=lambda i: sort_func(results.get_value(i, 'path')),
+                           reverse=reverse)
+            return results.take(order)
+        if sort_name:
+            if sort_name not in ('mtime', 'name', 'size'):
+                raise RuntimeError(f'unknown sort_name={sort_name}')
+            results.sort('path' if sort_name == 'name' else sort_name, reverse=reverse)
+        return results
+
     if not globbed:
         files2 = tpglob(files, **opt)
     else:
@@ -269,31 +989,557 @@ def get_latest_files(files: list, **opt):
     return sort_files(files, sort_name='mtime', reverse=True, **opt)
 
 
+owner_by_uid = {}
+
+
+def get_owner(uid: int):
+    if uid not in owner_by_uid:
+        import pwd
+        try:
+            owner_by_uid[uid] = pwd.getpwuid(uid).pw_name
+        except KeyError:
+            # no such user any more. 'ls -l' shows the number too.
+            owner_by_uid[uid] = str(uid)
+    return owner_by_uid[uid]
+
+
+group_by_gid = {}
+
+
+def get_group(gid: int):
+    if gid not in group_by_gid:
+        import grp
+        try:
+            group_by_gid[gid] = grp.getgrgid(gid).gr_name
+        except KeyError:
+            group_by_gid[gid] = str(gid)
+    return group_by_gid[gid]
+
+
+class FindNode(dict):
+    """
+    the 'r' dict of tpfind().
+
+    path, short, type and now are set up front. the lstat fields (size, mtime, ...) and
+    the derived fields (owner, mtimel, ...) are computed on first access, so an expression
+    that only looks at r['short'] never stats the path or looks up a user name.
+
+    otherwise it is a plain dict: r.get(), 'size' in r, iteration, pformat(r), dict(r)
+    and json.dumps(r) see all fields.
+    """
+    __slots__ = ('entry', 'info', 'is_linux', 'complete')
+
+    stat_attr_by_field = {
+        'dev': 'st_dev',
+        'ino': 'st_ino',
+        'mode': 'st_mode',
+        'nlink': 'st_nlink',
+        'uid': 'st_uid',
+        'gid': 'st_gid',
+        'size': 'st_size',
+        'atime': 'st_atime',
+        'mtime': 'st_mtime',
+        'ctime': 'st_ctime',
+    }
+
+    # in the order of the old plain dict
+    fields = ['path', 'short', 'type', *stat_attr_by_field.keys(), 'now',
+              'fmode', 'atimel', 'ctimel', 'mtimel', 'owner', 'group']
+    lazy_fields = set(fields) - {'path', 'short', 'type', 'now'}
+
+    def __init__(self, path: str, node_type: str, now: float,
+                 entry: os.DirEntry = None, info: os.stat_result = None, is_linux: bool = True):
+        super().__init__(path=path, short=os.path.basename(path), type=node_type, now=now)
+        self.entry = entry
+        self.info = info
+        self.is_linux = is_linux
+        self.complete = False
+
+    def __missing__(self, key):
+        if key in FindNode.stat_attr_by_field:
+            if self.info is None:
+                # DirEntry caches its lstat result; we only need it once.
+                self.info = self.entry.stat(follow_symlinks=False)
+                self.entry = None
+            for k, attr in FindNode.stat_attr_by_field.items():
+                dict.setdefault(self, k, getattr(self.info, attr))
+            return dict.__getitem__(self, key)
+
+        if key == 'fmode':
+            value = stat.filemode(self['mode'])
+        elif key in ('atimel', 'ctimel', 'mtimel'):
+            value = time.strftime('%Y%m%d-%H:%M:%S', time.localtime(self[key[:-1]]))
+        elif key == 'owner':
+            value = get_owner(self['uid']) if self.is_linux else self['uid']
+        elif key == 'group':
+            value = get_group(self['gid']) if self.is_linux else self['gid']
+        else:
+            raise KeyError(key)
+        dict.__setitem__(self, key, value)
+        return value
+
+    def load(self, keys):
+        for k in keys:
+            if k in FindNode.lazy_fields and not dict.__contains__(self, k):
+                self[k]
+
+    def materialize(self):
+        if self.complete:
+            return
+        self.load(FindNode.fields)
+        # keep the key order of the old plain dict, then any keys added by the caller
+        ordered = {k: dict.__getitem__(self, k) for k in FindNode.fields if dict.__contains__(self, k)}
+        ordered.update(dict.items(self))
+        dict.clear(self)
+        dict.update(self, ordered)
+        self.complete = True
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or (not self.complete and key in FindNode.lazy_fields)
+
+    def __iter__(self):
+        self.materialize()
+        return dict.__iter__(self)
+
+    def __len__(self):
+        self.materialize()
+        return dict.__len__(self)
+
+    def keys(self):
+        self.materialize()
+        return dict.keys(self)
+
+    def values(self):
+        self.materialize()
+        return dict.values(self)
+
+    def items(self):
+        self.materialize()
+        return dict.items(self)
+
+    def copy(self):
+        self.materialize()
+        return dict(self)
+
+    def __eq__(self, other):
+        self.materialize()
+        if isinstance(other, FindNode):
+            other.materialize()
+        return dict.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __reduce__(self):
+        # pickle as a plain dict. a DirEntry cannot be pickled.
+        return (dict, (self.copy(),))
+
+
+class FindRow:
+    """
+    a row of FindResults. it reads like the 'r' dict: r['size'], r.get('owner'), 'mtime' in r,
+    r.keys() and dict(r.items()). nothing is stored in the row itself.
+    """
+    __slots__ = ('results', 'i')
+
+    def __init__(self, results: 'FindResults', i: int):
+        self.results = results
+        self.i = i
+
+    def __getitem__(self, key):
+        return self.results.get_value(self.i, key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return key in FindNode.fields
+
+    def keys(self):
+        return list(FindNode.fields)
+
+    def values(self):
+        return [self[k] for k in FindNode.fields]
+
+    def items(self):
+        return [(k, self[k]) for k in FindNode.fields]
+
+    def to_dict(self) -> dict:
+        return dict(self.items())
+
+    def __eq__(self, other):
+        if isinstance(other, FindRow):
+            other = other.to_dict()
+        return self.to_dict() == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+
+class FindResults:
+    """
+    a compact list of tpfind nodes, from tpfind(..., Compact=True).
+
+    a FindNode costs over 1 KB. here, each node is a directory index and a name, a type
+    code and the lstat fields in array columns, about 150 bytes. results[i] and iterating
+    give FindRow views, which compute path, owner, mtimel, ... when asked. keys the
+    caller added to a node, eg, in HandleActs, are not kept.
+
+    sort() and to_csv() work on the columns. sort_files() and get_latest_files() sort it
+    by its own mtime and size columns, without stat'ing the files again.
+    """
+    types = ('dir', 'link', 'file')
+    typecode_by_field = {
+        'dev': 'Q',
+        'ino': 'Q',
+        'mode': 'L',
+        'nlink': 'L',
+        'uid': 'L',
+        'gid': 'L',
+        'size': 'q',
+        'atime': 'd',
+        'mtime': 'd',
+        'ctime': 'd',
+    }
+
+    def __init__(self, now: float = None, is_linux: bool = True):
+        self.now = now
+        self.is_linux = is_linux
+        self.heads = []  # distinct parent dirs, with the trailing '/'
+        self.head_index = {}
+        self.head_ids = array.array('l')
+        self.names = []
+        self.type_ids = array.array('b')
+        self.columns = {k: array.array(code) for k, code in FindResults.typecode_by_field.items()}
+
+    def append(self, r: dict):
+        path = r['path']
+        k = path.rfind('/') + 1
+        head = path[:k]
+        if head not in self.head_index:
+            self.head_index[head] = len(self.heads)
+            self.heads.append(head)
+        values = [r[k2] for k2 in FindResults.typecode_by_field]  # may lstat, before appending
+
+        self.head_ids.append(self.head_index[head])
+        self.names.append(path[k:])
+        self.type_ids.append(FindResults.types.index(r['type']))
+        for column, value in zip(self.columns.values(), values):
+            column.append(value)
+        if self.now is None:
+            self.now = r['now']
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return self.take(range(len(self))[i])
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return FindRow(self, i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield FindRow(self, i)
+
+    def get_value(self, i: int, key: str):
+        if key in self.columns:
+            return self.columns[key][i]
+        if key == 'path':
+            return self.heads[self.head_ids[i]] + self.names[i]
+        if key == 'short':
+            return os.path.basename(self.heads[self.head_ids[i]] + self.names[i])
+        if key == 'type':
+            return FindResults.types[self.type_ids[i]]
+        if key == 'now':
+            return self.now
+        if key == 'fmode':
+            return stat.filemode(self.columns['mode'][i])
+        if key in ('atimel', 'ctimel', 'mtimel'):
+            return time.strftime('%Y%m%d-%H:%M:%S', time.localtime(self.columns[key[:-1]][i]))
+        if key == 'owner':
+            uid = self.columns['uid'][i]
+            return get_owner(uid) if self.is_linux else uid
+        if key == 'group':
+            gid = self.columns['gid'][i]
+            return get_group(gid) if self.is_linux else gid
+        raise KeyError(key)
+
+    def column(self, key: str):
+        """
+        return the array of a stat field, or a list for the other fields.
+        """
+        if key in self.columns:
+            return self.columns[key]
+        return [self.get_value(i, key) for i in range(len(self))]
+
+    def paths(self) -> list:
+        return self.column('path')
+
+    def take(self, indices) -> 'FindResults':
+        """
+        return a new FindResults with the rows at the indices, in that order.
+        """
+        results = FindResults(now=self.now, is_linux=self.is_linux)
+        results.heads = self.heads
+        results.head_index = self.head_index
+        results.head_ids = array.array('l', [self.head_ids[i] for i in indices])
+        results.names = [self.names[i] for i in indices]
+        results.type_ids = array.array('b', [self.type_ids[i] for i in indices])
+        for k, column in self.columns.items():
+            results.columns[k] = array.array(column.typecode, [column[i] for i in indices])
+        return results
+
+    def sort(self, key: str = 'path', reverse: bool = False):
+        """
+        sort in place by a field, eg, 'mtime', 'size' or 'path'.
+        """
+        values = self.column(key)
+        order = sorted(range(len(self)), key=values.__getitem__, reverse=reverse)
+        sorted_results = self.take(order)
+        self.head_ids = sorted_results.head_ids
+        self.names = sorted_results.names
+        self.type_ids = sorted_results.type_ids
+        self.columns = sorted_results.columns
+
+    def to_csv(self, file: str, fields: list = None, **opt):
+        """
+        write the rows to a csv file, '-' for stdout. fields defaults to all fields.
+        """
+        if fields is None:
+            fields = FindNode.fields
+        columns = [self.column(k) for k in fields]
+
+        fh = sys.stdout if file == '-' else open(file, 'w', newline='')
+        try:
+            writer = csv.writer(fh, lineterminator=os.linesep)
+            writer.writerow(fields)
+            writer.writerows(zip(*columns))
+        finally:
+            if fh is not sys.stdout:
+                fh.close()
+
+
+# r['size'], r["size"] or r.get('size') in a tpfind expression
+r_field_pattern = re.compile(r'''\br\s*(?:\[\s*(['"])(\w+)\1\s*\]|\.get\(\s*(['"])(\w+)\3)''')
+r_word_pattern = re.compile(r'\br\b')
+
+
+def get_exp_fields(exps: list) -> Union[set, None]:
+    """
+    return the r fields used by tpfind expressions, eg,
+        get_exp_fields(['r["size"] > 2000', "r.get('owner') == 'root'"]) => {'size', 'owner'}
+    return None if an expression uses r in other ways, eg, r[k] or pformat(r).
+    """
+    fields = set()
+    for exp in exps:
+        for m in r_field_pattern.finditer(exp):
+            fields.add(m.group(2) or m.group(4))
+        if r_word_pattern.search(r_field_pattern.sub('', exp)):
+            return None
+    return fields
+
+
+# the r fields known without a stat call: from the path itself, or the DirEntry's d_type
+name_fields = {'path', 'short', 'type'}
+
+# pure functions that name-only conditions may call
+name_funcs = {'len', 'str', 'int', 're.search', 're.match', 're.fullmatch',
+              'os.path.basename', 'os.path.dirname', 'os.path.splitext'}
+name_methods = {'startswith', 'endswith', 'lower', 'upper', 'casefold', 'strip', 'lstrip',
+                'rstrip', 'split', 'rsplit', 'find', 'rfind', 'count', 'replace',
+                'isdigit', 'isalpha', 'isalnum'}
+
+
+def get_dotted_name(node: ast.AST) -> Union[str, None]:
+    if isinstance(node, ast.Name):
+        return node.id
+    if isinstance(node, ast.Attribute):
+        parent = get_dotted_name(node.value)
+        return f'{parent}.{node.attr}' if parent else None
+    return None
+
+
+def is_name_only(node: ast.AST) -> bool:
+    """
+    whether an expression only uses r['short'], r['path'], r['type'], constants and
+    pure functions, so that it can be evaluated without a stat call.
+    """
+    if isinstance(node, ast.Constant):
+        return True
+    if isinstance(node, (ast.Tuple, ast.List, ast.Set)):
+        return all(is_name_only(e) for e in node.elts)
+    if isinstance(node, ast.Subscript):
+        if isinstance(node.value, ast.Name) and node.value.id == 'r':
+            return isinstance(node.slice, ast.Constant) and node.slice.value in name_fields
+        return is_name_only(node.value) and is_name_only(node.slice)
+    if isinstance(node, ast.Slice):
+        return all(x is None or is_name_only(x) for x in (node.lower, node.upper, node.step))
+    if isinstance(node, ast.BoolOp):
+        return all(is_name_only(v) for v in node.values)
+    if isinstance(node, ast.UnaryOp):
+        return is_name_only(node.operand)
+    if isinstance(node, ast.BinOp):
+        return is_name_only(node.left) and is_name_only(node.right)
+    if isinstance(node, ast.Compare):
+        return is_name_only(node.left) and all(is_name_only(c) for c in node.comparators)
+    if isinstance(node, ast.IfExp):
+        return is_name_only(node.test) and is_name_only(node.body) and is_name_only(node.orelse)
+    if isinstance(node, ast.Call):
+        if not all(is_name_only(a) for a in node.args) or \
+                not all(is_name_only(k.value) for k in node.keywords):
+            return False
+        func = node.func
+        if isinstance(func, ast.Attribute) and isinstance(func.value, ast.Name) and func.value.id == 'r':
+            # r.get('short')
+            return func.attr == 'get' and len(node.args) >= 1 and \
+                isinstance(node.args[0], ast.Constant) and node.args[0].value in name_fields
+        if get_dotted_name(func) in name_funcs:
+            return True
+        if isinstance(func, ast.Attribute) and func.attr in name_methods:
+            return is_name_only(func.value)
+        return False
+    return False
+
+
+def split_match_exps(MatchExps: list) -> tuple:
+    """
+    split each MatchExp at its top-level 'and's. return (name_exps, other_exps), where
+    name_exps only look at the name, path and type (see is_name_only()). checking them
+    first lets tpfind drop most nodes before anything needs a stat call. an expression
+    we cannot parse is kept whole in other_exps.
+
+        split_match_exps(["r['short'].endswith('.log') and r['size'] > 1e9"])
+        => (["r['short'].endswith('.log')"], ["r['size'] > 1e9"])
+    """
+    name_exps = []
+    other_exps = []
+    for exp in MatchExps:
+        try:
+            tree = ast.parse(exp.strip(), mode='eval')
+        except SyntaxError:
+            other_exps.append(exp)
+            continue
+
+        body = tree.body
+        if isinstance(body, ast.BoolOp) and isinstance(body.op, ast.And):
+            conditions = body.values
+        else:
+            conditions = [body]
+
+        others = []
+        for c in conditions:
+            if is_name_only(c):
+                name_exps.append(ast.unparse(c))
+            else:
+                others.append(c)
+
+        if len(others) == len(conditions):
+            # nothing to split out. keep the user's text.
+            other_exps.append(exp)
+        elif others:
+            other_exps.append(' and '.join([f'({ast.unparse(c)})' for c in others]))
+    return name_exps, other_exps
+
+
+def get_path_prefixes(name_exps: list) -> list:
+    """
+    return a list of prefix tuples, one for each r['path'].startswith(<constant>) in
+    name_exps. a path must start with one prefix of every tuple to match.
+    """
+    prefixes_list = []
+    for exp in name_exps:
+        node = ast.parse(exp, mode='eval').body
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) \
+                and node.func.attr == 'startswith' and len(node.args) == 1 and not node.keywords \
+                and isinstance(node.func.value, ast.Subscript) \
+                and isinstance(node.func.value.value, ast.Name) and node.func.value.value.id == 'r' \
+                and isinstance(node.func.value.slice, ast.Constant) and node.func.value.slice.value == 'path':
+            arg = node.args[0]
+            if isinstance(arg, ast.Constant) and isinstance(arg.value, str):
+                prefixes_list.append((arg.value,))
+            elif isinstance(arg, ast.Tuple) and all(isinstance(e, ast.Constant) and isinstance(e.value, str)
+                                                    for e in arg.elts):
+                prefixes_list.append(tuple(e.value for e in arg.elts))
+    return prefixes_list
+
+
+def can_have_match_below(dir_path: str, prefixes_list: list) -> bool:
+    """
+    whether a path under dir_path can start with one prefix of every tuple.
+    """
+    dir_path2 = f'{dir_path}/'
+    for prefixes in prefixes_list:
+        if not any(p.startswith(dir_path2) or dir_path2.startswith(p) for p in prefixes):
+            return False
+    return True
+
+
 exclude_dirs = set(['.', '..', '-', '.git', '.idea',
                    '__pycache__', '.snapshot', '.vscode'])
 
 
-def tpfind(paths: Union[list, str],
-           MatchExps: list = [],
-           FlowExps: list = [],
-           FlowDirs: list = [],
-           HandleExps: list = [],
-           HandleActs: list = [],
-           no_print: bool = False,
-           find_print: bool = False,
-           find_ls: bool = False,
-           find_dump: bool = False,
-           MaxCount: int = None,
-           MaxDepth: int = None,
-           **opt):
+def tpfind_iter(paths: Union[list, str],
+                MatchExps: list = [],
+                FlowExps: list = [],
+                FlowDirs: list = [],
+                HandleExps: list = [],
+                HandleActs: list = [],
+                no_print: bool = False,
+                find_print: bool = False,
+                find_ls: bool = False,
+                find_dump: bool = False,
+                MaxCount: int = None,
+                MaxDepth: int = None,
+                Workers: int = None,
+                Sorted: bool = False,
+                Listings: dict = None,
+                ListingsOut: dict = None,
+                **opt):
+    """
+    walk the paths breadth-first, like 'find', and yield each matched node ('r' dict)
+    as soon as it is found. see ptfind for the expressions.
+
+    nothing is kept, so memory does not grow with the number of matched nodes, and the
+    caller can start working on the first node while the walk goes on. MaxCount stops
+    the walk after that many nodes. tpfind() returns them all in a list.
+
+    Workers=N lists (and stats) directories in a pool of N threads, for filesystems with
+    high per-directory latency, eg, NFS. nodes are still processed in this thread, in the
+    same order as Workers=None, so MaxDepth, MaxCount, FlowExps prune/exit, HandleActs
+    and the printed order do not change.
+
+    Sorted=True visits the entries of each directory in name order, instead of the
+    order the filesystem returns them.
+
+    ListingsOut={} collects {dir: (mtime_ns, [names])} of the directories listed.
+    Listings=<an old ListingsOut> reuses the names of a directory whose mtime has not
+    changed, instead of reading it again. the entries are still stat'ed. a directory
+    changed within listing_granularity_ns before its listing gets mtime_ns=None, so
+    that its listing is read again next time. see tpsup.snapshottools.
+    """
 
     # verbose will be passed to downstream functions, therefore, it stays in **opt
     verbose = opt.get('verbose', 0)
 
     import platform
     if platform.system().lower().startswith("lin"):
-        import pwd
-        import grp
         is_linux = True
     else:
         is_linux = False
@@ -373,9 +1619,24 @@ def getline(**opt):
     mod_code = compile(mod_source, mod_name, 'exec')
     exec(mod_code, mod.__dict__)
 
+    # check the name-only conditions of MatchExps first, so that most nodes are dropped
+    # before anything needs a stat call. see split_match_exps().
+    name_exps, other_exps = split_match_exps(MatchExps)
+    MatchExps2 = name_exps + other_exps
+
+    # a directory can be skipped when no path below it can match r['path'].startswith(...),
+    # unless FlowExps or HandleExps still need to see those nodes.
+    path_prefixes_list = []
+    if not HandleExps and all(d == 'prune' for d in FlowDirs):
+        path_prefixes_list = get_path_prefixes(name_exps)
+
+    if verbose >= 2:
+        log_FileFuncLine(f'name_exps={name_exps}, other_exps={other_exps}, '
+                         f'path_prefixes_list={path_prefixes_list}', file=sys.stderr)
+
     # keep all functions in 1 module so that we only need to export 'r' once
     CompiledMatchExps = compile_codelist(
-        MatchExps, existing_module=mod, is_exp=True)
+        MatchExps2, existing_module=mod, is_exp=True)
     CompiledFlowExps = compile_codelist(
         FlowExps, existing_module=mod, is_exp=True, verbose=verbose)
     CompiledHandleExps = compile_codelist(
@@ -388,14 +1649,23 @@ def getline(**opt):
     # export_r = mod.export_r
     export_r = getattr(mod, 'export_r')
 
-    ret = {
-        'error': 0,
-        'hashes': [],
-        'count': 0,
-    }
+    count = 0
 
     now = time.time()
 
+    # the fields that the expressions and the printing use. they are loaded together
+    # when a node is created; other fields are only computed if accessed.
+    # the MatchExps fields are not loaded up front: most nodes fail the name-only
+    # conditions and never need them.
+    exp_fields = get_exp_fields(FlowExps + HandleExps + HandleActs)
+    if exp_fields is not None:
+        exp_fields = [f for f in FindNode.fields if f in exp_fields]
+
+    # whether the rest of the nodes, or printing them, will need a stat
+    match_fields = get_exp_fields(other_exps)
+    need_stat = find_dump or find_ls or exp_fields is None or match_fields is None or \
+        bool((set(exp_fields) | match_fields) & FindNode.lazy_fields)
+
     #############################################################
     # begin - function inside function
     # we use function inside function to avoid passing too many parameters.
@@ -408,57 +1678,36 @@ def getline(**opt):
         elif find_print:
             print(f'{r["path"]}')
 
-    def process_node(full_path: str = None, **opt):
+    def process_node(full_path: str = None, entry: os.DirEntry = None, **opt):
         # 'r' is the node info, for expression matching.
         # 'result' is the return value of this function, mainly for flow control.
-        r = {}
         result = {}
 
-        r['path'] = full_path
-        r['short'] = os.path.basename(full_path)
-
-        if os.path.isdir(full_path):
-            r['type'] = 'dir'
-        elif os.path.islink(full_path):
-            r['type'] = 'link'
+        if entry is not None:
+            # a DirEntry from os.scandir() has the file type from the directory read,
+            # so we only lstat it if an expression needs, eg, r['size'].
+            info = None
+            is_dir = entry.is_dir()
+            is_link = entry.is_symlink()
         else:
-            r['type'] = 'file'
-
-        info = os.lstat(r['path'])
-        r['dev'] = info.st_dev
-        r['ino'] = info.st_ino
-        r['mode'] = info.st_mode
-        r['nlink'] = info.st_nlink
-        r['uid'] = info.st_uid
-        r['gid'] = info.st_gid
-        r['size'] = info.st_size
-        r['atime'] = info.st_atime
-        r['mtime'] = info.st_mtime
-        r['ctime'] = info.st_ctime
-
-        r['now'] = now
-        r['fmode'] = stat.filemode(info.st_mode)
-
-        r['atimel'] = time.strftime(
-            '%Y%m%d-%H:%M:%S', time.localtime(r['atime']))
-        r['ctimel'] = time.strftime(
-            '%Y%m%d-%H:%M:%S', time.localtime(r['ctime']))
-        r['mtimel'] = time.strftime(
-            '%Y%m%d-%H:%M:%S', time.localtime(r['mtime']))
-
-        if is_linux:
-            # https://stackoverflow.com/questions/7770034/in-python-and-linux
-            # -how-to-get-given-users-id
-            # https://docs.python.org/2/1ibrary/pwd.html
-            _pwd = pwd.getpwuid(r['uid'])
-            r['owner'] = _pwd.pw_name
-
-            # https://docs.python.org/2/library/grp.html#module-grp
-            _grp = grp.getgrgid(r['gid'])
-            r['group'] = _grp.gr_name
+            info = os.lstat(full_path)
+            is_link = stat.S_ISLNK(info.st_mode)
+            if is_link:
+                is_dir = os.path.isdir(full_path)
+            else:
+                is_dir = stat.S_ISDIR(info.st_mode)
+
+        # same as os.path.isdir() and os.path.islink(): a link to a dir is a 'dir'
+        if is_dir:
+            r_type = 'dir'
+        elif is_link:
+            r_type = 'link'
         else:
-            r['owner'] = r['uid']
-            r['group'] = r['gid']
+            r_type = 'file'
+
+        r = FindNode(full_path, r_type, now, entry=entry, info=info, is_linux=is_linux)
+        if exp_fields:
+            r.load(exp_fields)
 
         # export r into the module, so that functions in the module can access it.
         export_r(r)
@@ -510,8 +1759,8 @@ def getline(**opt):
             # MatchExps doesn't affect flow control;
             # it only affects whether to count or print the path
             all_matched = True
-            for i in range(0, len(MatchExps)):
-                exp = MatchExps[i]
+            for i in range(0, len(MatchExps2)):
+                exp = MatchExps2[i]
                 compiled = CompiledMatchExps[i]
 
                 try:
@@ -532,8 +1781,7 @@ def getline(**opt):
                 count_path = True
 
         if count_path:
-            ret['hashes'].append(r)
-            ret['count'] += 1
+            result['node'] = r
             print_path(r)
         return result
 
@@ -543,51 +1791,151 @@ def getline(**opt):
     # the following mimic perl's tpfind()
     globbed_paths = tpglob(paths, **opt)
 
-    pathLevels = []
-    for path in globbed_paths:
-        pathLevel = [path, 0]
-        pathLevels.append(pathLevel)
+    def list_dir(path: str) -> list:
+        """
+        return [(name, DirEntry or None)]. None when the name comes from Listings.
+        """
+        mtime_ns = None
+        if Listings is not None or ListingsOut is not None:
+            # before the stat and the listing, so that a later change cannot be in the
+            # same mtime tick as a settled listing
+            now_ns = time.time_ns()
+            mtime_ns = os.stat(path).st_mtime_ns
+
+        old = Listings.get(path, None) if Listings else None
+        if old and old[0] == mtime_ns:
+            # no entry was added, removed or renamed since the old listing
+            entries = [(name, None) for name in old[1]]
+        else:
+            with os.scandir(path) as it:
+                entries = [(e.name, e) for e in it if e.name not in exclude_dirs]
+
+        if Sorted:
+            entries.sort(key=lambda x: x[0])
+        if ListingsOut is not None:
+            settled = mtime_ns < now_ns - listing_granularity_ns
+            ListingsOut[path] = (mtime_ns if settled else None, [name for name, e in entries])
+        if pool and need_stat:
+            # with workers, fill the DirEntry caches here, in the worker thread
+            for name, e in entries:
+                if e is None:
+                    continue
+                try:
+                    e.is_dir()
+                    e.stat(follow_symlinks=False)
+                except OSError:
+                    # eg, removed since listed. process_node() will see the error.
+                    pass
+        return entries
 
     seen = {}
 
-    while pathLevels:
-        if MaxCount is not None:
-            if ret['count'] >= MaxCount:
-                break
+    def add_children(path: str, level: int, entries: list):
+        for name, entry2 in entries:
+            path2 = f'{path}/{name}'
+            if path2 in seen:
+                continue
+            seen[path2] = 1
 
-        pathLevel = pathLevels.pop(0)
-        path, level = pathLevel
+            pathLevels.append((path2, level + 1, entry2))
 
-        if path == '-':
-            # this is stdin. skip it.
-            # we could come here when tpfind() is called by tpgrep() which
-            # can take stdin as input.
-            continue
+    # breadth-first. each item is (path, level, DirEntry or None for the top paths).
+    # with workers, a directory's item is followed later by (path, level, Future of
+    # its listing). the children are queued when that item comes up, which is the
+    # same order as listing the directory right away.
+    pathLevels = deque()
+    for path in globbed_paths:
+        pathLevels.append((path, 0, None))
+
+    pool = None
+    if Workers and Workers > 1:
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=Workers)
+
+    try:
+        while pathLevels:
+            if MaxCount is not None:
+                if count >= MaxCount:
+                    break
 
-        result = process_node(full_path=path, **opt)
-        if direction := result.get('direction', None):
-            if direction == 'exit':
-                return ret
-            elif direction == 'prune':
+            path, level, entry = pathLevels.popleft()
+
+            if isinstance(entry, concurrent.futures.Future):
+                add_children(path, level, entry.result())
                 continue
 
-        if MaxDepth is not None:
-            if level >= MaxDepth:
+            if path == '-':
+                # this is stdin. skip it.
+                # we could come here when tpfind() is called by tpgrep() which
+                # can take stdin as input.
                 continue
 
-        if os.path.isdir(path):
-            shorts = os.listdir(path)
-            for short in shorts:
-                if short in exclude_dirs:
+            result = process_node(full_path=path, entry=entry, **opt)
+            if (node := result.get('node')) is not None:
+                count += 1
+                yield node
+                if MaxCount is not None and count >= MaxCount:
+                    return
+            if direction := result.get('direction', None):
+                if direction == 'exit':
+                    return
+                elif direction == 'prune':
                     continue
 
-                path2 = f'{path}/{short}'
-                if path2 in seen:
+            if MaxDepth is not None:
+                if level >= MaxDepth:
                     continue
-                seen[path2] = 1
 
-                pathLevel = [path2, level + 1]
-                pathLevels.append(pathLevel)
+            # DirEntry.is_dir() is cached by process_node()
+            is_dir = entry.is_dir() if entry is not None else os.path.isdir(path)
+            if is_dir and path_prefixes_list and not can_have_match_below(path, path_prefixes_list):
+                if verbose:
+                    log_FileFuncLine(f'nothing under {path} can match, skip it', file=sys.stderr)
+                continue
+            if is_dir:
+                if pool:
+                    pathLevels.append((path, level, pool.submit(list_dir, path)))
+                else:
+                    add_children(path, level, list_dir(path))
+    finally:
+        if pool:
+            # after an exit, MaxCount or the caller stopping early, don't wait for
+            # the listings nobody needs
+            pool.shutdown(wait=False, cancel_futures=True)
+
+
+def tpfind(paths: Union[list, str], Compact: bool = False, **opt) -> dict:
+    """
+    walk the paths like 'find'. return {'error': 0, 'hashes': [r, ...], 'count': N}
+    with all matched nodes. see tpfind_iter() for the options.
+
+    Compact=True returns the nodes in a FindResults instead of a list, for walks of
+    millions of files.
+    """
+    if Compact:
+        import platform
+        hashes = FindResults(is_linux=platform.system().lower().startswith("lin"))
+    else:
+        hashes = []
+
+    ret = {
+        'error': 0,
+        'hashes': hashes,
+        'count': 0,
+    }
+
+    verbose = opt.get('verbose', 0)
+    for r in tpfind_iter(paths, **opt):
+        if Compact:
+            try:
+                ret['hashes'].append(r)
+            except OSError as e:
+                # eg, removed after its directory was read
+                if verbose:
+                    log_FileFuncLine(f'skip {r["path"]}: {e}', file=sys.stderr)
+                continue
+        else:
+            ret['hashes'].append(r)
+        ret['count'] += 1
 
     return ret
 
@@ -672,6 +2020,11 @@ def main():
         for line in tf:
             print(line, end='')
 
+    print('test1b')
+    with TpInput(filename=file, ExcludePatterns=['Smith'], binary=True, verbose=verbose) as tf:
+        for line in tf:
+            print(line, end='')
+
     print('test2')
     import csv
     with TpInput(filename=file, MatchPatterns=[',S'], ExcludePatterns=['Stephen'], verbose=verbose) as tf:
@@ -712,6 +2065,7 @@ def main():
     libfiles = f'{TPSUP}/python3/lib/tpsup/*tools.py'
     p3scripts = f'{TPSUP}/python3/scripts'
     searchfiles = f'{TPSUP}/python3/lib/tpsup/searchtools_test*.txt'
+    compact = tpfind(p3scripts, MatchExps=['r["short"].startswith("ptgrep")'], no_print=True, Compact=True)
 
     def test_codes():
         sort_files([libfiles], sort_name='mtime')
@@ -737,6 +2091,13 @@ def main():
                    '''print('------');print(getline(count=10));os.system(f"ls -l {r['path']}")'''],
                MaxCount=5,
                )
+        [r['short'] for r in tpfind_iter(p3scripts, MatchExps=['r["short"].startswith("ptgrep")'],
+                                         no_print=True, MaxCount=2)]
+        get_exp_fields(['r["size"] > 2000', "r.get('owner') == 'root'"])  # {'size', 'owner'}
+        get_exp_fields(['pformat(r)'])  # None
+        split_match_exps(["r['short'].endswith('.log') and r['size'] > 1e9"])
+        [r['short'] for r in get_latest_files(compact['hashes'])[:2]]
+        compact['hashes'][0]['size'] == os.lstat(compact['hashes'][0]['path']).st_size  # True
 
         stat.filemode(0o100644)
         un_filemode('-rw-r--r--')
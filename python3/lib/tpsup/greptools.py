@@ -1,13 +1,243 @@
 # python grep equivallent
 
+from functools import partial
 from glob import glob
+import itertools
+import mmap
+import multiprocessing
 import os
 import re
 import sys
+import threading
 from typing import Union
-from tpsup.filetools import TpInput, tpfind
+from tpsup.filetools import TpInput, sort_files, tpfind_iter
 from tpsup.logbasic import log_FileFuncLine
+from tpsup.patterntools import MatchPlan, get_match_plan, ignorecase_unsafe_pattern
 from tpsup.searchtools import binary_search_first
+from tpsup.trigramtools import TrigramIndex
+
+
+# regex pieces that behave differently on a bytes buffer than on a decoded line:
+#   - '.', '\w', '\s', '\d', '\b', [^...] match one byte in bytes but one char in str,
+#     and the classes are ascii-only in bytes.
+#   - '\A', '\Z' anchor at the buffer ends, not the line ends.
+#   - newlines let a match span lines.
+#   - '\xNN', '\uNNNN', '\UNNNNNNNN', '\N{...}' and octal escapes can name a non-ascii char,
+#     which is more than one byte in utf-8. bytes patterns reject '\u', '\U' and '\N'.
+# patterns with these cannot be used to scan the whole buffer without risking a miss.
+mmap_unsafe_pattern = re.compile(r'\.|\\[AZwWsSdDbBnrxuUN0-7]|\[\^|\n|\r')
+
+
+def get_mmap_scanner(plan: MatchPlan):
+    """
+    return what grep_1_file_mmap() uses to find candidate lines in a whole buffer:
+        - a bytes literal that every matched line must contain, found by bytes.find(), or
+        - the first MatchPattern that is safe for a whole buffer, compiled as bytes.
+    return None if there is neither.
+    """
+    literal = plan.get_scan_literal()
+    if literal is not None:
+        return literal.encode('utf-8')
+
+    for p in plan.match_compiled:
+        if not p.pattern.isascii() or mmap_unsafe_pattern.search(p.pattern):
+            continue
+        flags = re.MULTILINE
+        if p.flags & re.IGNORECASE:
+            if not p.flags & re.ASCII and ignorecase_unsafe_pattern.search(p.pattern):
+                continue
+            flags |= re.IGNORECASE
+        try:
+            return re.compile(p.pattern.encode('utf-8'), flags)
+        except re.error:
+            # eg, an inline (?u), which bytes patterns do not take
+            continue
+    return None
+
+
+def grep_1_file_mmap(f: str,
+                     scanner: Union[bytes, re.Pattern],
+                     plan: MatchPlan,
+                     FileNameOnly: bool = False,
+                     print_filename: bool = False,
+                     print_output: bool = False,
+                     **opt) -> list:
+    """
+    grep one uncompressed file by mmap.
+    the scanner searches the whole buffer; each hit is expanded to its line, and
+    only that candidate line is decoded and checked with the full plan.
+    """
+    verbose = opt.get('verbose', 0)
+    errors = opt.get('errors', 'replace')
+
+    lines = []
+    with open(f, 'rb') as fh:
+        size = os.fstat(fh.fileno()).st_size
+        if size == 0:
+            # mmap cannot map an empty file
+            return lines
+
+        with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            if isinstance(scanner, bytes):
+                def find(pos: int) -> int:
+                    return buf.find(scanner, pos)
+            else:
+                def find(pos: int) -> int:
+                    m = scanner.search(buf, pos)
+                    return m.start() if m else -1
+
+            pos = 0
+            while pos < size:
+                hit = find(pos)
+                if hit < 0:
+                    break
+
+                start = buf.rfind(b'\n', 0, hit) + 1
+                end = buf.find(b'\n', hit)
+                end = size if end < 0 else end + 1
+
+                # always restart from the next line, so a hit that spans lines
+                # cannot hide a real hit in the lines it spans.
+                pos = end
+
+                line = buf[start:end].decode('utf-8', errors=errors)
+
+                if verbose > 2:
+                    print(f'line={line}', file=sys.stderr)
+
+                if not plan.matches(line):
+                    continue
+
+                if FileNameOnly:
+                    # we only need the file name, stop reading at the first match
+                    lines.append(f)
+                    if print_output:
+                        print(f)
+                    break
+
+                if print_filename:
+                    lines.append(f'{f}:{line}')
+                    if print_output:
+                        print(f'{f}:{line}', end='')
+                else:
+                    lines.append(line)
+                    if print_output:
+                        print(line, end='')
+
+    return lines
+
+
+def grep_1_file(f: str,
+                plan: MatchPlan,
+                FileNameOnly: bool = False,
+                print_filename: bool = False,
+                print_output: bool = False,
+                Engine: str = 'line',
+                LastN: int = None,
+                IndexRanges: dict = None,
+                **opt) -> list:
+    """
+    grep one file with a MatchPlan, return a list of matched lines.
+    this is a module-level function so that it can be sent to a process pool.
+
+    Engine='mmap' uses grep_1_file_mmap() for uncompressed files; stdin, .gz
+    and plans that cannot scan a whole buffer fall back to the line engine.
+
+    LastN=k reads the file backward and stops after k matches. the k lines are
+    returned in file order.
+
+    with follow=True (see TpInput), matched lines are printed as the file grows and
+    are not kept, so memory stays flat. Engine and LastN are ignored.
+
+    IndexRanges={file: ranges} from TrigramIndex.get_candidates() limits the line
+    engine to the byte ranges that may match.
+    """
+    verbose = opt.get('verbose', 0)
+    follow = opt.get('follow', False)
+
+    if IndexRanges and IndexRanges.get(f, None) is not None:
+        opt['ranges'] = IndexRanges[f]
+
+    if follow:
+        # a followed file never ends. print as we go and keep nothing.
+        LastN = None
+        print_output = True
+    elif LastN:
+        # the mmap engine scans forward. reading backward is faster for the last few matches.
+        opt['reverse'] = True
+        opt['reverse_buffer'] = LastN
+    elif Engine == 'mmap':
+        scanner = get_mmap_scanner(plan)
+        if scanner is None:
+            if verbose:
+                log_FileFuncLine(f'no MatchPattern can scan a whole buffer, use line engine for {f}',
+                                 file=sys.stderr)
+        elif f == '-' or f.endswith('.gz'):
+            if verbose:
+                log_FileFuncLine(f'cannot mmap {f}, use line engine', file=sys.stderr)
+        else:
+            return grep_1_file_mmap(f, scanner, plan,
+                                    FileNameOnly=FileNameOnly,
+                                    print_filename=print_filename,
+                                    print_output=print_output,
+                                    **opt)
+    elif Engine != 'line':
+        raise RuntimeError(f'unknown Engine={Engine}, expect line or mmap')
+
+    matches = None if plan.is_empty() else plan.matches
+
+    # with LastN, lines come newest-first. we print them after putting them back in order.
+    print_now = print_output and not LastN
+
+    lines = []
+    with TpInput(filename=f, **opt) as tf:
+        # Regex is built inside TpInput
+
+        try:
+            for line in tf:  # this line may raise exception for binary file. so use try/except
+                if verbose > 2:
+                    print(f'line={line}', file=sys.stderr)
+
+                if matches and not matches(line):
+                    continue
+
+                if FileNameOnly:
+                    # we only need the file name, stop reading at the first match
+                    lines.append(f)
+                    if print_output:
+                        print(f)
+                    break
+
+                if follow:
+                    print(f'{f}:{line}' if print_filename else line, end='', flush=True)
+                    continue
+
+                if print_filename:
+                    lines.append(f'{f}:{line}')
+                    if print_now:
+                        print(f'{f}:{line}', end='')
+                else:
+                    lines.append(line)
+                    if print_now:
+                        print(line, end='')
+
+                if LastN and len(lines) >= LastN:
+                    break
+        except UnicodeDecodeError as e:
+            # UnicodeDecodeError: 'utf-8' codec can't decode byte 0x9b in position 147:
+            #     invalid start byte
+            print(
+                f'grep {f} failed with decode error. skipped.', file=sys.stderr)
+            if verbose:
+                print(e, file=sys.stderr)
+
+    if LastN and not FileNameOnly:
+        lines.reverse()
+        if print_output:
+            for line in lines:
+                print(line, end='')
+
+    return lines
 
 
 def tpgrep(files: Union[list, str],
@@ -21,9 +251,44 @@ def tpgrep(files: Union[list, str],
            FindFirstFile: bool = False,
            print_output: bool = False,
            CaseInsensitive: bool = False,
+           Parallel: int = None,
+           Engine: str = 'line',
+           LastN: int = None,
+           Follow: bool = False,
+           Index: str = None,
            **opt):
     """
     grep a file, return a list of matched lines
+
+    FindFirstFile=True binary-searches the files for the first one with a match,
+    and returns it, or None. each probe stops at the first matched line. the files
+    are first sorted by sort_name ('mtime', 'name', 'size') or sort_func if given.
+
+    Parallel=N greps files in a pool of N processes. results are returned
+    (and printed) in the same per-file order as the serial path.
+
+    binary=True matches raw bytes and only decodes matched lines, using
+    errors='replace' by default. see TpInput.
+
+    gzindex=True keeps a sidecar index next to each .gz file, so that tail=N
+    (bytes) and offset=N jump into it. see TpInput.
+
+    LastN=k only returns the last k matches of each file, reading it backward
+    from EOF (.gz files are scanned forward unless gzindex=True).
+
+    Follow=True keeps printing new matched lines as the files grow, like
+    'tail -f | grep', and handles rotation and truncation. it only returns when
+    follow_idle=N seconds pass without a new line. more than one file is followed
+    in threads. see TpInput.
+
+    Index=DIR keeps a persistent trigram index of the files in DIR, updated for new
+    or changed files, and only greps the files and blocks that may match. it never
+    drops a match. .gz files are only narrowed to the whole file, not to blocks.
+    index_block=N sets the block size in MB. see TrigramIndex.
+
+    Engine='mmap' scans uncompressed files as one mmap buffer with a required
+    literal or the first MatchPattern, and only checks the lines around its hits.
+    see grep_1_file().
     """
 
     # verbose will be passed to downstream functions, therefore, it stays in **opt
@@ -32,22 +297,35 @@ def tpgrep(files: Union[list, str],
     if not Recursive:
         MaxDepth = 0
 
-    found = tpfind(files,
+    find = partial(tpfind_iter,
                    MaxDepth=MaxDepth,
-                   MatchExps=['r["type"] != "dir"'],
+                   # skip the sidecar index files of TpInput(gzindex=True)
+                   MatchExps=['r["type"] != "dir" and not r["short"].endswith((".gzidx", ".gzidx.json"))'],
                    no_print=True,
                    **opt)
 
-    files2 = [r['path'] for r in found["hashes"]]
-
-    if '-' in files:
-        # tpfind will throw away '-' because it is not a file. we need to add it back
-        files2.append('-')
-
-    print_filename = len(files2) > 1
+    def iter_files():
+        # tpfind throws away '-' because it is not a file. walk the paths between the
+        # '-'s, so that stdin is grepped at its place in files.
+        paths = files.split() if isinstance(files, str) else files
+        segment = []
+        for path in list(paths) + [None]:
+            if path is None or path == '-':
+                if segment:
+                    for r in find(segment):
+                        yield r['path']
+                    segment = []
+                if path == '-':
+                    yield '-'
+            else:
+                segment.append(path)
 
-    if verbose:
-        print(f'files2={files2}', file=sys.stderr)
+    # the walk is streamed: we grep the first file while the walk goes on.
+    # file names are printed when there are more than 1 file; looking ahead 2 files tells.
+    files_iter = iter_files()
+    head = list(itertools.islice(files_iter, 2))
+    print_filename = len(head) > 1
+    files2 = itertools.chain(head, files_iter)
 
     if MatchPatterns:
         MatchPatterns2 = MatchPatterns
@@ -65,87 +343,76 @@ def tpgrep(files: Union[list, str],
     # print(f'MatchPatterns2={MatchPatterns2}', file=sys.stderr)
     # print(f'ExcludePatterns2={ExcludePatterns2}', file=sys.stderr)  # toremove
 
-    MatchCompiled = []
-    if MatchPatterns2:
-        for p in MatchPatterns2:
-            if CaseInsensitive:
-                MatchCompiled.append(re.compile(p, re.IGNORECASE))
-            else:
-                MatchCompiled.append(re.compile(p))
-    ExcludeCompiled = []
-    if ExcludePatterns2:
-        for p in ExcludePatterns2:
-            if CaseInsensitive:
-                ExcludeCompiled.append(re.compile(p, re.IGNORECASE))
-            else:
-                ExcludeCompiled.append(re.compile(p))
+    if Follow:
+        opt['follow'] = True
+        Parallel = None
+        FindFirstFile = False
+        Index = None
+
+    if Index or FindFirstFile:
+        # these need all files up front
+        files2 = list(files2)
+        if verbose:
+            print(f'files2={files2}', file=sys.stderr)
+
+    IndexRanges = None
+    if Index:
+        # narrow the files to the ones, and the blocks, that may have a match
+        with TrigramIndex(Index,
+                          block_size=int(opt.get('index_block', 1) * 1024 * 1024),
+                          verbose=verbose) as ti:
+            IndexRanges = ti.get_candidates(files2, MatchPatterns2, CaseInsensitive=CaseInsensitive)
+        files2 = [f for f in files2 if f in IndexRanges]
+
+    if LastN or (opt.get('binary', False) and Engine != 'mmap'):
+        # binary mode: let TpInput match raw bytes so that only matched lines are decoded.
+        # LastN: TpInput must match, so that it keeps the last matches, not the last lines,
+        # when it cannot read backward.
+        opt['MatchPatterns'] = MatchPatterns2
+        opt['ExcludePatterns'] = ExcludePatterns2
+        opt['CaseInsensitive'] = CaseInsensitive
+        MatchPatterns2 = []
+        ExcludePatterns2 = []
+
+    # the plan checks required literals before running the regex engine,
+    # and fuses ExcludePatterns into one regex.
+    plan = get_match_plan(MatchPatterns2, ExcludePatterns2,
+                          CaseInsensitive=CaseInsensitive)
 
     lines2 = []
 
-    # define a function inside a function to save from passing parameters
-
-    def grep_1_file(f: str):
-        lines = []
-        with TpInput(filename=f, **opt) as tf:
-            # Regex is built inside TpInput
-
-            try:
-                for line in tf:  # this line may raise exception for binary file. so use try/except
-                    if verbose > 2:
-                        print(f'line={line}', file=sys.stderr)
-
-                    if MatchCompiled:
-                        all_matched = True
-                        for p in MatchCompiled:
-                            if not p.search(line):
-                                all_matched = False
-                                break
-                        if not all_matched:
-                            continue
-
-                    to_exclude = False
-                    if ExcludeCompiled:
-                        for p in ExcludeCompiled:
-                            if p.search(line):
-                                # print(f'exclude {f}:{line}',
-                                #       file=sys.stderr)  # toremove
-                                to_exclude = True
-                                break
-                    if to_exclude:
-                        continue
-
-                    if FileNameOnly:
-                        lines.append(f)
-                        if print_output:
-                            print(f)
-                        break
-
-                    if print_filename:
-                        lines.append(f'{f}:{line}')
-                        if print_output:
-                            print(f'{f}:{line}', end='')
-                    else:
-                        lines.append(line)
-                        if print_output:
-                            print(line, end='')
-            except UnicodeDecodeError as e:
-                # UnicodeDecodeError: 'utf-8' codec can't decode byte 0x9b in position 147:
-                #     invalid start byte
-                print(
-                    f'grep {f} failed with decode error. skipped.', file=sys.stderr)
+    if FindFirstFile:
+        # use binary search to find the first file has the match.
+        # it assumes that, in this order, all files before the first match have no match,
+        # eg, a time-ordered log set with sort_name='mtime'. stdin cannot be probed.
+        files4 = [f for f in dict.fromkeys(files2) if f != '-']
+        if opt.get('sort_name', None) or opt.get('sort_func', None):
+            files4 = sort_files(files4,
+                                sort_name=opt.get('sort_name', None),
+                                sort_func=opt.get('sort_func', None),
+                                globbed=True)
+
+        probed = {}
+
+        def probe(f) -> bool:
+            # we only need a yes/no: FileNameOnly stops at the first match.
+            # remember the answer, so that no file is grepped twice in this call.
+            if f not in probed:
+                probed[f] = bool(grep_1_file(f, plan,
+                                             FileNameOnly=True,
+                                             Engine=Engine,
+                                             IndexRanges=IndexRanges,
+                                             **opt))
                 if verbose:
-                    print(e, file=sys.stderr)
+                    log_FileFuncLine(f'probed {f}, matched={probed[f]}', file=sys.stderr)
+            return probed[f]
 
-        return lines
+        index = binary_search_first(files4, probe)
+        return files4[index] if index is not None else None
 
-    if FindFirstFile:
-        # use binary search to find the first file has the match
-        def grep2(f):
-            return grep_1_file(f)
-        index = binary_search_first(files2, grep2)
-        return files2[index] if index >= 0 else None
-    else:
-        seen_file = {}
+    seen_file = {}
+
+    def iter_new_files():
         for file in files2:
             if file in seen_file:
                 if verbose:
@@ -154,25 +421,122 @@ def tpgrep(files: Union[list, str],
                 continue
             else:
                 seen_file[file] = True
+            if verbose:
+                log_FileFuncLine(f'grep {file}', file=sys.stderr)
+            yield file
+
+    files3 = iter_new_files()
+
+    if Follow and print_filename:
+        # every followed file blocks forever, so each one needs its own thread.
+        # grep_1_file() prints each line with one call, so lines are not mixed up.
+        threads = []
+        for file in files3:
+            t = threading.Thread(target=grep_1_file,
+                                 args=(file, plan),
+                                 kwargs=dict(FileNameOnly=FileNameOnly,
+                                             print_filename=print_filename,
+                                             **opt),
+                                 daemon=True)
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+    elif Parallel and Parallel > 1 and print_filename:
+        # the workers only collect lines; printing is done here, one file at a time,
+        # so that lines from different files are never interleaved.
+        grep_func = partial(grep_1_file,
+                            plan=plan,
+                            FileNameOnly=FileNameOnly,
+                            print_filename=print_filename,
+                            Engine=Engine,
+                            LastN=LastN,
+                            IndexRanges=IndexRanges,
+                            **opt)
+
+        with multiprocessing.Pool(processes=Parallel) as pool:
+            # stdin can only be read by this process. the pool greps the files up to
+            # stdin, then we grep stdin, then the pool goes on with the rest.
+            while True:
+                stdin_next = False
 
-            match = grep_1_file(file)
+                def pool_files():
+                    # the pool's feeder thread pulls the files from the walk as it goes
+                    nonlocal stdin_next
+                    for f in files3:
+                        if f == '-':
+                            stdin_next = True
+                            return
+                        yield f
+
+                # imap() returns results in the same order as pool_files(), which is
+                # the order the serial path uses.
+                for match in pool.imap(grep_func, pool_files(), chunksize=1):
+                    if print_output:
+                        for line in match:
+                            if FileNameOnly:
+                                print(line)
+                            else:
+                                print(line, end='')
+                    lines2.extend(match)
+
+                if not stdin_next:
+                    break
+                match = grep_1_file('-', plan,
+                                    FileNameOnly=FileNameOnly,
+                                    print_filename=print_filename,
+                                    Engine=Engine,
+                                    LastN=LastN,
+                                    IndexRanges=IndexRanges,
+                                    print_output=print_output,
+                                    **opt)
+                lines2.extend(match)
+    else:
+        for file in files3:
+            match = grep_1_file(file, plan,
+                                FileNameOnly=FileNameOnly,
+                                print_filename=print_filename,
+                                Engine=Engine,
+                                LastN=LastN,
+                                IndexRanges=IndexRanges,
+                                print_output=print_output,
+                                **opt)
             lines2.extend(match)
 
-        return lines2
+    return lines2
 
 
 def main():
     import os
+    import tpsup.tmptools
     TPSUP = os.environ.get('TPSUP')
     files1 = f'{TPSUP}/python3/scripts/ptgrep_test*'
     files2 = f'{TPSUP}/python3/lib/tpsup/searchtools_test*'
 
+    # binary mode must match the same lines as text mode on non-ascii data
+    text_file = f'{tpsup.tmptools.get_dailydir()}/ptgrep_nonascii.txt'
+    with open(text_file, 'w', encoding='utf-8') as fh:
+        fh.write('caf\u00e9x\nna\u00efve\n\u017fome\n\u212aelvin\nplain\n')
+    text_patterns = ['f' + chr(92) + 'wx', '^.{5}$', chr(92) + 'bve', 's', 'k', 'i', '\u00e9']
+
     def test_codes():
         tpgrep(files1, 'Mypattern', CaseInsensitive=True)
         tpgrep(files1, ExcludePattern='abc|def')
         tpgrep(files1, 'mypattern', FileNameOnly=True)
+        tpgrep(files1, 'Mypattern', CaseInsensitive=True, binary=True)
+        [tpgrep(text_file, p, binary=True) == tpgrep(text_file, p) for p in text_patterns]
+        [tpgrep(text_file, p, CaseInsensitive=True, binary=True) == tpgrep(text_file, p, CaseInsensitive=True)
+         for p in text_patterns]
+        tpgrep(files1, 'Mypattern', CaseInsensitive=True, Engine='mmap')
+        tpgrep(files1, chr(92) + 'u006dypattern', Engine='mmap')  # backslash-u006d is m, not a bytes escape
+        tpgrep(files1, 'mypattern', LastN=1)
+        tpgrep(files1, 'mypattern1', Index=f'{tpsup.tmptools.get_dailydir()}/ptgrep_index')
         tpgrep(files2, 'bc', FindFirstFile=True)
         tpgrep(files2, 'bc', FindFirstFile=True, sort_name='mtime')
+        tpgrep(files2, 'no_such_thing', FindFirstFile=True)  # None
+        tpgrep(files2, 'bc', Parallel=2)
+        tpgrep(files2, 'bc', Parallel=2) == tpgrep(files2, 'bc')  # True, same order
+        tpgrep(files2, 'bc', FileNameOnly=True, Parallel=2)
 
     from tpsup.testtools import test_lines
     test_lines(test_codes, source_globals=globals(), source_locals=locals())
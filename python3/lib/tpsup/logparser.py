@@ -3,6 +3,7 @@ import sys
 
 from tpsup.filetools import TpInput, sort_files, tpglob
 from tpsup.modtools import load_module
+from tpsup.patterntools import get_match_plan
 
 
 def get_logs(log, LogLastCount: int = 0, **opt):
@@ -41,19 +42,20 @@ def get_log_section_gen(log, section_cfg, **opt):
     # PostPattern/PostPattern are tried after BeginPattern/EndPattern are tried
     # they are for both speedup and reduce noise,
 
-    CompiledPreMatch = None
-    CompiledPreExclude = None
-    if PreMatch := section_cfg.get('PreMatch', None):
-        CompiledPreMatch = re.compile(PreMatch)
-    if PreExclude := section_cfg.get('PreExclude', None):
-        CompiledPreExclude = re.compile(PreExclude)
-
-    CompiledPostMatch = None
-    CompiledPostExclude = None
-    if PostMatch := section_cfg.get('PostMatch', None):
-        CompiledPostMatch = re.compile(PostMatch)
-    if PostExclude := section_cfg.get('PostExclude', None):
-        CompiledPostExclude = re.compile(PostExclude)
+    # the plans check required literals before running the regex engine.
+    PreMatch = section_cfg.get('PreMatch', None)
+    PreExclude = section_cfg.get('PreExclude', None)
+    PrePlan = None
+    if PreMatch or PreExclude:
+        PrePlan = get_match_plan([PreMatch] if PreMatch else None,
+                                 [PreExclude] if PreExclude else None)
+
+    PostMatch = section_cfg.get('PostMatch', None)
+    PostExclude = section_cfg.get('PostExclude', None)
+    PostPlan = None
+    if PostMatch or PostExclude:
+        PostPlan = get_match_plan([PostMatch] if PostMatch else None,
+                                  [PostExclude] if PostExclude else None)
 
     mod_source = ''
     for exp in ['ItemMatchExp', 'ItemExcludeExp']:
@@ -126,16 +128,30 @@ def get_log_section_gen(log, section_cfg, **opt):
     logs = get_logs(log, **opt)
     reset_item()
 
+    tpi_opt = {**opt}
+    for k in ['gzindex', 'tail', 'readahead', 'readahead_block', 'readahead_depth']:
+        # a sidecar gzip index lets a 'tail' read jump to the end of a rotated .gz log.
+        # read-ahead decompresses .gz logs in a background thread.
+        if k in section_cfg:
+            tpi_opt[k] = section_cfg[k]
+
+    if opt.get('binary', False):
+        # binary mode: push PreMatch/PreExclude down to TpInput so that they are
+        # tried on raw bytes and the filtered-out lines are never decoded.
+        if PreMatch:
+            tpi_opt['MatchPatterns'] = list(opt.get('MatchPatterns', [])) + [PreMatch]
+        if PreExclude:
+            tpi_opt['ExcludePatterns'] = list(opt.get('ExcludePatterns', [])) + [PreExclude]
+        PrePlan = None
+
     for lg in logs:
-        with TpInput(filename=lg, **opt) as tf:
+        with TpInput(filename=lg, **tpi_opt) as tf:
             try:
                 for line in tf:  # this line may raise exception for binary file. so use try/except
                     if verbose > 2:
                         print(f'line={line}', file=sys.stderr)
 
-                    if CompiledPreMatch and not CompiledPreMatch.search(line):
-                        continue
-                    if CompiledPreExclude and CompiledPreExclude.search(line):
+                    if PrePlan and not PrePlan.matches(line):
                         continue
 
                     if CompiledBegin and CompiledBegin.search(line):
@@ -188,8 +204,7 @@ def get_log_section_gen(log, section_cfg, **opt):
                         # we don't need to do any of below as they will be taken care of by loop
                         # line = None
                         # continue
-                    elif (CompiledPostMatch and not CompiledPostMatch.search(line)) or \
-                         (CompiledPostExclude and CompiledPostExclude.search(line)):
+                    elif PostPlan and not PostPlan.matches(line):
                         continue
                     else:
                         if started:
@@ -271,6 +286,7 @@ def main():
         get_logs(f'{TPSUP}/python3/lib/tpsup/*py', LogLastCount=5)
         get_log_section_headers(section_cfg['ExtractPatterns'])
         get_log_sections(log, section_cfg, MaxCount=7)
+        get_log_sections(log, section_cfg, MaxCount=7, binary=True)
         section_cfg.update({'ItemMatchExp': '"TRD-0002" in r["TradeId"]'})
         get_log_sections(log, section_cfg)
 
@@ -1,5 +1,6 @@
 import pprint
 
+import ast
 import inspect
 import re
 import sys
@@ -113,6 +114,105 @@ def strings_to_compilable_func(strings: List, func_name: str, logic: str = 'and'
     return '\n'.join(statements)
 
 
+# re functions whose 1st arg is the pattern, and the position of their flags arg
+re_flags_pos_by_func = {
+    'compile': 1,
+    'search': 2,
+    'match': 2,
+    'fullmatch': 2,
+    'findall': 2,
+    'finditer': 2,
+    'split': 3,
+    'sub': 4,
+    'subn': 4,
+}
+
+
+def is_re_flags(node: ast.AST) -> bool:
+    """ whether the node is a constant flags expression, eg, re.I | re.M """
+    if isinstance(node, ast.Constant):
+        return isinstance(node.value, int)
+    if isinstance(node, ast.Attribute):
+        return isinstance(node.value, ast.Name) and node.value.id == 're'
+    if isinstance(node, ast.BinOp) and isinstance(node.op, ast.BitOr):
+        return is_re_flags(node.left) and is_re_flags(node.right)
+    return False
+
+
+class ReLiteralHoister(ast.NodeTransformer):
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        self.compiled_list = []  # source of each re.compile() hoisted
+
+    def visit_Call(self, node: ast.Call):
+        self.generic_visit(node)
+
+        func = node.func
+        if not (isinstance(func, ast.Attribute) and isinstance(func.value, ast.Name)
+                and func.value.id == 're' and func.attr in re_flags_pos_by_func):
+            return node
+        if not node.args or not isinstance(node.args[0], ast.Constant) \
+                or not isinstance(node.args[0].value, (str, bytes)):
+            return node
+
+        flags_pos = re_flags_pos_by_func[func.attr]
+        args = node.args[1:]
+        keywords = list(node.keywords)
+        flags = None
+        if len(node.args) > flags_pos:
+            flags = node.args[flags_pos]
+            args = node.args[1:flags_pos] + node.args[flags_pos + 1:]
+        for kw in keywords:
+            if kw.arg == 'flags':
+                flags = kw.value
+                keywords.remove(kw)
+                break
+            if kw.arg is None:
+                # **kwargs may hold the flags
+                return node
+        if flags is not None and not is_re_flags(flags):
+            return node
+
+        compile_args = [ast.unparse(node.args[0])]
+        if flags is not None:
+            compile_args.append(ast.unparse(flags))
+        name = f'{self.prefix}{len(self.compiled_list)}'
+        self.compiled_list.append(f'{name} = re.compile({", ".join(compile_args)})')
+
+        if func.attr == 'compile':
+            return ast.copy_location(ast.Name(id=name, ctx=ast.Load()), node)
+        new_func = ast.Attribute(value=ast.Name(id=name, ctx=ast.Load()), attr=func.attr, ctx=ast.Load())
+        return ast.copy_location(ast.Call(func=new_func, args=args, keywords=keywords), node)
+
+
+def hoist_re_literals(strings: List, prefix: str = '_re', **opt) -> tuple:
+    """
+    rewrite re.search('literal', ...) and the like in the expression strings into
+    calls of pre-compiled patterns. return (new_strings, compiled_list), where
+    compiled_list is the source of the module-level re.compile() statements.
+
+        hoist_re_literals(["re.search(r'^B', r['side'])"])
+        => (["_re0.search(r['side'])"], ["_re0 = re.compile('^B')"])
+
+    an expression we cannot parse is left as is.
+    """
+    hoister = ReLiteralHoister(prefix)
+    new_strings = []
+    for s in strings:
+        try:
+            tree = ast.parse(s.strip(), mode='eval')
+        except SyntaxError:
+            new_strings.append(s)
+            continue
+        before = len(hoister.compiled_list)
+        tree = hoister.visit(tree)
+        if len(hoister.compiled_list) == before:
+            new_strings.append(s)
+        else:
+            new_strings.append(ast.unparse(tree))
+    return new_strings, hoister.compiled_list
+
+
 def load_module(source: Union[str, types.CodeType, types.FunctionType],
                 new_module_name: str = None,
                 function_name: str = "default_function",
@@ -378,6 +478,12 @@ test_dict = {'a': {'b': 1}, 'c': 'hello'}
         print(f'{k}({r2}) = {exp(r2)}')
         print(f'{k}({r3}) = {exp(r3)}')
 
+    print()
+    print("------------------------------------------------")
+    strings = ["re.search(r'^B', r['side'])", "re.sub('a', 'b', r['x'], flags=re.I)", "re.match(p, r['x'])"]
+    print(f'strings = {pformat(strings)}')
+    print(f'hoist_re_literals(strings) = {pformat(hoist_re_literals(strings))}')
+
     print()
     print("------------------------------------------------")
     print("test injecting code into existing module")
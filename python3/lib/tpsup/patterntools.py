@@ -0,0 +1,347 @@
+import re
+from functools import lru_cache
+
+try:
+    # python 3.11 renamed sre_parse to re._parser
+    import re._parser as sre_parse
+    import re._constants as sre_constants
+except ImportError:
+    import sre_parse
+    import sre_constants
+
+
+def get_required_literals(pattern: str, flags: int = 0) -> list:
+    """
+    return the literal substrings that every match of the pattern must contain.
+    return [] if we cannot tell, eg, the pattern is case-insensitive or has alternations
+    at the top level.
+
+    get_required_literals('35=D')           => ['35=D']
+    get_required_literals('orderid=ORD\\d+') => ['orderid=ORD']
+    get_required_literals('(abc|def)')      => []
+    """
+    if flags & re.IGNORECASE:
+        return []
+
+    try:
+        parsed = sre_parse.parse(pattern, flags)
+    except Exception:
+        return []
+
+    if parsed.state.flags & re.IGNORECASE:
+        # inline (?i)
+        return []
+
+    literals = []
+    current = []
+
+    def flush():
+        nonlocal current
+        if current:
+            literals.append(''.join(current))
+        current = []
+
+    def walk(items):
+        for op, av in items:
+            if op == sre_constants.LITERAL:
+                current.append(chr(av))
+            elif op == sre_constants.AT:
+                # zero-width anchor, eg, ^ $ \b. the run of literals around it is still contiguous.
+                continue
+            elif op == sre_constants.SUBPATTERN:
+                # (group, add_flags, del_flags, sub_pattern)
+                add_flags = av[1]
+                if add_flags & re.IGNORECASE:
+                    flush()
+                    continue
+                # a plain group is matched exactly once; its literals join the current run
+                walk(av[-1])
+            elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+                # (min, max, sub_pattern)
+                flush()
+                if av[0] >= 1:
+                    # the repeated part appears at least once. its own literals are required,
+                    # but they cannot be joined with the neighbors.
+                    walk(av[2])
+                    flush()
+            else:
+                flush()
+
+    walk(parsed)
+    flush()
+
+    return literals
+
+
+def is_literal_pattern(pattern: str, flags: int = 0) -> bool:
+    """
+    whether the pattern only matches its own text, eg, '35=D', 'orderid=' or 'a\\.b'.
+    """
+    if flags & re.IGNORECASE:
+        return False
+    try:
+        parsed = sre_parse.parse(pattern, flags)
+    except Exception:
+        return False
+    if parsed.state.flags & re.IGNORECASE:
+        return False
+    return len(parsed) > 0 and all(op == sre_constants.LITERAL for op, av in parsed)
+
+
+def is_fusable_pattern(pattern: str, flags: int = 0) -> bool:
+    """
+    whether the pattern can be wrapped as '(?:pattern)' in an alternation.
+    patterns with global inline flags, backreferences or named groups cannot.
+    """
+    try:
+        parsed = sre_parse.parse(pattern, flags)
+    except Exception:
+        return False
+
+    if parsed.state.flags & ~(flags | re.UNICODE):
+        # global inline flags, eg, (?i) at the beginning
+        return False
+
+    if parsed.state.groupdict:
+        return False
+
+    def has_groupref(items) -> bool:
+        for op, av in items:
+            if op in (sre_constants.GROUPREF, sre_constants.GROUPREF_EXISTS):
+                return True
+            if isinstance(av, (list, tuple)):
+                for x in av:
+                    if isinstance(x, sre_parse.SubPattern) and has_groupref(x):
+                        return True
+                    if isinstance(x, (list, tuple)):
+                        for y in x:
+                            if isinstance(y, sre_parse.SubPattern) and has_groupref(y):
+                                return True
+            elif isinstance(av, sre_parse.SubPattern) and has_groupref(av):
+                return True
+        return False
+
+    return not has_groupref(parsed)
+
+
+# regex pieces that behave differently on a bytes line than on a decoded line:
+#   - '.', '\w', '\s', '\d', '\b', [^...] match one byte in bytes but one char in str,
+#     and the classes are ascii-only in bytes.
+#   - '\xNN', '\uNNNN', '\UNNNNNNNN', '\N{...}' and octal escapes can name a non-ascii char,
+#     which is more than one byte in utf-8. bytes patterns reject '\u', '\U' and '\N'.
+# a non-ascii char in a pattern is also more than one byte, eg, 'é{2}' or '[éè]'.
+bytes_unsafe_pattern = re.compile(r'\.|\\[wWsSdDbBxuUN0-7]|\[\^')
+
+# with IGNORECASE, a str pattern folds i, k and s to non-ascii chars too, eg, 'k' matches
+# the kelvin sign; a bytes pattern does not. a [...] class can hold these letters in a range.
+ignorecase_unsafe_pattern = re.compile(r'[iksIKS]|\[')
+
+
+def is_bytes_safe_pattern(compiled: re.Pattern) -> bool:
+    """
+    return True if the compiled str pattern matches the same lines when it is
+    compiled as bytes and run on the raw utf-8 lines.
+    """
+    pattern = compiled.pattern
+    if not pattern.isascii() or bytes_unsafe_pattern.search(pattern):
+        return False
+    # compiled.flags also has the inline flags, eg, (?i)
+    if compiled.flags & re.IGNORECASE and not compiled.flags & re.ASCII:
+        if ignorecase_unsafe_pattern.search(pattern):
+            return False
+    return True
+
+
+class TextPattern:
+    """
+    a str pattern used on bytes lines: each line is decoded before the search.
+    MatchPlan(binary=True) uses it for the patterns that are not safe on bytes.
+    """
+
+    def __init__(self, compiled: re.Pattern):
+        self.compiled = compiled
+        self.pattern = compiled.pattern
+        self.flags = compiled.flags
+
+    def search(self, line: bytes):
+        return self.compiled.search(line.decode('utf-8', errors='replace'))
+
+    def __repr__(self):
+        return f'TextPattern({self.compiled!r})'
+
+
+class MatchPlan:
+    """
+    a plan to test lines against MatchPatterns (AND logic) and ExcludePatterns (OR logic).
+
+    - each MatchPattern is first checked by a required literal with a cheap 'in' test.
+      a pure literal pattern, eg, '35=D', never runs the regex engine at all.
+    - pure literal ExcludePatterns are checked with 'in'; the rest are fused into one
+      alternation regex, so each line runs the regex engine at most once for excludes.
+
+    binary=True works on bytes lines, eg, from TpInput(binary=True). literals are
+    checked on the raw bytes. a pattern that would match differently as bytes, eg,
+    with '.' or '\w', or non-ascii, is kept as a str pattern and decodes the line first,
+    so binary mode matches the same lines as text mode.
+
+    the plan only holds strings and compiled patterns, so it can be sent to a process pool.
+    """
+
+    def __init__(self,
+                 MatchPatterns: list = None,
+                 ExcludePatterns: list = None,
+                 CaseInsensitive: bool = False,
+                 binary: bool = False,
+                 **opt):
+        self.MatchPatterns = list(MatchPatterns) if MatchPatterns else []
+        self.ExcludePatterns = list(ExcludePatterns) if ExcludePatterns else []
+        self.binary = binary
+
+        flags = re.IGNORECASE if CaseInsensitive else 0
+        self.flags = flags
+
+        # full compiled patterns, for the callers that need them, eg, mmap engine
+        self.match_compiled = [self.compile(p) for p in self.MatchPatterns]
+        self.exclude_compiled = [self.compile(p) for p in self.ExcludePatterns]
+
+        # list of (literal, compiled). either can be None.
+        self.match_items = []
+        for p, compiled in zip(self.MatchPatterns, self.match_compiled):
+            literals = get_required_literals(p, flags)
+            if is_literal_pattern(p, flags):
+                # eg, 'a\.b' is the literal 'a.b'
+                self.match_items.append((self.encode(literals[0]), None))
+                continue
+            if literals:
+                literal = self.encode(max(literals, key=len))
+            else:
+                literal = None
+            self.match_items.append((literal, compiled))
+
+        self.exclude_literals = []
+        fusable = []
+        self.exclude_items = []  # compiled patterns that cannot be fused
+        for p, compiled in zip(self.ExcludePatterns, self.exclude_compiled):
+            if is_literal_pattern(p, flags):
+                self.exclude_literals.append(self.encode(get_required_literals(p, flags)[0]))
+            elif is_fusable_pattern(p, flags):
+                fusable.append(p)
+            else:
+                self.exclude_items.append(compiled)
+
+        if len(fusable) == 1:
+            self.exclude_items.append(self.compile(fusable[0]))
+        elif fusable:
+            fused = '|'.join([f'(?:{p})' for p in fusable])
+            try:
+                self.exclude_items.append(self.compile(fused))
+            except re.error:
+                self.exclude_items.extend([self.compile(p) for p in fusable])
+
+    def encode(self, string: str):
+        return string.encode('utf-8') if self.binary else string
+
+    def compile(self, pattern: str):
+        compiled = re.compile(pattern, self.flags)
+        if not self.binary:
+            return compiled
+        if is_bytes_safe_pattern(compiled):
+            try:
+                return re.compile(self.encode(pattern), self.flags)
+            except re.error:
+                # eg, an inline (?u), which bytes patterns do not take
+                pass
+        return TextPattern(compiled)
+
+    def matches(self, line) -> bool:
+        """
+        return True if the line matches all MatchPatterns and none of ExcludePatterns
+        """
+        for literal, compiled in self.match_items:
+            if literal is not None and literal not in line:
+                return False
+            if compiled is not None and not compiled.search(line):
+                return False
+
+        for literal in self.exclude_literals:
+            if literal in line:
+                return False
+
+        for compiled in self.exclude_items:
+            if compiled.search(line):
+                return False
+
+        return True
+
+    def is_empty(self) -> bool:
+        return not self.MatchPatterns and not self.ExcludePatterns
+
+    def get_scan_literal(self):
+        """
+        return the longest literal that every matched line must contain, or None.
+        """
+        literals = [literal for literal, compiled in self.match_items if literal is not None]
+        if not literals:
+            return None
+        return max(literals, key=len)
+
+
+@lru_cache(maxsize=256)
+def get_match_plan_by_key(MatchPatterns: tuple, ExcludePatterns: tuple,
+                          CaseInsensitive: bool, binary: bool) -> MatchPlan:
+    return MatchPlan(list(MatchPatterns), list(ExcludePatterns),
+                     CaseInsensitive=CaseInsensitive, binary=binary)
+
+
+def get_match_plan(MatchPatterns: list = None,
+                   ExcludePatterns: list = None,
+                   CaseInsensitive: bool = False,
+                   binary: bool = False,
+                   **opt) -> MatchPlan:
+    """
+    return a shared MatchPlan, so that callers building the same plan again and again,
+    eg, tpfind's getline() for every node, only build it once.
+    the cache keeps the most recently used plans, so a long-running caller
+    with ever-changing patterns does not grow it without bound.
+    """
+    return get_match_plan_by_key(tuple(MatchPatterns or []), tuple(ExcludePatterns or []),
+                                 bool(CaseInsensitive), bool(binary))
+
+
+def main():
+    plan = get_match_plan(['35=D', r'orderid=ORD\d+'], ['Smith', r'cancel\w+', 'reject(ed)?'])
+    plan_escaped = get_match_plan([r're\.compile'], [])
+    plan_bytes = get_match_plan(['35=D'], ['Smith'], binary=True)
+    plan_text = get_match_plan([r'caf\w'], ['^.{5}$'], binary=True)
+    cafe4 = 'caf\u00e9\n'.encode('utf-8')  # 4 chars, 5 bytes
+    cafe5 = 'caf\u00e9s\n'.encode('utf-8')  # 5 chars
+
+    def test_codes():
+        get_required_literals('35=D')  # ['35=D']
+        get_required_literals(r'orderid=ORD\d+')  # ['orderid=ORD']
+        get_required_literals(r'^(abc)+x\d')  # ['abc', 'x']
+        get_required_literals('(abc|def)')  # []
+        get_required_literals('abc', re.IGNORECASE)  # []
+        is_literal_pattern('35=D')  # True
+        is_literal_pattern(r'a\.b')  # True
+        is_literal_pattern('a.b')  # False
+        is_fusable_pattern(r'(a)\1')  # False
+        plan.match_items
+        plan.exclude_items
+        plan.matches('8=FIX|35=D|orderid=ORD123|')  # True
+        plan.matches('8=FIX|35=D|orderid=ORD123|Smith')  # False
+        plan.matches('8=FIX|35=D|orderid=ORD123|rejected')  # False
+        plan.matches('8=FIX|35=F|orderid=ORD123|')  # False
+        plan_bytes.matches(b'8=FIX|35=D|')  # True
+        plan_escaped.matches('x = re.compile(p)')  # True
+        get_match_plan(['35=D'], ['Smith'], binary=True) is plan_bytes  # True
+        plan_text.match_items  # the \w pattern decodes the line first
+        plan_text.matches(cafe4)  # True, like text mode
+        plan_text.matches(cafe5)  # False, excluded by ^.{5}$
+
+    from tpsup.testtools import test_lines
+    test_lines(test_codes, source_globals=globals(), source_locals=locals())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+import gzip
+import json
+import os
+import sys
+import time
+from tpsup.filetools import tpfind_iter
+from tpsup.logbasic import log_FileFuncLine
+
+record_fields = ('path', 'ino', 'size', 'mtime', 'mode')
+
+
+def take_snapshot(paths: list, Listings: dict = None, **opt) -> dict:
+    """
+    walk the paths with tpfind_iter and return a snapshot
+        {'paths': [...], 'time': ..., 'records': [...], 'listings': {...}}
+
+    records is a list of (path, ino, size, mtime, mode), sorted by path, of the nodes
+    matched by MatchExps, if any. listings is {dir: (mtime_ns, [names])} of the
+    directories walked, whatever the MatchExps.
+
+    Listings=<an old snapshot's listings> reuses the names of the directories whose
+    mtime has not changed, instead of reading them again. the nodes are still stat'ed,
+    because changing a file does not change its directory's mtime. a directory changed
+    just before it was listed is always read again, see tpfind_iter().
+    """
+    if isinstance(paths, str):
+        paths = [paths]
+
+    listings = {}
+    records = []
+    for r in tpfind_iter(paths, no_print=True, Listings=Listings, ListingsOut=listings, **opt):
+        records.append((r['path'], r['ino'], r['size'], r['mtime'], r['mode']))
+    records.sort()
+
+    return {'paths': list(paths), 'time': time.time(), 'records': records, 'listings': listings}
+
+
+def save_snapshot(snapshot: dict, file: str, **opt):
+    """
+    save the snapshot as gzipped json lines: a header, then one array per record, in
+    path order, then one object per directory listing.
+    """
+    verbose = opt.get('verbose', 0)
+
+    # write to a tmp file first, so that a failed walk never leaves a half snapshot
+    tmp_file = f'{file}.tmp{os.getpid()}'
+    with gzip.open(tmp_file, 'wt', encoding='utf-8', errors='surrogateescape') as fh:
+        header = {'snapshot': 1, 'paths': snapshot['paths'], 'time': snapshot['time']}
+        fh.write(json.dumps(header) + '\n')
+        for record in snapshot['records']:
+            fh.write(json.dumps(record, separators=(',', ':')) + '\n')
+        for d in sorted(snapshot['listings']):
+            mtime_ns, names = snapshot['listings'][d]
+            fh.write(json.dumps({'dir': d, 'mtime_ns': mtime_ns, 'names': names},
+                                separators=(',', ':')) + '\n')
+    os.replace(tmp_file, file)
+
+    if verbose:
+        log_FileFuncLine(f'saved {len(snapshot["records"])} records, '
+                         f'{len(snapshot["listings"])} listings to {file}', file=sys.stderr)
+
+
+def load_snapshot(file: str, **opt) -> dict:
+    snapshot = {'records': [], 'listings': {}}
+    with gzip.open(file, 'rt', encoding='utf-8', errors='surrogateescape') as fh:
+        header = json.loads(fh.readline())
+        if header.get('snapshot') != 1:
+            raise RuntimeError(f'{file} is not a snapshot file')
+        snapshot['paths'] = header['paths']
+        snapshot['time'] = header['time']
+        for line in fh:
+            item = json.loads(line)
+            if isinstance(item, list):
+                snapshot['records'].append(tuple(item))
+            else:
+                snapshot['listings'][item['dir']] = (item['mtime_ns'], item['names'])
+    return snapshot
+
+
+def diff_snapshots(old: dict, new: dict) -> list:
+    """
+    return [(status, path, changed_fields)] in path order, status is 'added', 'removed'
+    or 'changed'. changed_fields is a list of the record fields that differ.
+    """
+    a = old['records']
+    b = new['records']
+    i = j = 0
+    diffs = []
+    while i < len(a) or j < len(b):
+        if j >= len(b) or (i < len(a) and a[i][0] < b[j][0]):
+            diffs.append(('removed', a[i][0], []))
+            i += 1
+        elif i >= len(a) or b[j][0] < a[i][0]:
+            diffs.append(('added', b[j][0], []))
+            j += 1
+        else:
+            changed_fields = [record_fields[k] for k in range(1, len(record_fields))
+                              if a[i][k] != b[j][k]]
+            if changed_fields:
+                diffs.append(('changed', b[j][0], changed_fields))
+            i += 1
+            j += 1
+    return diffs
+
+
+def print_diffs(diffs: list, file=sys.stdout):
+    for status, path, changed_fields in diffs:
+        if changed_fields:
+            print(f'{status:8} {path} ({",".join(changed_fields)})', file=file)
+        else:
+            print(f'{status:8} {path}', file=file)
+
+
+def main():
+    import shutil
+    import tpsup.tmptools
+    test_dir = f'{tpsup.tmptools.get_dailydir()}/snapshot_test'
+    shutil.rmtree(test_dir, ignore_errors=True)
+    os.makedirs(f'{test_dir}/tree/sub')
+    for f in ['a.txt', 'b.txt', 'sub/c.txt']:
+        with open(f'{test_dir}/tree/{f}', 'w') as fh:
+            fh.write('hello\n')
+    snapshot_file = f'{test_dir}/snapshot.json.gz'
+
+    old = take_snapshot([f'{test_dir}/tree'], Sorted=True)
+    save_snapshot(old, snapshot_file)
+    old = load_snapshot(snapshot_file)
+
+    # a new directory, changed again within the same mtime tick as its listing
+    os.makedirs(f'{test_dir}/fresh')
+    fresh = take_snapshot([f'{test_dir}/fresh'], Sorted=True)
+    fresh_mtime_ns = os.stat(f'{test_dir}/fresh').st_mtime_ns
+    with open(f'{test_dir}/fresh/e.txt', 'w') as fh:
+        fh.write('new\n')
+    os.utime(f'{test_dir}/fresh', ns=(fresh_mtime_ns, fresh_mtime_ns))
+
+    os.remove(f'{test_dir}/tree/b.txt')
+    with open(f'{test_dir}/tree/d.txt', 'w') as fh:
+        fh.write('new\n')
+    with open(f'{test_dir}/tree/sub/c.txt', 'a') as fh:
+        fh.write('world\n')
+
+    def test_codes():
+        len(old['records'])  # 5
+        sorted(os.path.basename(d) for d in old['listings'])  # ['sub', 'tree']
+        [(s, os.path.basename(p)) for s, p, f in diff_snapshots(old, take_snapshot([f'{test_dir}/tree']))]
+        [f for s, p, f in diff_snapshots(old, take_snapshot([f'{test_dir}/tree'], Listings=old['listings']))
+         if p.endswith('c.txt')]
+        fresh['listings'][f'{test_dir}/fresh']  # (None, []), too new to reuse
+        [(s, os.path.basename(p)) for s, p, f in diff_snapshots(
+            fresh, take_snapshot([f'{test_dir}/fresh'], Listings=fresh['listings']))]  # [('added', 'e.txt')]
+
+    from tpsup.testtools import test_lines
+    test_lines(test_codes, source_globals=globals(), source_locals=locals())
+
+
+if __name__ == '__main__':
+    main()
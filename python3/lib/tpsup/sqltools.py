@@ -385,10 +385,9 @@ def run_sql(sql: Union[str, list], **opt):
                 if qr.ReturnType == 'DictList':
                     ret3 = ret2
                 else:
-                    # convert ListList to DictList
-                    ret3 = []
-                    for row in ret2:
-                        ret3.append(dict(zip(qr.columns, row)))
+                    # the rows are already lists in column order; write them as they are.
+                    # skip ret2[0], the header.
+                    ret3 = ret2[1:]
                 tpsup.csvtools.write_dictlist_to_csv(
                     ret3, qr.columns, outfile, **opt)
 
@@ -10,7 +10,7 @@ from tpsup.logparser import get_log_section_headers, get_log_sections
 
 from tpsup.printtools import render_arrays, string_short
 from tpsup.sqltools import get_dbh, run_sql
-from tpsup.filetools import tpfind, tpglob
+from tpsup.filetools import TpInput, tpfind_iter, tpglob
 from tpsup.logtools import get_exception_string, get_stack, print_exception
 from tpsup.logbasic import log_FileFuncLine
 from tpsup.utilbasic import arrays_to_hashes, get_keys_from_array, get_node_list, hashes_to_arrays, unify_array_hash, unify_hash_hash
@@ -555,7 +555,16 @@ def process_log(entity: str,
     MaxExtracts = opt.get('MaxExtracts', None)
 
     for l in resolved_logs:
-        with open(l, 'r') as fh:
+        gzindex = method_cfg.get('gzindex', False)
+        tail = method_cfg.get('tail', None)
+        if l.endswith('.gz') or gzindex or tail is not None:
+            # TpInput reads .gz logs too. with 'gzindex', a sidecar index lets 'tail'
+            # jump to the end of a rotated .gz log instead of decompressing all of it.
+            # newline=None gives the same lines as open().
+            log_fh = TpInput(filename=l, gzindex=gzindex, tail=tail, newline=None, verbose=verbose)
+        else:
+            log_fh = open(l, 'r')
+        with log_fh as fh:
             print(f"extract info from {l}\n")
             h, extracts = extract_from_fh(
                 fh,
@@ -618,11 +627,7 @@ def extract_from_fh(fh, extract_pattern: str, **opt):
     if verbose:
         log_FileFuncLine("\n---- match begin -----\n")
 
-    while True:
-        line = fh.readline()
-        if not line:
-            break
-
+    for line in fh:
         if CompiledMatch and not CompiledMatch.search(line):
             continue
         if CompiledExclude and CompiledExclude.search(line):
@@ -1051,10 +1056,10 @@ def process_path(entity: str, method_cfg: dict, **opt):
 
     verbose and print(f"opt2 = {pformat(opt2)}")
 
-    result = tpfind(**opt2)
-
-    rc = result['error']
-    hashes = result['hashes']
+    # the nodes are the global buffer for post_code and the output. tpfind_iter()
+    # stops at MaxCount during the walk, and each node's fields are only computed if used.
+    hashes = list(tpfind_iter(**opt2))
+    rc = 0
     row_count = len(hashes)
 
 
@@ -1075,12 +1080,13 @@ method_syntax = {
     },
     'log': {
         'required': ['log', 'extract'],
-        'optional': ['MatchPattern', 'ExcludePattern'],
+        'optional': ['MatchPattern', 'ExcludePattern', 'gzindex', 'tail'],
     },
     'section': {
         'required': ['log', 'ExtractPatterns'],
         'optional': ['PreMatch', 'PreExclude', 'PostMatch', 'PostExclude', 
-                     'BeginPattern', 'EndPattern', 'KeyType', 'KeyDefault'],
+                     'BeginPattern', 'EndPattern', 'KeyType', 'KeyDefault',
+                     'gzindex', 'tail', 'readahead', 'readahead_block', 'readahead_depth'],
     },
     'path': {
         'required': ['paths'],
@@ -0,0 +1,342 @@
+import gzip
+import os
+import sqlite3
+import sys
+import time
+from tpsup.logbasic import log_FileFuncLine
+from tpsup.patterntools import get_required_literals
+
+try:
+    # numpy makes the trigram extraction about 10x faster. pure python works too.
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def get_trigrams(data: bytes) -> list:
+    """
+    return the distinct trigrams of the data, each as an int: (b0 << 16) | (b1 << 8) | b2.
+    """
+    if len(data) < 3:
+        return []
+    if np is not None:
+        a = np.frombuffer(data, dtype=np.uint8).astype(np.uint32)
+        t = (a[:-2] << 16) | (a[1:-1] << 8) | a[2:]
+        return np.unique(t).tolist()
+    return [(b0 << 16) | (b1 << 8) | b2 for b0, b1, b2 in set(zip(data, data[1:], data[2:]))]
+
+
+def get_pattern_trigrams(MatchPatterns: list, CaseInsensitive: bool = False) -> set:
+    """
+    return the trigrams that every line matching all MatchPatterns must contain.
+    an empty set means we cannot narrow, eg, no literal of 3 or more bytes, or
+    CaseInsensitive, where unicode case folding could match other bytes.
+    """
+    trigrams = set()
+    if CaseInsensitive:
+        return trigrams
+
+    for p in MatchPatterns:
+        for literal in get_required_literals(p):
+            if '\ufffd' in literal:
+                # a replacement char can come from any bad byte when decoding with errors='replace'
+                continue
+            trigrams.update(get_trigrams(literal.encode('utf-8')))
+    return trigrams
+
+
+class TrigramIndex:
+    """
+    a persistent trigram index of files, to narrow repeated searches over the same
+    log trees.
+
+    each file is cut into blocks of about block_size bytes, ending at a newline. for
+    each trigram, the index keeps a bitmap of the blocks that contain it. a line
+    matching a pattern must contain all trigrams of the pattern's required literals,
+    so only the blocks having all of them need to be grepped.
+
+    the index is a sqlite db in index_dir. a file is (re)indexed when its mtime, size
+    or inode changes, so the index never causes a false negative. .gz files are
+    indexed on their uncompressed content, but only narrowed to the file, not blocks.
+    the rows of removed or renamed files are purged when a search updates their directory.
+
+    more than one process can use the same index. a writer waits up to busy_timeout
+    seconds for another; if the db stays locked, the search goes on without the index.
+    """
+
+    def __init__(self, index_dir: str, block_size: int = 1024 * 1024, busy_timeout: float = 10, **opt):
+        self.verbose = opt.get('verbose', 0)
+        self.index_dir = index_dir
+        self.block_size = block_size
+
+        os.makedirs(index_dir, exist_ok=True)
+        self.db_file = os.path.join(index_dir, 'trigram.db')
+        self.conn = sqlite3.connect(self.db_file, timeout=busy_timeout)
+        try:
+            self.create_tables()
+        except sqlite3.OperationalError as e:
+            log_FileFuncLine(f'cannot use {self.db_file}: {e}. search without the index', file=sys.stderr)
+            self.close()
+
+    def create_tables(self):
+        # readers do not wait for a writer in WAL mode
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS files (
+                id INTEGER PRIMARY KEY,
+                path TEXT UNIQUE,
+                mtime REAL,
+                size INTEGER,
+                ino INTEGER,
+                blocks TEXT
+            );
+            CREATE TABLE IF NOT EXISTS postings (
+                trigram INTEGER,
+                file_id INTEGER,
+                bitmap BLOB,
+                PRIMARY KEY (trigram, file_id)
+            ) WITHOUT ROWID;
+        ''')
+
+    def close(self):
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exec_type, exc_value, traceback):
+        self.close()
+
+    def is_index_file(self, path: str) -> bool:
+        return os.path.abspath(path).startswith(os.path.abspath(self.index_dir) + os.sep)
+
+    def update(self, files: list) -> list:
+        """
+        index the new or changed files. return the list of files (re)indexed.
+        """
+        updated = []
+        live = set()
+        dirs = set()
+        for f in files:
+            if f == '-' or self.is_index_file(f):
+                continue
+            path = os.path.abspath(f)
+            dirs.add(os.path.dirname(path))
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            live.add(path)
+
+            row = self.conn.execute('SELECT id, mtime, size, ino FROM files WHERE path = ?',
+                                    (path,)).fetchone()
+            if row and tuple(row[1:]) == (st.st_mtime, st.st_size, st.st_ino):
+                continue
+
+            self.index_file(path, st, file_id=row[0] if row else None)
+            updated.append(f)
+
+        self.purge(live, dirs)
+        return updated
+
+    def purge(self, live: set, dirs: set):
+        """
+        remove the rows of the files that no longer exist, eg, removed or renamed, in the
+        dirs walked by update(). the live files were just stat'ed; only the other indexed
+        files in these dirs are checked, so a search does not stat the whole index.
+        """
+        gone = []
+        for d in dirs:
+            prefix = os.path.join(d, '')
+            for file_id, path in self.conn.execute('SELECT id, path FROM files WHERE path > ? AND path < ?',
+                                                   (prefix, prefix + '\U0010ffff')).fetchall():
+                if path in live or os.path.dirname(path) != d:
+                    continue
+                if not os.path.exists(path):
+                    gone.append((file_id,))
+        if not gone:
+            return
+        with self.conn:
+            self.conn.executemany('DELETE FROM postings WHERE file_id = ?', gone)
+            self.conn.executemany('DELETE FROM files WHERE id = ?', gone)
+        if self.verbose:
+            log_FileFuncLine(f'purged {len(gone)} files that no longer exist', file=sys.stderr)
+
+    def index_file(self, path: str, st: os.stat_result, file_id: int = None):
+        if self.verbose:
+            log_FileFuncLine(f'indexing {path}', file=sys.stderr)
+        start_time = time.time()
+
+        blocks = []  # start offset of each block
+        block_ids_by_trigram = {}
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rb') as fh:
+            offset = 0
+            while True:
+                data = fh.read(self.block_size)
+                if not data:
+                    break
+                # end the block at a newline, so that a line is never split across blocks
+                data += fh.readline()
+
+                block_id = len(blocks)
+                blocks.append(offset)
+                offset += len(data)
+                for t in get_trigrams(data):
+                    if t in block_ids_by_trigram:
+                        block_ids_by_trigram[t].append(block_id)
+                    else:
+                        block_ids_by_trigram[t] = [block_id]
+
+        nbytes = (len(blocks) + 7) // 8
+
+        def get_bitmap(block_ids: list) -> bytes:
+            bitmap = bytearray(nbytes)
+            for b in block_ids:
+                bitmap[b >> 3] |= 1 << (b & 7)
+            return bytes(bitmap)
+
+        with self.conn:
+            if file_id is not None:
+                self.conn.execute('DELETE FROM postings WHERE file_id = ?', (file_id,))
+                self.conn.execute('DELETE FROM files WHERE id = ?', (file_id,))
+            cursor = self.conn.execute(
+                'INSERT INTO files (path, mtime, size, ino, blocks) VALUES (?, ?, ?, ?, ?)',
+                (path, st.st_mtime, st.st_size, st.st_ino, ','.join([str(b) for b in blocks])))
+            file_id = cursor.lastrowid
+            self.conn.executemany(
+                'INSERT INTO postings (trigram, file_id, bitmap) VALUES (?, ?, ?)',
+                ((t, file_id, get_bitmap(ids)) for t, ids in block_ids_by_trigram.items()))
+
+        if self.verbose:
+            log_FileFuncLine(f'indexed {path}, {len(blocks)} blocks, {len(block_ids_by_trigram)} trigrams, '
+                             f'{time.time() - start_time:.2f} seconds', file=sys.stderr)
+
+    def get_candidates(self,
+                       files: list,
+                       MatchPatterns: list,
+                       CaseInsensitive: bool = False) -> dict:
+        """
+        update the index for the files, then return {file: ranges} for the files that
+        may have a match. ranges is a list of (start, end) byte ranges, end=None means
+        EOF, to be read by TpInput(ranges=...). ranges=None means the whole file.
+        files missing from the result cannot have a match.
+        """
+        if self.conn is None:
+            return self.get_all(files)
+        try:
+            return self.narrow(files, MatchPatterns, CaseInsensitive=CaseInsensitive)
+        except sqlite3.OperationalError as e:
+            # eg, another process has held 'database is locked' for over busy_timeout
+            log_FileFuncLine(f'cannot use {self.db_file}: {e}. search without the index', file=sys.stderr)
+            return self.get_all(files)
+
+    def get_all(self, files: list) -> dict:
+        """ the result of get_candidates() when we cannot narrow: all files, whole """
+        return {f: None for f in files if not self.is_index_file(f)}
+
+    def narrow(self, files: list, MatchPatterns: list, CaseInsensitive: bool = False) -> dict:
+        self.update(files)
+
+        trigrams = get_pattern_trigrams(MatchPatterns, CaseInsensitive=CaseInsensitive)
+        if not trigrams:
+            if self.verbose:
+                log_FileFuncLine(f'no trigram in {MatchPatterns}, cannot narrow', file=sys.stderr)
+            return self.get_all(files)
+
+        file_by_id = {}
+        blocks_by_id = {}
+        candidates = {}
+        for f in files:
+            if f == '-' or self.is_index_file(f):
+                # stdin is never indexed
+                if f == '-':
+                    candidates[f] = None
+                continue
+            row = self.conn.execute('SELECT id, blocks FROM files WHERE path = ?',
+                                    (os.path.abspath(f),)).fetchone()
+            if row is None:
+                # cannot stat or index it. let the grep report the error.
+                candidates[f] = None
+                continue
+            file_by_id[row[0]] = f
+            blocks_by_id[row[0]] = [int(b) for b in row[1].split(',')] if row[1] else []
+
+        # AND the block bitmaps of all trigrams
+        bitmap_by_id = None
+        for t in trigrams:
+            found = {}
+            for file_id, bitmap in self.conn.execute(
+                    'SELECT file_id, bitmap FROM postings WHERE trigram = ?', (t,)):
+                if file_id not in file_by_id:
+                    continue
+                if bitmap_by_id is None:
+                    found[file_id] = int.from_bytes(bitmap, 'little')
+                elif file_id in bitmap_by_id:
+                    both = bitmap_by_id[file_id] & int.from_bytes(bitmap, 'little')
+                    if both:
+                        found[file_id] = both
+            bitmap_by_id = found
+            if not bitmap_by_id:
+                break
+
+        for file_id, bitmap in bitmap_by_id.items():
+            f = file_by_id[file_id]
+            if f.endswith('.gz'):
+                candidates[f] = None
+                continue
+            blocks = blocks_by_id[file_id]
+            ranges = []
+            for i, start in enumerate(blocks):
+                if not (bitmap >> i) & 1:
+                    continue
+                # the last block reads to EOF, in case the file grew after we indexed it
+                end = blocks[i + 1] if i + 1 < len(blocks) else None
+                if ranges and ranges[-1][1] == start:
+                    ranges[-1] = (ranges[-1][0], end)
+                else:
+                    ranges.append((start, end))
+            candidates[f] = ranges
+
+        if self.verbose:
+            log_FileFuncLine(f'{len(candidates)} of {len(files)} files may match', file=sys.stderr)
+
+        # keep the caller's file order
+        return {f: candidates[f] for f in files if f in candidates}
+
+
+def main():
+    import tpsup.tmptools
+    TPSUP = os.environ.get('TPSUP')
+    files = [f'{TPSUP}/python3/scripts/ptgrep_test_1.txt',
+             f'{TPSUP}/python3/scripts/ptgrep_test_2.txt']
+    index_dir = f'{tpsup.tmptools.get_dailydir()}/trigram_test'
+    ti = TrigramIndex(index_dir)
+
+    # index a file, then rename it. the next search in its dir purges the old rows.
+    gone_file = f'{index_dir}_gone.txt'
+    renamed_file = f'{index_dir}_renamed.txt'
+    with open(gone_file, 'w') as fh:
+        fh.write('mypattern3\n')
+    ti.get_candidates([gone_file], ['mypattern3'])
+    os.replace(gone_file, renamed_file)
+
+    def test_codes():
+        get_trigrams(b'abcd')  # [6382179, 6447972]
+        sorted(get_pattern_trigrams([r'abcd\d+']))  # [6382179, 6447972]
+        get_pattern_trigrams([r'ab\d+'])  # set()
+        ti.get_candidates(files, ['mypattern1'])
+        ti.get_candidates(files, ['no_such_thing'])  # {}
+        ti.get_candidates(files, ['mypattern'], CaseInsensitive=True)
+        ti.get_candidates([renamed_file], ['mypattern3'])
+        ti.conn.execute('SELECT count(*) FROM files WHERE path = ?', (gone_file,)).fetchone()  # (0,)
+
+    from tpsup.testtools import test_lines
+    test_lines(test_codes, source_globals=globals(), source_locals=locals())
+    ti.close()
+
+
+if __name__ == '__main__':
+    main()
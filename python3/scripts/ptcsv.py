@@ -51,9 +51,63 @@ examples:
     
     # test empty file
     ptcsv.py ptcsv_py_test_empty.csv
+
+    # match -mp/-xp patterns on raw bytes, only decode matched lines
+    ptcsv.py -binary -mp 'c,2' ptcsv_py_test.csv
+
+    # filter a large uncompressed csv in 4 processes. the output keeps the input order.
+    ptcsv.py -j 4 -me "float(r['number']) > 2" ptcsv_py_test.csv
+
+    # sort, numerically on 'number'. big inputs spill sorted runs to -tmpdir past -memory MB.
+    ptcsv.py -sort number:num -sort_reverse ptcsv_py_test.csv
+
+    # roll up: one row per group, sorted by the group columns
+    ptcsv.py -groupby alpha -agg count -agg sum:number -agg total=max:number ptcsv_py_test.csv
+
+    # join with another csv on a key column, then filter the joined rows.
+    # the smaller file is loaded into memory; the right columns clashing with the left
+    # ones are renamed right_<col>.
+    ptcsv.py -join ptcsv_py_test.csv -on alpha -me "r['number'] != r['right_number']" ptcsv_py_test.csv
+    ptcsv.py -join ptcsv_py_test.csv -on alpha=alpha -how anti ptcsv_py_test_missing.csv
+
+    # both files already sorted on the key: merge join, in constant memory
+    ptcsv.py -sort id -o /tmp/blotter.csv blotter.csv; ptcsv.py -sort id -o /tmp/broker.csv broker.csv
+    ptcsv.py -join /tmp/broker.csv -on id -sorted -how left /tmp/blotter.csv
+
+    # run simple numeric/string conditions as numpy masks over batches of rows.
+    # the conditions numpy cannot run, eg, re.search(), run row by row on what is left.
+    ptcsv.py -engine numpy -me "float(r['number']) > 2 and r['alpha'] != 'd'" ptcsv_py_test.csv
+
+    # keep a binary columnar copy of a big csv file. the next run on the unchanged file
+    # skips parsing; with -engine numpy, its numeric columns are used as they are.
+    ptcsv.py -cache -engine numpy -me "float(r['number']) > 2" ptcsv_py_test.csv
+
+    # convert the int, float and yyyymmdd columns, so that the expressions compare numbers
+    # and dates. the output keeps the original text. the types are reported on stderr. -schema col=type,... sets some of them.
+    ptcsv.py -schema infer -me "r['number'] > 2" ptcsv_py_test.csv
+    ptcsv.py -schema number=float -me "r['number'] > 2.5" ptcsv_py_test.csv
+
+    # decompress .csv.gz in a background thread while filtering in this one
+    ptcsv.py -readahead -mp 'J' ../lib/tpsup/csvtools_test.csv.gz
     
     """)
 
+
+def parse_schema(schema: str):
+    # 'infer', or 'col=type,...' where type is int, float, date (yyyymmdd) or str
+    if schema == 'infer':
+        return schema
+    given = {}
+    for pair in schema.split(','):
+        if pair == 'infer':
+            continue  # the other columns are always inferred
+        col, sep, type_name = pair.partition('=')
+        if not sep:
+            raise argparse.ArgumentTypeError(f"expected 'infer' or col=type, got '{pair}'")
+        given[col] = type_name
+    return given
+
+
 parser = argparse.ArgumentParser(
     prog=sys.argv[0],
     description=usage,
@@ -112,8 +166,106 @@ parser.add_argument(
     '-skip', dest="skip", default=0, action='store', type=int,
     help="skip these number of lines before header, default to 0")
 
+parser.add_argument(
+    '-binary', dest="binary", default=False, action='store_true',
+    help="match -mp/-xp on raw bytes and only decode matched lines")
+
+parser.add_argument(
+    '-errors', dest="errors", default=None, action='store',
+    help="decode error policy for -binary, eg, strict, replace, ignore. default to replace. "
+         "without -binary, a decode error fails")
+
+parser.add_argument(
+    '-j', dest="Parallel", default=None, action='store', type=int,
+    help="filter an uncompressed file in this many processes")
+
+parser.add_argument(
+    '-sort', dest="SortKeys", default=None, action='append',
+    help="sort by this column, 'col:num' to sort as numbers. can use multiple times")
+
+parser.add_argument(
+    '-sort_reverse', dest="SortReverse", default=False, action='store_true',
+    help="sort in descending order")
+
+parser.add_argument(
+    '-groupby', dest="GroupBy", default=None, action='store', type=lambda x: x.split(','),
+    help="group by these columns, eg, -groupby side,sym")
+
+parser.add_argument(
+    '-agg', dest="Aggs", default=None, action='append',
+    help="aggregate of each group: count, or func:col, or name=func:col. "
+         "func is count, sum, min, max, mean, first or last. can use multiple times")
+
+parser.add_argument(
+    '-memory', dest="MemoryMB", default=256, action='store', type=float,
+    help="MB of rows to sort or group in memory before spilling to temp files, default to 256")
+
+parser.add_argument(
+    '-tmpdir', dest="TmpDir", default=None, action='store',
+    help="dir for the spilled temp files, default to the system temp dir")
+
+parser.add_argument(
+    '-join', '--join', dest="right", default=None, action='store',
+    help="join the input csv (left) with this csv (right), see -on and -how. "
+         "-d, -skip, -binary, -errors, -cache and -readahead apply to both files; "
+         "-mp, -xp and -j only to the input csv")
+
+parser.add_argument(
+    '-on', dest="on", default=None, action='store',
+    help="join columns, 'col' or 'left_col=right_col', comma separated, eg, -on id,side")
+
+parser.add_argument(
+    '-how', dest="how", default='inner', action='store', choices=['inner', 'left', 'anti'],
+    help="inner: matched rows. left: all left rows. anti: left rows without a match. default to inner")
+
+parser.add_argument(
+    '-sorted', dest="Sorted", default=False, action='store_true',
+    help="both join inputs are sorted on the join columns: merge join in constant memory")
+
+parser.add_argument(
+    '-cache', dest="Cache", default=False, action='store_true',
+    help="keep a binary columnar copy of the csv file; later runs read it while the file is unchanged")
+
+parser.add_argument(
+    '-cache_dir', dest="CacheDir", default=None, action='store',
+    help="dir of the -cache copies, default to ~/.tpsup/csvcache")
+
+parser.add_argument(
+    '-cache_mb', dest="CacheMB", default=1024, action='store', type=float,
+    help="MB of -cache copies to keep; the least recently used ones are removed. default to 1024")
+
+parser.add_argument(
+    '-schema', '--schema', dest="Schema", default=None, action='store', type=parse_schema,
+    help="'infer', or col=type,... with type int, float, date or str; other columns are inferred. "
+         "the expressions, sorting and grouping see typed values; the output keeps the original text. "
+         "the types are reported on stderr")
+
+parser.add_argument(
+    '-schema_rows', dest="SchemaRows", default=1000, action='store', type=int,
+    help="number of rows to infer the -schema types from, default to 1000")
+
+parser.add_argument(
+    '-engine', dest="Engine", default='row', action='store', choices=['row', 'numpy'],
+    help="row: evaluate expressions row by row. numpy: vectorize the simple ones. default to row")
+
+parser.add_argument(
+    '-readahead', dest="readahead", default=False, action='store_true',
+    help="decompress .gz input in a background thread")
+
+parser.add_argument(
+    '-readahead_block', dest="readahead_block", default=4, type=float, action='store',
+    help="MB of uncompressed data per read-ahead block, default to 4")
+
+parser.add_argument(
+    '-readahead_depth', dest="readahead_depth", default=4, type=int, action='store',
+    help="max number of read-ahead blocks waiting to be filtered, default to 4")
+
 args = vars(parser.parse_args())
 
+if not args['binary'] or args['errors'] is None:
+    # like ptgrep, -errors only applies to -binary. TpInput defaults it to replace there.
+    args.pop('errors')
+
 if args['verbose'] >= 1:
     sys.stderr.write("args =\n")
     sys.stderr.write(pformat(args) + "\n")
@@ -131,7 +283,26 @@ if args['verbose'] >= 1:
 
 # query_csv(**args);
 
+if args['right']:
+    if not args['on']:
+        sys.stderr.write("-join needs -on\n")
+        sys.exit(1)
+    if args['Schema']:
+        sys.stderr.write("-schema is not supported with -join\n")
+        sys.exit(1)
+    if args['Engine'] != 'row':
+        sys.stderr.write("-engine is not supported with -join\n")
+        sys.exit(1)
+    with tpsup.csvtools.JoinCsv(args.pop('filename'), args.pop('right'), args.pop('on'), **args) as jc:
+        jc.output(filename=args['Output'], **args)
+    sys.exit(0)
+
+for k in ['right', 'on', 'how', 'Sorted']:
+    args.pop(k)
+
 with tpsup.csvtools.QueryCsv(
         **args) as qc:
     args.pop('filename')
+    if qc.schema:
+        sys.stderr.write(f"schema:\n{tpsup.csvtools.format_schema(qc.schema)}\n")
     qc.output(filename=args['Output'], **args)
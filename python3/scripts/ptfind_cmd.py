@@ -7,6 +7,7 @@ import argparse
 import textwrap
 from pprint import pprint, pformat
 from tpsup.filetools import tpfind
+from tpsup.snapshottools import take_snapshot, save_snapshot, load_snapshot, diff_snapshots, print_diffs
 
 prog = os.path.basename(sys.argv[0]).replace('_cmd.py', '')
 
@@ -37,6 +38,10 @@ examples = textwrap.dedent(f"""
         -dump                  print out detail of the path
         -maxdepth  int         max depth to search. 0 means given path only.
         -maxcount  int         max count to search
+        -j         int         list directories in this many threads. good for NFS.
+        -sort                  visit the entries of each directory in name order
+        -snapshot  file        save a snapshot of (path, inode, size, mtime, mode) to the file
+        -since     file        only print what was added, removed or changed since the snapshot
 
         # print the dir tree
         {prog} -maxdepth 0 $TPSUP
@@ -48,6 +53,16 @@ examples = textwrap.dedent(f"""
         {prog} -maxcount 5 -m 'r["path"].endswith(".py")' $TPSUP
         {prog} -maxcount 5 -m 'r["size"] > 50000 and r["type"] != "dir"' $TPSUP -ls
 
+        # list directories in 16 threads, eg, on a share with slow directory reads.
+        # the output is in the same order as without -j.
+        {prog} -j 16 -sort -m 'r["short"].endswith(".log")' /nfs/share/logs
+
+        # check a tree for changes, eg, hourly. the 1st run only saves the snapshot.
+        # later runs print the changes, then save the new snapshot. directories whose
+        # mtime has not changed are not read again, but their entries are still stat'ed.
+        {prog} --snapshot /var/tmp/deploy.snap.gz /opt/deploy
+        {prog} --since /var/tmp/deploy.snap.gz --snapshot /var/tmp/deploy.snap.gz /opt/deploy
+
         # flow control
         {prog} -fe 'r["short"] in ["scripts", "lib", "python3", "bat"]' -fd prune $TPSUP
         {prog} -fe 'r["short"] in ["scripts", "lib", "python3", "bat"]' -fd exit  $TPSUP
@@ -114,6 +129,22 @@ parser.add_argument(
     '-maxcount', dest='MaxCount', type=int, default=None,
     help='max count to search')
 
+parser.add_argument(
+    '-j', dest='Workers', type=int, default=None,
+    help='number of threads to list directories')
+
+parser.add_argument(
+    '-sort', dest='Sorted', action="store_true",
+    help='visit the entries of each directory in name order')
+
+parser.add_argument(
+    '-snapshot', '--snapshot', dest='snapshot', default=None,
+    help='save a snapshot of the tree to this file')
+
+parser.add_argument(
+    '-since', '--since', dest='since', default=None,
+    help='print only the changes since the snapshot in this file')
+
 parser.add_argument(
     'paths',  # this is the remaining args
     nargs='*',  # 0 or more positional arguments.
@@ -137,4 +168,23 @@ if not args['paths']:
     print(examples)
     sys.exit(1)
 
-tpfind(**args)
+snapshot_file = args.pop('snapshot')
+since_file = args.pop('since')
+
+if not snapshot_file and not since_file:
+    tpfind(**args)
+    sys.exit(0)
+
+old = None
+if since_file and os.path.exists(since_file):
+    old = load_snapshot(since_file)
+elif since_file:
+    print(f'{since_file} not found. every entry is reported as added.', file=sys.stderr)
+
+new = take_snapshot(args.pop('paths'), Listings=old['listings'] if old else None, **args)
+
+if since_file:
+    print_diffs(diff_snapshots(old if old else {'records': []}, new))
+
+if snapshot_file:
+    save_snapshot(new, snapshot_file, **args)
@@ -40,6 +40,37 @@ examples = textwrap.dedent(f"""
         # file name only
         {prog} -l -r selenium .
 
+        # grep files in parallel, using 4 processes
+        {prog} -j 4 -r selenium .
+
+        # match raw bytes, only decode matched lines. good for big logs with bad bytes.
+        {prog} -binary mypattern ptgrep_test*
+        {prog} -binary -errors ignore mypattern ptgrep_test*
+
+        # scan each uncompressed file as one mmap buffer. good when few lines match.
+        {prog} -engine mmap mypattern ptgrep_test*
+
+        # only grep the last 10 MB of each file. with -gzindex, .gz files keep a sidecar
+        # index, so later runs jump to the tail instead of decompressing from the start.
+        {prog} -tail 10000000 -gzindex mypattern /var/log/app.log.*.gz
+
+        # only the last 5 matches of each file, reading backward from the end.
+        {prog} -last 5 mypattern ptgrep_test*
+
+        # keep a trigram index of the logs in ~/.tpsup/ptgrep_index. the first run builds it,
+        # later runs only index new or changed files, and only grep the blocks that may match.
+        {prog} -index ~/.tpsup/ptgrep_index -r 'orderid=ORD123' /var/log/fix
+        {prog} -index ~/.tpsup/ptgrep_index -index_block 4 -r 'orderid=ORD123' /var/log/fix
+
+        # keep printing new matches as the log grows, like 'tail -f | grep'.
+        # rotation and truncation are handled. -tail skips the old part first.
+        {prog} -F -tail 0 mypattern /var/log/app.log
+        {prog} -F -follow_idle 3600 mypattern /var/log/app.log
+
+        # decompress .gz files in a background thread while matching in this one
+        {prog} -readahead mypattern /var/log/app.log.*.gz
+        {prog} -readahead -readahead_block 8 -readahead_depth 2 mypattern /var/log/app.log.*.gz
+
     """)
 
 parser = argparse.ArgumentParser(
@@ -72,6 +103,62 @@ parser.add_argument(
     '-i', dest='CaseInsensitive', action="store_true",
     default=False, help='case-insensitive')
 
+parser.add_argument(
+    '-j', dest='Parallel', default=None, type=int,
+    help='number of processes to grep files in parallel')
+
+parser.add_argument(
+    '-binary', '--binary', dest='binary', action="store_true", default=False,
+    help='match raw bytes and only decode matched lines')
+
+parser.add_argument(
+    '-errors', '--errors', dest='errors', default='replace', action='store',
+    help="decode error policy for -binary, eg, strict, replace, ignore. default to replace")
+
+parser.add_argument(
+    '-engine', '--engine', dest='Engine', default='line', choices=['line', 'mmap'],
+    help='search engine. mmap falls back to line for .gz and stdin. default to line')
+
+parser.add_argument(
+    '-gzindex', '--gzindex', dest='gzindex', action="store_true", default=False,
+    help='build and reuse a sidecar seek index for .gz files')
+
+parser.add_argument(
+    '-tail', '--tail', dest='tail', default=None, type=int,
+    help='only grep the last this many (uncompressed) bytes of each file')
+
+parser.add_argument(
+    '-index', '--index', dest='Index', default=None, action='store',
+    help='directory of a persistent trigram index, to narrow repeated searches')
+
+parser.add_argument(
+    '-index_block', '--index-block', dest='index_block', default=1, type=float,
+    help='MB per indexed block, for newly indexed files. default to 1')
+
+parser.add_argument(
+    '-last', '--last', dest='LastN', default=None, type=int,
+    help='only print the last this many matches of each file, reading it backward')
+
+parser.add_argument(
+    '-F', '-follow', '--follow', dest='Follow', action="store_true", default=False,
+    help='keep reading as the files grow, like tail -f. .gz files are read once')
+
+parser.add_argument(
+    '-follow_idle', '--follow-idle', dest='follow_idle', default=None, type=float,
+    help='with -F, stop after this many seconds without a new line. default to never')
+
+parser.add_argument(
+    '-readahead', '--readahead', dest='readahead', action="store_true", default=False,
+    help='decompress .gz files in a background thread')
+
+parser.add_argument(
+    '-readahead_block', '--readahead-block', dest='readahead_block', default=4, type=float,
+    help='MB of uncompressed data per read-ahead block. default to 4')
+
+parser.add_argument(
+    '-readahead_depth', '--readahead-depth', dest='readahead_depth', default=4, type=int,
+    help='max number of read-ahead blocks waiting to be matched. default to 4')
+
 parser.add_argument(
     '-d', dest='verbose', default=0, action="count",
     help='verbose mode. -d, -dd, -ddd, ...')
@@ -128,6 +215,26 @@ opt['verbose'] = args['verbose']
 opt['CaseInsensitive'] = args['CaseInsensitive']
 opt['Recursive'] = args['Recursive']
 opt['FileNameOnly'] = args['FileNameOnly']
+opt['Parallel'] = args['Parallel']
+opt['Engine'] = args['Engine']
+opt['gzindex'] = args['gzindex']
+if args['tail'] is not None:
+    opt['tail'] = args['tail']
+if args['Index']:
+    opt['Index'] = args['Index']
+    opt['index_block'] = args['index_block']
+if args['LastN']:
+    opt['LastN'] = args['LastN']
+if args['Follow']:
+    opt['Follow'] = True
+    opt['follow_idle'] = args['follow_idle']
+if args['readahead']:
+    opt['readahead'] = True
+    opt['readahead_block'] = args['readahead_block']
+    opt['readahead_depth'] = args['readahead_depth']
+if args['binary']:
+    opt['binary'] = True
+    opt['errors'] = args['errors']
 
 if verbose:
     print(f'opt={pformat(opt)}', file=sys.stderr)